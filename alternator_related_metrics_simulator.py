@@ -3,10 +3,14 @@ import websockets
 import random
 import json
 import time
+from obd_wire import SUBPROTOCOL_BINARY, encode_binary_frame
 
 # Assuming "admin" has user_id 1 (you can check the exact value in the SQLite database)
 admin_user_id = 1
 
+# Wire format: "json" (default) or "binary" for compact obd.bin.v1 frames
+wire_format = "json"
+
 # Function to simulate battery voltage, engine load, and RPM
 def simulate_obd_data():
     # Simulate battery voltage between 12.5V and 14.8V
@@ -27,15 +31,20 @@ def simulate_obd_data():
 
 # WebSocket client function to send data to the server
 async def send_obd_data(uri):
-    async with websockets.connect(uri) as websocket:
+    subprotocols = [SUBPROTOCOL_BINARY] if wire_format == "binary" else None
+    async with websockets.connect(uri, subprotocols=subprotocols) as websocket:
         while True:
             try:
                 # Simulate OBD-II data
                 obd_data = simulate_obd_data()
                 obd_data["timestamp"] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
 
-                # Send data as JSON via WebSocket
-                await websocket.send(json.dumps(obd_data))
+                # Send data as a binary frame if the server accepted it, otherwise as JSON
+                if websocket.subprotocol == SUBPROTOCOL_BINARY:
+                    sample = dict(obd_data, ts=int(time.time() * 1000))
+                    await websocket.send(encode_binary_frame(admin_user_id, [sample]))
+                else:
+                    await websocket.send(json.dumps(obd_data))
                 print(f"Sent simulated data: {obd_data}")
 
                 # Wait for 1 second before sending the next batch of simulated data
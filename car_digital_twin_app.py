@@ -3,64 +3,21 @@ import websockets
 import json
 import streamlit as st
 import pandas as pd
-import sqlite3
 import bcrypt  # For password hashing
 import threading
-
-# Initialize SQLite Database
-def init_db():
-    conn = sqlite3.connect('obd_data.db')
-    cursor = conn.cursor()
-
-    # Create table for user authentication
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE,
-            password TEXT
-        )
-    ''')
-
-    # Create table for storing OBD-II data with user association
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS obd_data (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            timestamp TEXT,
-            battery_voltage REAL,
-            engine_load REAL,
-            rpm REAL,
-            FOREIGN KEY(user_id) REFERENCES users(id)
-        )
-    ''')
-
-    conn.commit()
-
-    # Create a default admin account if it doesn't exist
-    cursor.execute('''
-        SELECT * FROM users WHERE username = ?
-    ''', ('admin',))
-    if cursor.fetchone() is None:
-        # Hash the default password (new complex password: "boogy332!")
-        hashed_password = bcrypt.hashpw('boogy332!'.encode('utf-8'), bcrypt.gensalt())
-        cursor.execute('''
-            INSERT INTO users (username, password)
-            VALUES (?, ?)
-        ''', ('admin', hashed_password))
-        conn.commit()
-        print("Admin account created with default credentials: username: admin, password: boogy332!")
-
-    conn.close()
+from obd_config import apply_config, parse_args
+from obd_dashboard_data import open_database, user_exists
+from obd_profiling import get_profiler
+from obd_storage import connection, timestamp_to_ms
 
 # Function to authenticate user
 def authenticate_user(username, password):
-    conn = sqlite3.connect('obd_data.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT id, password FROM users WHERE username = ?
-    ''', (username,))
-    user = cursor.fetchone()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, password FROM users WHERE username = ?
+        ''', (username,))
+        user = cursor.fetchone()
 
     if user:
         user_id, hashed_password = user
@@ -68,27 +25,15 @@ def authenticate_user(username, password):
             return user_id
     return None
 
-# Function to check if user exists
-def user_exists(user_id):
-    conn = sqlite3.connect('obd_data.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT id FROM users WHERE id = ?
-    ''', (user_id,))
-    user = cursor.fetchone()
-    conn.close()
-    return user is not None
-
 # Function to store data in SQLite
 def store_data_in_db(user_id, timestamp, battery_voltage, engine_load, rpm):
-    conn = sqlite3.connect('obd_data.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO obd_data (user_id, timestamp, battery_voltage, engine_load, rpm)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (user_id, timestamp, battery_voltage, engine_load, rpm))
-    conn.commit()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO obd_data (user_id, ts, battery_voltage, engine_load, rpm)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (user_id, timestamp_to_ms(timestamp), battery_voltage, engine_load, rpm))
+        conn.commit()
 
 # Streamlit login function using st.form
 def login():
@@ -112,67 +57,74 @@ def login():
 # WebSocket handler
 async def obd_websocket(websocket, path):
     global battery_voltage_data, engine_load_data, rpm_data, timestamps
+    profiler = get_profiler('app')
     while True:
         try:
             # Receive data from WebSocket client
             message = await websocket.recv()
-            data = json.loads(message)
-
-            # Check if the user_id is valid
-            if 'user_id' not in data:
-                await websocket.send(json.dumps({"error": "user_id missing in message"}))
-                continue
-
-            user_id = data['user_id']
-            if not user_exists(user_id):
-                await websocket.send(json.dumps({"error": "Invalid user_id"}))
-                continue
-
-            # Update the text displays
-            battery_voltage_display.markdown(f"**Battery Voltage:** {data['battery_voltage']}")
-            engine_load_display.markdown(f"**Engine Load:** {data['engine_load']}")
-            rpm_display.markdown(f"**RPM:** {data['rpm']}")
-
-            # Parse the numeric values for graphing
-            battery_voltage_value = float(data['battery_voltage'].split()[0])
-            engine_load_value = float(data['engine_load'].split()[0])
-            rpm_value = float(data['rpm'].split()[0])
-
-            # Append the values to the data containers
-            timestamps.append(data['timestamp'])
-            battery_voltage_data.append(battery_voltage_value)
-            engine_load_data.append(engine_load_value)
-            rpm_data.append(rpm_value)
-
-            # Store the incoming data in SQLite, associated with the provided user_id
-            store_data_in_db(user_id, data['timestamp'], battery_voltage_value, engine_load_value, rpm_value)
-
-            # Trim the lists to the last 20 records
-            if len(timestamps) > 20:
-                timestamps = timestamps[-20:]
-                battery_voltage_data = battery_voltage_data[-20:]
-                engine_load_data = engine_load_data[-20:]
-                rpm_data = rpm_data[-20:]
-
-            # Update the charts by re-creating them with the last 20 records
-            battery_voltage_chart.line_chart(pd.DataFrame({'Battery Voltage (V)': battery_voltage_data}, index=timestamps))
-            engine_load_chart.line_chart(pd.DataFrame({'Engine Load (%)': engine_load_data}, index=timestamps))
-            rpm_chart.line_chart(pd.DataFrame({'RPM': rpm_data}, index=timestamps))
+            with profiler.section('obd_websocket'):
+                data = json.loads(message)
+
+                # Check if the user_id is valid
+                if 'user_id' not in data:
+                    await websocket.send(json.dumps({"error": "user_id missing in message"}))
+                    continue
+
+                user_id = data['user_id']
+                if not user_exists(user_id):
+                    await websocket.send(json.dumps({"error": "Invalid user_id"}))
+                    continue
+
+                # Update the text displays
+                battery_voltage_display.markdown(f"**Battery Voltage:** {data['battery_voltage']}")
+                engine_load_display.markdown(f"**Engine Load:** {data['engine_load']}")
+                rpm_display.markdown(f"**RPM:** {data['rpm']}")
+
+                # Parse the numeric values for graphing
+                battery_voltage_value = float(data['battery_voltage'].split()[0])
+                engine_load_value = float(data['engine_load'].split()[0])
+                rpm_value = float(data['rpm'].split()[0])
+
+                # Append the values to the data containers
+                timestamps.append(data['timestamp'])
+                battery_voltage_data.append(battery_voltage_value)
+                engine_load_data.append(engine_load_value)
+                rpm_data.append(rpm_value)
+
+                # Store the incoming data in SQLite, associated with the provided user_id
+                store_data_in_db(user_id, data['timestamp'], battery_voltage_value, engine_load_value, rpm_value)
+
+                # Trim the lists to the last 20 records
+                if len(timestamps) > 20:
+                    timestamps = timestamps[-20:]
+                    battery_voltage_data = battery_voltage_data[-20:]
+                    engine_load_data = engine_load_data[-20:]
+                    rpm_data = rpm_data[-20:]
+
+                # Update the charts by re-creating them with the last 20 records
+                battery_voltage_chart.line_chart(pd.DataFrame({'Battery Voltage (V)': battery_voltage_data}, index=timestamps))
+                engine_load_chart.line_chart(pd.DataFrame({'Engine Load (%)': engine_load_data}, index=timestamps))
+                rpm_chart.line_chart(pd.DataFrame({'RPM': rpm_data}, index=timestamps))
 
         except websockets.ConnectionClosed:
             print("Client disconnected")
             break
 
 # WebSocket server coroutine
-async def start_websocket_server():
-    async with websockets.serve(obd_websocket, "localhost", 8765):
-        print("WebSocket server started on ws://localhost:8765")
+async def start_websocket_server(host, port):
+    async with websockets.serve(obd_websocket, host, port):
+        print(f"WebSocket server started on ws://{host}:{port}")
         await asyncio.Future()  # Run forever
 
 # Main function to run the WebSocket server and Streamlit
 def main():
-    # Initialize SQLite database
-    init_db()
+    # Options come after `--`: streamlit run car_digital_twin_app.py -- --port ...
+    config = apply_config(parse_args("OBD-II dashboard that receives the frames itself.", server=True))
+    if config.profile:
+        get_profiler('app').start()
+
+    # Initialize SQLite database, once per process
+    open_database(config.db_path)
 
     # Handle user login
     if 'logged_in' not in st.session_state:
@@ -208,7 +160,7 @@ def main():
         timestamps = []
 
         # Run the WebSocket server asynchronously
-        asyncio.run(start_websocket_server())
+        asyncio.run(start_websocket_server(config.host, config.port))
 
 if __name__ == "__main__":
     main()
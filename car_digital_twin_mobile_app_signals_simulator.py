@@ -3,10 +3,20 @@ import websockets
 import random
 import json
 import time
+from obd_wire import SUBPROTOCOL_BINARY, encode_binary_frame
 
 # Assuming "admin" has user_id 1 (you can check the exact value in the SQLite database)
 admin_user_id = 1
 
+# Wire format: "json" (default) or "binary" for compact obd.bin.v1 frames
+wire_format = "json"
+
+# Readings taken per second, and readings sent per websocket message. The defaults
+# send one reading every second; e.g. 10 and 10 sends one batch of 10 Hz readings
+# every second.
+sample_rate_hz = 1
+batch_size = 1
+
 # Hard-coded normal ranges for OBD-II parameters
 NORMAL_RANGES = {
     'battery_voltage': (12.5, 14.8),
@@ -68,20 +78,46 @@ def simulate_obd_data():
         "timestamp": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())  # Add timestamp
     }
 
+# Function to encode buffered (epoch ms, reading) pairs as one websocket message
+def encode_batch(batch, binary):
+    if binary:
+        return encode_binary_frame(admin_user_id, [dict(obd_data, ts=ts) for ts, obd_data in batch])
+    if len(batch) == 1:
+        ts, obd_data = batch[0]
+        return json.dumps(dict(obd_data, ts=ts))
+    return json.dumps({
+        "user_id": admin_user_id,
+        "samples": [
+            dict({k: v for k, v in obd_data.items() if k != "user_id"}, ts=ts) for ts, obd_data in batch
+        ]
+    })
+
 # WebSocket client function to send data to the server
 async def send_obd_data(uri):
-    async with websockets.connect(uri) as websocket:
+    subprotocols = [SUBPROTOCOL_BINARY] if wire_format == "binary" else None
+    async with websockets.connect(uri, subprotocols=subprotocols) as websocket:
+        binary = websocket.subprotocol == SUBPROTOCOL_BINARY
+        loop = asyncio.get_running_loop()
+        next_sample = loop.time()
+        batch = []
         while True:
             try:
                 # Simulate OBD-II data
                 obd_data = simulate_obd_data()
+                batch.append((int(time.time() * 1000), obd_data))
 
-                # Send data as JSON via WebSocket
-                await websocket.send(json.dumps(obd_data))
-                print(f"Sent simulated data: {obd_data}")
+                # Send the buffered readings as a binary frame if the server accepted it, otherwise as JSON
+                if len(batch) >= batch_size:
+                    await websocket.send(encode_batch(batch, binary))
+                    if len(batch) == 1:
+                        print(f"Sent simulated data: {obd_data}")
+                    else:
+                        print(f"Sent batch of {len(batch)} simulated readings, last: {obd_data}")
+                    batch = []
 
-                # Wait for 1 second before sending the next batch of simulated data
-                await asyncio.sleep(1)
+                # Wait until the next reading is due
+                next_sample += 1 / sample_rate_hz
+                await asyncio.sleep(max(0, next_sample - loop.time()))
 
             except websockets.ConnectionClosed:
                 print("Connection to server closed")
@@ -1,12 +1,19 @@
-import sqlite3
 import streamlit as st
 import bcrypt
 import time
+import numpy as np
 import pandas as pd
 import time
 from datetime import datetime, timedelta
 import subprocess
 import os
+from collections import deque
+from obd_config import apply_config, parse_args
+from obd_dashboard_data import (CHART_WINDOW, HISTORY_TTL, LIVE_TTL, LOG_PAGE_SIZE, LOG_TTL, FeedReader,
+                                latest_obd_data, metric_history, open_database, out_of_norm_logs, static_asset,
+                                window_start)
+from obd_profiling import get_profiler
+from obd_storage import METRIC_COLUMNS, TIMESTAMP_FORMAT, connection, ms_to_datetime
 
 # Function to authenticate user
 def authenticate_user(username, password):
@@ -22,22 +29,75 @@ def authenticate_user(username, password):
     return user_id
     # return None
 
-# Function to retrieve the latest 20 OBD-II entries for the logged-in user
-def get_latest_obd_data(user_id):
-    conn = sqlite3.connect('obd_data.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT timestamp, battery_voltage, engine_load, rpm, 
-               coolant_temp, throttle_position, fuel_level, 
-               intake_pressure, maf_rate
-        FROM obd_data
-        WHERE user_id = ?
-        ORDER BY id DESC
-        LIMIT 30
-    ''', (user_id,))
-    rows = cursor.fetchall()
-    conn.close()
-    return rows[::-1]  # Reverse to get chronological order
+# Name, unit and chart label of each metric, in METRIC_COLUMNS order
+METRIC_DISPLAY = [
+    ('Battery Voltage', 'V', 'Battery Voltage (V)'),
+    ('Engine Load', '%', 'Engine Load (%)'),
+    ('RPM', 'RPM', 'RPM'),
+    ('Coolant Temp', '°C', 'Coolant Temp (°C)'),
+    ('Throttle Position', '%', 'Throttle Position (%)'),
+    ('Fuel Level', '%', 'Fuel Level (%)'),
+    ('Intake Pressure', 'kPa', 'Intake Pressure (kPa)'),
+    ('MAF Rate', 'g/s', 'MAF Rate (g/s)')
+]
+CHART_COLUMNS = [label for _, _, label in METRIC_DISPLAY]
+
+# Animation shown above the chart once the vehicle sends data
+CAR_GIF = 'engine-miata-engine.gif'
+
+# Chart range choices, as a look-back in milliseconds (None = the live window of
+# the last CHART_WINDOW samples). Longer ranges are read from the rollup tables
+# and downsampled to the chart's point budget (--chart-points).
+CHART_RANGES = {
+    "Live": None,
+    "Last hour": 60 * 60 * 1000,
+    "Last 24 hours": 24 * 60 * 60 * 1000,
+    "Last 30 days": 30 * 24 * 60 * 60 * 1000
+}
+
+# Size in pixels of each metric's panel in the dashboard chart
+CHART_PANEL_WIDTH = 280
+CHART_PANEL_HEIGHT = 140
+
+# Vega-Lite spec of the dashboard chart: one panel per metric, two per row, on a
+# shared time axis and each with a y scale of its own. Every metric is sent to the
+# browser in one table: a Time column and a float32 column per metric.
+METRICS_CHART_SPEC = {
+    'repeat': CHART_COLUMNS,
+    'columns': 2,
+    'spec': {
+        'width': CHART_PANEL_WIDTH,
+        'height': CHART_PANEL_HEIGHT,
+        'mark': 'line',
+        'encoding': {
+            'x': {'field': 'Time', 'type': 'temporal', 'title': None},
+            'y': {'field': {'repeat': 'repeat'}, 'type': 'quantitative', 'scale': {'zero': False}},
+        },
+    },
+    'resolve': {'scale': {'x': 'shared', 'y': 'independent'}},
+    # Composed charts cannot be fitted to the page, they take the size of their panels
+    'autosize': {'type': 'pad'},
+}
+
+# Function to format a metric value for display. Binary frames carry float32
+# values, shown to the 7 significant digits they hold (13.2, not 13.199999809265137).
+def format_value(value):
+    return 'None' if value is None else f'{value:.7g}'
+
+# Function to turn a history frame (ts and one column per metric) into chart data
+def history_to_chart_data(history):
+    data = history[METRIC_COLUMNS].astype(np.float32)
+    data.columns = CHART_COLUMNS
+    data.insert(0, 'Time', [ms_to_datetime(ts) for ts in history['ts']])
+    return data
+
+# Function to turn (id, ts, *metrics) rows into chart data
+def rows_to_chart_data(rows):
+    return history_to_chart_data(pd.DataFrame([row[1:] for row in rows], columns=['ts'] + METRIC_COLUMNS))
+
+# Function to draw the chart into its placeholder. Returns the chart, which takes add_rows.
+def draw_chart(chart, data):
+    return chart.vega_lite_chart(data, METRICS_CHART_SPEC)
 
 # Streamlit login function using st.form
 def login():
@@ -58,34 +118,224 @@ def login():
                 st.error("Invalid username or password")
 # Function to retrieve the most recent timestamp in the obd_data table
 def get_most_recent_timestamp(user_id):
-    conn = sqlite3.connect('obd_data.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT timestamp FROM obd_data 
-        WHERE user_id = ? 
-        ORDER BY id DESC 
-        LIMIT 1
-    ''', (user_id,))
-    result = cursor.fetchone()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT ts FROM obd_data 
+            WHERE user_id = ? 
+            ORDER BY ts DESC 
+            LIMIT 1
+        ''', (user_id,))
+        result = cursor.fetchone()
     if result:
-        return datetime.strptime(result[0], '%Y-%m-%d %H:%M:%S')
+        return ms_to_datetime(result[0])
     return None
 
-# Function to get all out-of-norm logs and join with norm ranges
-def get_out_of_norm_logs():
-    conn = sqlite3.connect('obd_data.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT logs.id, logs.metric_name, logs.value, logs.timestamp, 
-               ranges.min_value, ranges.max_value
-        FROM out_of_norm_logs logs
-        JOIN norm_ranges ranges ON logs.metric_name = ranges.metric_name
-        ORDER BY logs.timestamp DESC
-    ''')
-    logs = cursor.fetchall()
-    conn.close()
-    return logs
+# Time range choices of the log view, as a look-back in milliseconds (None = all time)
+LOG_TIME_RANGES = {
+    "All time": None,
+    "Last hour": 60 * 60 * 1000,
+    "Last 24 hours": 24 * 60 * 60 * 1000,
+    "Last 7 days": 7 * 24 * 60 * 60 * 1000
+}
+
+LOG_COLUMNS = ['Log ID', 'Metric Name', 'Value', 'Timestamp', 'Min Value', 'Max Value']
+
+# Function to show the filter and paging controls of the log view. Returns
+# (metric_name, look_back, before_id); before_id is None on the live first page.
+def out_of_norm_log_controls():
+    metric_column, range_column, newer_column, older_column = st.columns([3, 3, 1, 1])
+    metric = metric_column.selectbox("Metric", ["All metrics"] + METRIC_COLUMNS)
+    time_range = range_column.selectbox("Time range", list(LOG_TIME_RANGES))
+    newer = newer_column.button("Newer")
+    older = older_column.button("Older")
+
+    # Each older page starts below the last id of the page before it; start over
+    # from the live page whenever the filters change
+    filters = (metric, time_range)
+    if st.session_state.get('log_filters') != filters:
+        st.session_state['log_filters'] = filters
+        st.session_state['log_page_starts'] = []
+    page_starts = st.session_state['log_page_starts']
+    if newer and page_starts:
+        page_starts.pop()
+    if older and st.session_state.get('log_page_last_id'):
+        page_starts.append(st.session_state['log_page_last_id'])
+
+    metric_name = None if metric == "All metrics" else metric
+    return metric_name, LOG_TIME_RANGES[time_range], page_starts[-1] if page_starts else None
+
+# Functions to turn messages pushed by the daemon's live feed into the row layouts
+# the dashboard reads from SQLite. Pushed samples have no database id yet (None);
+# out-of-norm events carry the id of their log row.
+def pushed_obd_rows(message):
+    return [(None, *row) for row in message['rows']]
+
+def pushed_out_of_norm_logs(message, metric_name=None, since_ts=None):
+    return [
+        (log_id, name, value, ms_to_datetime(ts).strftime(TIMESTAMP_FORMAT), min_value, max_value)
+        for log_id, name, value, ts, min_value, max_value in message['events']
+        if metric_name in (None, name) and (since_ts is None or ts >= since_ts)
+    ]
+
+# Seconds between refreshes of each part of the dashboard. Every part is a fragment
+# that reruns on its own and only sends something to the browser when its data
+# changed; the rest of the page stays as it is. The intervals match the TTLs of the
+# cached queries they read.
+LIVE_REFRESH_INTERVAL = LIVE_TTL
+LOG_REFRESH_INTERVAL = LOG_TTL
+HISTORY_REFRESH_INTERVAL = HISTORY_TTL
+
+# Refreshes of every session are sampled while --profile is on
+profiler = get_profiler('dashboard')
+
+# State of one session's dashboard, rebuilt on every full rerun together with the
+# placeholders the fragments draw into
+class DashboardView:
+    def __init__(self, user_id, car_gif, displays, chart, look_back, logs_placeholder, metric_name, log_look_back):
+        self.user_id = user_id
+        self.car_gif = car_gif
+        self.gif_shown = False
+
+        # Last entry displays and the chart. Long ranges are drawn from the rollups;
+        # only the live range follows each new sample.
+        self.live = FeedReader(user_id)
+        self.displays = displays
+        self.chart = chart
+        self.look_back = look_back
+        self.history_version = None
+        # Ring buffer of the last CHART_WINDOW samples
+        self.window = deque(maxlen=CHART_WINDOW)
+        self.last_id = 0
+        self.backfilled_rows = set()
+        self.rows_since_redraw = CHART_WINDOW
+
+        # Live first page of out-of-norm logs, kept as a bounded window that later
+        # updates extend with newly logged rows. The start of its time range moves
+        # on with every refresh.
+        self.log_feed = FeedReader(user_id)
+        self.logs_placeholder = logs_placeholder
+        self.metric_name = metric_name
+        self.log_look_back = log_look_back
+        self.since_ts = None
+        self.logs = deque(maxlen=LOG_PAGE_SIZE)
+        self.last_log_id = 0
+
+# Fragment that shows the latest samples. Pushed frames come from the vehicle's
+# shared live feed; the database is read to backfill whenever the source of
+# updates changes, since pushed rows carry no id, and polled while the daemon is
+# unreachable.
+@st.fragment(run_every=LIVE_REFRESH_INTERVAL)
+@profiler.profiled('refresh_live_data')
+def refresh_live_data():
+    view = st.session_state['dashboard']
+    messages, backfill = view.live.read()
+    if backfill:
+        # Fill the window with the latest records
+        view.window.clear()
+        new_rows = latest_obd_data(view.user_id)
+        view.last_id = new_rows[-1][0] if new_rows else 0
+        view.backfilled_rows = {row[1:] for row in new_rows}
+        view.rows_since_redraw = CHART_WINDOW
+    elif messages is None:
+        # Keep only the rows stored since the last refresh
+        new_rows = [row for row in latest_obd_data(view.user_id) if row[0] > view.last_id]
+        if new_rows:
+            view.last_id = new_rows[-1][0]
+    else:
+        # Pushed frames, dropping the few that the backfill already read from the database
+        new_rows = [row for message in messages if message['type'] == 'samples'
+                    for row in pushed_obd_rows(message) if row[1:] not in view.backfilled_rows]
+    if not new_rows:
+        return
+    view.window.extend(new_rows)
+
+    # Check if the last entry's timestamp is within the last 2 seconds
+    last_timestamp = ms_to_datetime(view.window[-1][1])
+    current_time = datetime.now()
+
+    # Update the last entry display for each parameter
+    last_entry = view.window[-1][2:]
+    for display, (name, unit, _), value in zip(view.displays, METRIC_DISPLAY, last_entry):
+        display.markdown(f"**{name} (Last Entry):** {format_value(value)} {unit}")
+
+    # add_rows only sends the new points, but the chart keeps everything it is
+    # given, so redraw it from the ring buffer once per window. The browser then
+    # never holds more than 2 * CHART_WINDOW points per metric.
+    if view.look_back is None:
+        view.rows_since_redraw += len(new_rows)
+        if view.rows_since_redraw >= CHART_WINDOW:
+            view.chart = draw_chart(view.chart, rows_to_chart_data(view.window))
+            view.rows_since_redraw = 0
+        else:
+            view.chart.add_rows(rows_to_chart_data(new_rows))
+
+    # Check if the last data entry is within the past 2 seconds
+    # if current_time - timedelta(seconds=2) <= last_timestamp:
+    # The GIF is sent to the browser once, when the first data arrives, after the
+    # data itself so a missing image never holds the displays back
+    if not view.gif_shown:
+        car_gif = static_asset(CAR_GIF)
+        if car_gif is not None:
+            view.car_gif.image(car_gif, use_column_width=True)
+        view.gif_shown = True
+    # else:
+    #     car_gif.image('engine-miata-engine-stopped.tiff', use_column_width=True)
+
+# Fragment that redraws the chart of a long range when its rollups change
+@st.fragment(run_every=HISTORY_REFRESH_INTERVAL)
+@profiler.profiled('refresh_history_chart')
+def refresh_history_chart():
+    view = st.session_state['dashboard']
+    history = metric_history(view.user_id, view.look_back)
+    version = history['ts'].iloc[-1] if len(history) else None
+    if version is not None and version == view.history_version:
+        return
+    view.history_version = version
+    draw_chart(view.chart, history_to_chart_data(history))
+
+# Fragment that keeps the live first page of out-of-norm logs up to date
+@st.fragment(run_every=LOG_REFRESH_INTERVAL)
+@profiler.profiled('refresh_out_of_norm_logs')
+def refresh_out_of_norm_logs():
+    view = st.session_state['dashboard']
+    messages, backfill = view.log_feed.read()
+
+    # Read the page from the database when the source of updates changed or the
+    # time range moved on; window_start only moves once per WINDOW_STEP_MS
+    since_ts = window_start(view.log_look_back)
+    reloaded = backfill or since_ts != view.since_ts
+    if reloaded:
+        logs = out_of_norm_logs(view.user_id, view.metric_name, since_ts)
+        # Rows pushed before the writer committed them are not in the database yet
+        stored_id = logs[0][0] if logs else 0
+        unstored = [log for log in view.logs if log[0] > stored_id]
+        view.since_ts = since_ts
+        view.logs = deque(unstored + logs, maxlen=LOG_PAGE_SIZE)
+        view.last_log_id = view.logs[0][0] if view.logs else 0
+
+    if messages is None:
+        # Fetch only the out-of-norm logs stored since the last refresh
+        new_logs = [] if backfill else out_of_norm_logs(view.user_id, view.metric_name, since_ts,
+                                                        after_id=view.last_log_id)
+    else:
+        # Pushed events, dropping the ones the database already returned
+        new_logs = [log for message in messages if message['type'] == 'out_of_norm'
+                    for log in pushed_out_of_norm_logs(message, view.metric_name, since_ts)
+                    if log[0] > view.last_log_id]
+        new_logs.reverse()
+    if new_logs:
+        view.last_log_id = new_logs[0][0]
+        view.logs.extendleft(reversed(new_logs))
+    elif not reloaded:
+        return
+
+    # New rows push the oldest ones out of the page, so "Older" continues below
+    # the last row shown now
+    st.session_state['log_page_last_id'] = view.logs[-1][0] if view.logs else None
+
+    # Display the logs as a sortable dataframe
+    view.logs_placeholder.dataframe(pd.DataFrame(list(view.logs), columns=LOG_COLUMNS))
 
 # Function to visualize data in Streamlit
 def visualize_obd_data():
@@ -96,122 +346,43 @@ def visualize_obd_data():
 
     # Create placeholder for the logs table
     st.subheader("Out-of-Norm Events Log")
+    metric_name, log_look_back, before_id = out_of_norm_log_controls()
     out_of_norm_logs_placeholder = st.empty()
 
-    # Fetch out-of-norm logs
-    logs = get_out_of_norm_logs()
+    user_id = st.session_state['user_id']
 
-    if logs:
-        # Convert logs to a DataFrame for better visualization and sorting
-        df_logs = pd.DataFrame(logs, columns=[
-            'Log ID', 'Metric Name', 'Value', 'Timestamp', 'Min Value', 'Max Value'
-        ])
-        
-        # Display the logs as a sortable dataframe
-        out_of_norm_logs_placeholder.dataframe(df_logs)
+    # Create placeholders for the last entry displays and the chart of every metric
+    chart_range = st.selectbox("Chart range", list(CHART_RANGES))
+    columns = st.columns(3) + st.columns(3) + st.columns(2)
+    displays = [column.empty() for column in columns]
+    chart = st.empty()
+    look_back = CHART_RANGES[chart_range]
 
-    user_id = st.session_state['user_id']
+    st.session_state['dashboard'] = DashboardView(user_id, car_gif, displays, chart, look_back,
+                                                  out_of_norm_logs_placeholder, metric_name, log_look_back)
 
-    # Create placeholders for the charts
-    col1, col2, col3 = st.columns(3)
-    battery_voltage_display = col1.empty()
-    engine_load_display = col2.empty()
-    rpm_display = col3.empty()
-
-    # Additional columns for the new parameters
-    col4, col5, col6 = st.columns(3)
-    coolant_temp_display = col4.empty()
-    throttle_position_display = col5.empty()
-    fuel_level_display = col6.empty()
-
-    col7, col8 = st.columns(2)
-    intake_pressure_display = col7.empty()
-    maf_rate_display = col8.empty()
-
-    # Create placeholders for line charts
-    battery_voltage_chart = col1.line_chart([])
-    engine_load_chart = col2.line_chart([])
-    rpm_chart = col3.line_chart([])
-
-    coolant_temp_chart = col4.line_chart([])
-    throttle_position_chart = col5.line_chart([])
-    fuel_level_chart = col6.line_chart([])
-
-    intake_pressure_chart = col7.line_chart([])
-    maf_rate_chart = col8.line_chart([])
-
-    while True:
-        # Fetch the latest 20 records
-        data = get_latest_obd_data(user_id)
-        
-        if data:
-            (timestamps, battery_voltage, engine_load, rpm, 
-             coolant_temp, throttle_position, fuel_level, 
-             intake_pressure, maf_rate) = zip(*data)
-
-            # Check if the last entry's timestamp is within the last 2 seconds
-            last_timestamp_str = timestamps[-1]
-            last_timestamp = datetime.strptime(last_timestamp_str, '%Y-%m-%d %H:%M:%S')
-            current_time = datetime.now()
-
-            # Check if the last data entry is within the past 2 seconds
-            # if current_time - timedelta(seconds=2) <= last_timestamp:
-            car_gif.image('engine-miata-engine.gif', use_column_width=True)
-            # else:
-            #     car_gif.image('engine-miata-engine-stopped.tiff', use_column_width=True)
-
-            # Fetch out-of-norm logs
-            logs = get_out_of_norm_logs()
-
-            if logs:
-                # Convert logs to a DataFrame for better visualization and sorting
-                df_logs = pd.DataFrame(logs, columns=[
-                    'Log ID', 'Metric Name', 'Value', 'Timestamp', 'Min Value', 'Max Value'
-                ])
-        
-            # Display the logs as a sortable dataframe
-            out_of_norm_logs_placeholder.dataframe(df_logs)
-                
-            # Update the last entry display for each parameter
-            battery_voltage_display.markdown(f"**Battery Voltage (Last Entry):** {battery_voltage[-1]} V")
-            engine_load_display.markdown(f"**Engine Load (Last Entry):** {engine_load[-1]} %")
-            rpm_display.markdown(f"**RPM (Last Entry):** {rpm[-1]} RPM")
-
-            coolant_temp_display.markdown(f"**Coolant Temp (Last Entry):** {coolant_temp[-1]} °C")
-            throttle_position_display.markdown(f"**Throttle Position (Last Entry):** {throttle_position[-1]} %")
-            fuel_level_display.markdown(f"**Fuel Level (Last Entry):** {fuel_level[-1]} %")
-
-            intake_pressure_display.markdown(f"**Intake Pressure (Last Entry):** {intake_pressure[-1]} kPa")
-            maf_rate_display.markdown(f"**MAF Rate (Last Entry):** {maf_rate[-1]} g/s")
-
-            # Prepare data for plotting as a DataFrame
-            chart_data = pd.DataFrame({
-                'Battery Voltage (V)': battery_voltage,
-                'Engine Load (%)': engine_load,
-                'RPM': rpm,
-                'Coolant Temp (°C)': coolant_temp,
-                'Throttle Position (%)': throttle_position,
-                'Fuel Level (%)': fuel_level,
-                'Intake Pressure (kPa)': intake_pressure,
-                'MAF Rate (g/s)': maf_rate
-            }, index=timestamps)
-
-            # Update the line charts with horizontal (time-based) data
-            battery_voltage_chart.line_chart(chart_data[['Battery Voltage (V)']])
-            engine_load_chart.line_chart(chart_data[['Engine Load (%)']])
-            rpm_chart.line_chart(chart_data[['RPM']])
-
-            coolant_temp_chart.line_chart(chart_data[['Coolant Temp (°C)']])
-            throttle_position_chart.line_chart(chart_data[['Throttle Position (%)']])
-            fuel_level_chart.line_chart(chart_data[['Fuel Level (%)']])
-
-            intake_pressure_chart.line_chart(chart_data[['Intake Pressure (kPa)']])
-            maf_rate_chart.line_chart(chart_data[['MAF Rate (g/s)']])
-
-        time.sleep(1)  # Refresh every second
+    # Only the first page of logs is live; older pages are drawn once
+    if before_id is None:
+        refresh_out_of_norm_logs()
+    else:
+        logs = out_of_norm_logs(user_id, metric_name, window_start(log_look_back), before_id=before_id)
+        st.session_state['log_page_last_id'] = logs[-1][0] if logs else None
+        out_of_norm_logs_placeholder.dataframe(pd.DataFrame(logs, columns=LOG_COLUMNS))
+
+    if look_back is not None:
+        refresh_history_chart()
+    refresh_live_data()
 
 # Main app function
 def main():
+    # Options come after `--`: streamlit run car_digital_twin_streamlit_app.py -- --db-path ...
+    config = apply_config(parse_args("OBD-II dashboard of one vehicle."))
+    if config.profile:
+        get_profiler('dashboard').start()
+
+    # Create or migrate the database schema, once per process
+    open_database(config.db_path)
+
     # if 'logged_in' not in st.session_state:
     st.session_state['logged_in'] = True
     st.session_state['user_id'] = authenticate_user("", "")
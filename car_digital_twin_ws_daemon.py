@@ -1,210 +1,498 @@
 import asyncio
 import websockets
 import json
+import signal
 import sqlite3
-import bcrypt
-
-# Initialize SQLite Database
-def init_db():
-    conn = sqlite3.connect('obd_data.db')
-    cursor = conn.cursor()
-
-    # Create table for user authentication
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE,
-            password TEXT
-        )
-    ''')
-
-    # Create table for storing OBD-II data with more parameters
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS obd_data (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            timestamp TEXT,
-            battery_voltage REAL,
-            engine_load REAL,
-            rpm REAL,
-            coolant_temp REAL,
-            throttle_position REAL,
-            fuel_level REAL,
-            intake_pressure REAL,
-            maf_rate REAL,
-            FOREIGN KEY(user_id) REFERENCES users(id)
-        )
-    ''')
-
-    # Create table for norm ranges
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS norm_ranges (
-            metric_name TEXT PRIMARY KEY,
-            min_value REAL,
-            max_value REAL
-        )
-    ''')
-
-    # Create table for logging out-of-norm events
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS out_of_norm_logs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            metric_name TEXT,
-            value REAL,
-            timestamp TEXT,
-            FOREIGN KEY(user_id) REFERENCES users(id)
-        )
-    ''')
-
-    conn.commit()
-
-    # Create default admin account if not exists
-    cursor.execute('''
-        SELECT * FROM users WHERE username = ?
-    ''', ('admin',))
-    if cursor.fetchone() is None:
-        hashed_password = bcrypt.hashpw('boogy332!'.encode('utf-8'), bcrypt.gensalt())
-        cursor.execute('''
-            INSERT INTO users (username, password)
-            VALUES (?, ?)
-        ''', ('admin', hashed_password))
-        conn.commit()
-        print("Admin account created with default credentials: username: admin, password: boogy332!")
-
-    # Insert default norm ranges if not exists
-    default_ranges = {
-        'battery_voltage': (12.5, 14.8),
-        'engine_load': (0, 100),
-        'rpm': (700, 6000),
-        'coolant_temp': (70, 120),
-        'throttle_position': (0, 100),
-        'fuel_level': (0, 100),
-        'intake_pressure': (20, 100),
-        'maf_rate': (0, 200)
-    }
-
-    for metric, (min_val, max_val) in default_ranges.items():
-        cursor.execute('''
-            INSERT OR IGNORE INTO norm_ranges (metric_name, min_value, max_value)
-            VALUES (?, ?, ?)
-        ''', (metric, min_val, max_val))
+import time
+import numpy as np
+from obd_storage import METRIC_COLUMNS, TABLE_VERSION_POLL_INTERVAL, connection, init_db, close_all
+from obd_archive import RETENTION_CHUNK_ROWS, RETENTION_INTERVAL, archive_chunk
+from obd_async_db import AsyncDb
+from obd_batch_writer import BatchWriter, replay_spill
+from obd_config import DEFAULT_HOST, DEFAULT_PORT, apply_config, parse_args
+from obd_detection import DetectionEngine
+from obd_hot_store import HotStoreWriter
+from obd_metrics import (ANOMALIES, CONNECTED_CLIENTS, FRAME_ERRORS, FRAMES, LIVE_SUBSCRIBERS, METRICS_PORT,
+                         OUT_OF_NORM_EVENTS, SAMPLES, STAGE_SECONDS, STATS_REPORT_INTERVAL, USER_CACHE_HITS,
+                         USER_CACHE_MISSES, WRITER_QUEUE_DEPTH, LoopLagMonitor, start_metrics_server)
+from obd_norm_ranges import NormRangeCache
+from obd_profiling import StackSampler
+from obd_pubsub import PubSubHub, SUBSCRIBE_PATH, parse_subscription
+from obd_rollups import ROLLUP_CHUNK_ROWS, ROLLUP_INTERVAL, compact
+from obd_user_cache import UserCache
+from obd_vehicle_stats import STATS_CHECKPOINT, STATS_CHECKPOINT_INTERVAL, VehicleStats, save_checkpoint
+from obd_wire import SUBPROTOCOLS, FrameError, decode_frame
+
+# Address the daemon accepts vehicles and dashboards on (--host/--port)
+HOST = DEFAULT_HOST
+PORT = DEFAULT_PORT
+
+# Port of the Prometheus /metrics endpoint on HOST (--metrics-port, 0 = off)
+metrics_port = METRICS_PORT
+
+# The /metrics server while it runs
+metrics_server = None
+
+# Timers of the frame path stages, resolved once rather than per frame
+DECODE_SECONDS, VALIDATE_SECONDS, DETECT_SECONDS, STORE_SECONDS, ALERT_SECONDS = (
+    STAGE_SECONDS.labels(stage) for stage in ('decode', 'validate', 'detect', 'store', 'alert')
+)
+JSON_FRAMES, BINARY_FRAMES = FRAMES.labels('json'), FRAMES.labels('binary')
+DECODE_ERRORS, INVALID_USER_ERRORS = FRAME_ERRORS.labels('decode'), FRAME_ERRORS.labels('invalid_user')
+
+# Database thread that runs every blocking sqlite3 call for the daemon
+db = None
+
+# Background group-commit writer shared by every connection
+writer = None
+
+# In-memory norm ranges used for out-of-norm checks
+norm_ranges = NormRangeCache()
+
+# Per-vehicle excursion tracking on top of the norm ranges
+detector = DetectionEngine(norm_ranges)
+
+# Rolling per-vehicle statistics (EWMA baselines and percentile histograms)
+vehicle_stats = VehicleStats()
+
+# File the rolling statistics are checkpointed to
+stats_checkpoint = STATS_CHECKPOINT
+
+# Cache of user_exists answers so frames skip the users lookup
+user_cache = UserCache()
+
+# Event loop lag probe
+loop_lag = None
+
+# Memory-mapped columns of each vehicle's recent samples, for fast dashboard reads
+hot_store = HotStoreWriter()
+
+# Live feed of accepted frames and out-of-norm events for subscribed dashboards
+pubsub = PubSubHub()
+
+# Stack sampler of the frame path, started by --profile and toggled with SIGUSR2
+profiler = StackSampler('daemon')
 
-    conn.commit()
-    conn.close()
+# Open vehicle connections, each with the loop time it last finished a frame, or
+# None while it handles one; a draining process closes the quiet ones
+ingest_connections = {}
+
+# Seconds a vehicle has to stay quiet, with no frame handled or queued, before a
+# draining process closes its connection; by then every frame it sent is answered
+DRAIN_QUIET_TIME = 0.25
 
 # Function to check if user exists
 def user_exists(user_id):
-    conn = sqlite3.connect('obd_data.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT id FROM users WHERE id = ?
-    ''', (user_id,))
-    user = cursor.fetchone()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id FROM users WHERE id = ?
+        ''', (user_id,))
+        user = cursor.fetchone()
     return user is not None
 
-# Function to store OBD-II data in SQLite
-def store_data_in_db(user_id, data):
-    conn = sqlite3.connect('obd_data.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO obd_data (
-            user_id, timestamp, battery_voltage, engine_load, rpm,
-            coolant_temp, throttle_position, fuel_level, intake_pressure, maf_rate
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (
-        user_id,
-        data.get('timestamp'),
-        data.get('battery_voltage'),
-        data.get('engine_load'),
-        data.get('rpm'),
-        data.get('coolant_temp'),
-        data.get('throttle_position'),
-        data.get('fuel_level'),
-        data.get('intake_pressure'),
-        data.get('maf_rate')
-    ))
-    conn.commit()
-    conn.close()
-
-# Function to get the normal range for a metric
-def get_norm_range(metric_name):
-    conn = sqlite3.connect('obd_data.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT min_value, max_value FROM norm_ranges WHERE metric_name = ?
-    ''', (metric_name,))
-    result = cursor.fetchone()
-    conn.close()
-    return result
-
-# Function to log out-of-norm events
-def log_out_of_norm(user_id, metric_name, value, timestamp):
-    conn = sqlite3.connect('obd_data.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO out_of_norm_logs (user_id, metric_name, value, timestamp)
-        VALUES (?, ?, ?, ?)
-    ''', (user_id, metric_name, value, timestamp))
-    conn.commit()
-    conn.close()
+# Function to queue a frame of OBD-II samples (rows aligned with METRIC_COLUMNS),
+# their out-of-norm events and anomalies for the batched SQLite writer, as one
+# transaction. SQLite numbers the out-of-norm log rows; on_commit gets their ids,
+# in np.nonzero order, once the frame is committed (see BatchWriter.put_many).
+async def store_data_in_db(user_id, timestamps, samples, out_of_norm, anomalies=(), on_commit=None):
+    rows = []
+    for ts, values in zip(timestamps.tolist(), samples.tolist()):
+        rows.append(('''
+            INSERT INTO obd_data (
+                user_id, ts, battery_voltage, engine_load, rpm,
+                coolant_temp, throttle_position, fuel_level, intake_pressure, maf_rate
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (user_id, ts, *[None if value != value else value for value in values])))
+
+    # Log out-of-norm events in the database
+    for sample_index, metric_index in zip(*np.nonzero(out_of_norm)):
+        rows.append(('''
+            INSERT INTO out_of_norm_logs (user_id, metric_name, value, ts)
+            VALUES (?, ?, ?, ?) RETURNING id
+        ''', (user_id, METRIC_COLUMNS[metric_index], float(samples[sample_index, metric_index]),
+              int(timestamps[sample_index]))))
+
+    # Log statistical anomalies in the database
+    for metric_name, value, ts, kind, score in anomalies:
+        rows.append(('''
+            INSERT INTO anomaly_logs (user_id, metric_name, value, ts, kind, score)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (user_id, metric_name, value, ts, kind, score)))
+
+    await writer.put_many(rows, on_commit)
+
+# Function to persist and fan out a checked frame: queue it for SQLite, append it
+# to the hot store and push it to live subscribers
+async def record_frame(user_id, timestamps, samples, out_of_norm, anomalies):
+    # Out-of-norm events are pushed once committed, with the ids of their log rows;
+    # those of a spilled frame are never pushed, as the dashboard cannot page to them
+    def publish_out_of_norm(log_ids):
+        if log_ids is not None and pubsub.has_subscribers(user_id):
+            pubsub.publish_out_of_norm(user_id, out_of_norm_events(timestamps, samples, out_of_norm, log_ids))
+
+    await store_data_in_db(user_id, timestamps, samples, out_of_norm, anomalies,
+                           publish_out_of_norm if out_of_norm.any() else None)
+    hot_store.append(user_id, timestamps, samples)
+
+    # Push the frame to subscribed dashboards; the database only serves history
+    pubsub.publish_samples(user_id, timestamps, samples)
+    pubsub.publish_anomalies(user_id, anomalies)
+
+# Function to check a user_id against the cache, falling back to the database
+async def is_valid_user(user_id):
+    valid_user = user_cache.get(user_id)
+    if valid_user is None:
+        valid_user = await db.run(user_exists, user_id)
+        user_cache.put(user_id, valid_user)
+    return valid_user
+
+# Function to list out-of-norm events as [id, metric_name, value, ts, min, max] for
+# subscribers, given the ids of their log rows
+def out_of_norm_events(timestamps, samples, out_of_norm, log_ids):
+    events = []
+    for log_id, (sample_index, metric_index) in zip(log_ids, zip(*np.nonzero(out_of_norm))):
+        metric_name = METRIC_COLUMNS[metric_index]
+        min_value, max_value = norm_ranges.get_norm_range(metric_name) or (None, None)
+        events.append([
+            log_id, metric_name, float(samples[sample_index, metric_index]), int(timestamps[sample_index]),
+            None if min_value == -np.inf else min_value, None if max_value == np.inf else max_value
+        ])
+    return events
+
+# Subscription handler: pushes one vehicle's live data to a dashboard until it disconnects
+async def subscribe_websocket(websocket, path):
+    user_id = parse_subscription(path)
+    if user_id is None or not await is_valid_user(user_id):
+        await websocket.close(code=1008, reason="Invalid user_id")
+        return
+
+    pubsub.subscribe(user_id, websocket)
+    try:
+        # Subscribers only listen; anything they send is ignored
+        async for _ in websocket:
+            pass
+    except websockets.ConnectionClosed:
+        pass
+    finally:
+        pubsub.unsubscribe(user_id, websocket)
 
 # WebSocket handler
 async def obd_websocket(websocket, path):
+    if path.startswith(SUBSCRIBE_PATH):
+        await subscribe_websocket(websocket, path)
+        return
+
+    CONNECTED_CLIENTS.inc()
+    try:
+        await ingest_frames(websocket)
+    finally:
+        CONNECTED_CLIENTS.dec()
+
+# Function to count the out-of-norm events and anomalies of a frame per metric
+def count_alerts(out_of_norm, anomalies):
+    if out_of_norm.any():
+        counts = out_of_norm.sum(axis=0)
+        for index in np.flatnonzero(counts):
+            OUT_OF_NORM_EVENTS.labels(METRIC_COLUMNS[index]).inc(int(counts[index]))
+    for metric_name, _, _, kind, _ in anomalies:
+        ANOMALIES.labels(metric_name, kind).inc()
+
+# Function to run the stateful checks of a frame: detection against the norm ranges
+# and rules, where only the sample that confirms an excursion is flagged, and the
+# vehicle's rolling statistics. Returns the out-of-norm mask and the anomalies as
+# (metric_name, value, ts, kind, score) tuples.
+def check_frame(user_id, timestamps, samples):
+    start = time.perf_counter()
+    out_of_norm = detector.detect(user_id, timestamps, samples)
+    anomalies = [
+        (METRIC_COLUMNS[metric_index], float(samples[sample_index, metric_index]),
+         int(timestamps[sample_index]), kind, score)
+        for sample_index, metric_index, kind, score in vehicle_stats.update(user_id, timestamps, samples)
+    ]
+    count_alerts(out_of_norm, anomalies)
+    DETECT_SECONDS.observe(time.perf_counter() - start)
+    return out_of_norm, anomalies
+
+# Function to list the warning messages a vehicle gets for a checked frame
+def frame_warnings(samples, out_of_norm, anomalies):
+    warnings = []
+
+    # Send alert if any metrics are out of norm
+    if out_of_norm.any():
+        warning_message = {
+            "warning": "Out of norm metrics detected",
+            "metrics": [METRIC_COLUMNS[index] for index in np.flatnonzero(out_of_norm.any(axis=0))]
+        }
+        if len(samples) > 1:
+            warning_message["samples"] = np.flatnonzero(out_of_norm.any(axis=1)).tolist()
+        warnings.append(json.dumps(warning_message))
+
+    # Send alert if any metric departs from the vehicle's own baseline
+    if anomalies:
+        warnings.append(json.dumps({
+            "warning": "Anomalous metrics detected",
+            "anomalies": [
+                {"metric": metric_name, "kind": kind, "score": round(score, 2)}
+                for metric_name, _, _, kind, score in anomalies
+            ]
+        }))
+    return warnings
+
+# Function to check, store and push a validated frame and warn its vehicle
+async def check_and_record(websocket, user_id, timestamps, samples):
+    out_of_norm, anomalies = check_frame(user_id, timestamps, samples)
+    start = time.perf_counter()
+    await record_frame(user_id, timestamps, samples, out_of_norm, anomalies)
+    stored = time.perf_counter()
+    STORE_SECONDS.observe(stored - start)
+    for warning in frame_warnings(samples, out_of_norm, anomalies):
+        await websocket.send(warning)
+    ALERT_SECONDS.observe(time.perf_counter() - stored)
+
+# Where obd_websocket hands validated frames: check_and_record in a single process,
+# or the aggregator queue in a sharded worker, as the aggregator runs the stateful
+# checks of every vehicle (see obd_sharding)
+frame_sink = check_and_record
+
+# Check, store and answer one frame of a vehicle connection
+async def handle_frame(websocket, message):
+    start = time.perf_counter()
+
+    # Decode JSON text frames or negotiated binary frames
+    try:
+        user_id, timestamps, samples, ack = decode_frame(message)
+    except FrameError as e:
+        DECODE_ERRORS.inc()
+        await websocket.send(json.dumps({"error": str(e)}))
+        return
+    decoded = time.perf_counter()
+    DECODE_SECONDS.observe(decoded - start)
+
+    # Check if the user_id is valid
+    if not await is_valid_user(user_id):
+        INVALID_USER_ERRORS.inc()
+        await websocket.send(json.dumps({"error": "Invalid user_id"}))
+        return
+    VALIDATE_SECONDS.observe(time.perf_counter() - decoded)
+    (JSON_FRAMES if isinstance(message, str) else BINARY_FRAMES).inc()
+    SAMPLES.inc(len(samples))
+
+    # Check the frame, store the data, out-of-norm events and anomalies, push them
+    # to live subscribers and warn the vehicle about what the checks found
+    await frame_sink(websocket, user_id, timestamps, samples)
+
+    # Acknowledge the frame if the client asked for it
+    if ack:
+        await websocket.send(json.dumps({"ack": len(samples)}))
+
+# Receive the frames of one vehicle connection until it closes
+async def ingest_frames(websocket):
+    loop = asyncio.get_running_loop()
+    ingest_connections[websocket] = loop.time()
+    try:
+        while True:
+            try:
+                # Receive data from WebSocket client
+                message = await websocket.recv()
+                ingest_connections[websocket] = None
+                with profiler.section('obd_websocket'):
+                    await handle_frame(websocket, message)
+                ingest_connections[websocket] = loop.time()
+            except websockets.ConnectionClosed:
+                print("Client disconnected")
+                break
+    finally:
+        del ingest_connections[websocket]
+
+# Function to close the vehicle connections gracefully once the server stopped
+# accepting. Each one is closed with 1001 (going away) only after it has been
+# quiet for DRAIN_QUIET_TIME, so the frames its vehicle sent get their answers
+# first. The quiet time asked for shrinks towards the deadline, so vehicles that
+# never pause are still closed between two frames. Returns the number of
+# connection handlers still running after `timeout`.
+async def drain_connections(timeout):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    closing = {}
+    while ingest_connections and loop.time() < deadline:
+        now = loop.time()
+        quiet_time = DRAIN_QUIET_TIME * (deadline - now) / timeout
+        for websocket, finished in list(ingest_connections.items()):
+            if (websocket not in closing and finished is not None and not websocket.messages
+                    and now - finished >= quiet_time):
+                closing[websocket] = asyncio.create_task(websocket.close(1001, "Server restarting"))
+        await asyncio.sleep(DRAIN_QUIET_TIME / 5)
+    return len(ingest_connections)
+
+# Background task that reloads cached tables whenever their version counter changes
+async def watch_table_versions():
+    while True:
+        await asyncio.sleep(TABLE_VERSION_POLL_INTERVAL)
+        try:
+            if await db.run(norm_ranges.refresh_if_changed):
+                print(f"Reloaded norm ranges (version {norm_ranges.version})")
+            if await db.run(user_cache.refresh_if_changed):
+                print(f"Users changed, cleared user cache (version {user_cache.version})")
+        except Exception as e:
+            print(f"Failed to refresh cached tables: {e}")
+
+# Background task that folds newly stored rows into the rollup tables. A full
+# chunk means it is behind, so it keeps going (yielding to the loop in between).
+async def compact_rollups():
     while True:
+        await asyncio.sleep(ROLLUP_INTERVAL)
         try:
-            # Receive data from WebSocket client
-            message = await websocket.recv()
-            data = json.loads(message)
-
-            # Check if the user_id is valid
-            if 'user_id' not in data:
-                await websocket.send(json.dumps({"error": "user_id missing in message"}))
-                continue
-
-            user_id = data['user_id']
-            if not user_exists(user_id):
-                await websocket.send(json.dumps({"error": "Invalid user_id"}))
-                continue
-
-            # Store the incoming data in SQLite
-            store_data_in_db(user_id, data)
-
-            # Check if any metrics are out of norm
-            out_of_norm_metrics = []
-            for metric, value in data.items():
-                if metric in ['battery_voltage', 'engine_load', 'rpm', 'coolant_temp',
-                              'throttle_position', 'fuel_level', 'intake_pressure', 'maf_rate']:
-                    norm_range = get_norm_range(metric)
-                    if norm_range:
-                        min_val, max_val = norm_range
-                        if not (min_val <= value <= max_val):
-                            out_of_norm_metrics.append(metric)
-                            # Log out-of-norm event in the database
-                            log_out_of_norm(user_id, metric, value, data.get('timestamp'))
-
-            # Send alert if any metrics are out of norm
-            if out_of_norm_metrics:
-                warning_message = {
-                    "warning": "Out of norm metrics detected",
-                    "metrics": out_of_norm_metrics
-                }
-                await websocket.send(json.dumps(warning_message))
-
-        except websockets.ConnectionClosed:
-            print("Client disconnected")
-            break
+            while await db.run(compact) == ROLLUP_CHUNK_ROWS:
+                await asyncio.sleep(0)
+        except Exception as e:
+            print(f"Failed to update rollups: {e}")
+
+# Background task that moves raw rows past the retention age to the archive, one
+# chunk per transaction, letting queued writes in between chunks
+async def archive_old_rows():
+    while True:
+        try:
+            archived = 0
+            while True:
+                count = await db.run(archive_chunk)
+                archived += count
+                if count < RETENTION_CHUNK_ROWS:
+                    break
+                await asyncio.sleep(0)
+            if archived:
+                print(f"Archived {archived} rows of obd_data")
+        except Exception as e:
+            print(f"Failed to archive old rows: {e}")
+        await asyncio.sleep(RETENTION_INTERVAL)
+
+# Background task that checkpoints the rolling statistics so restarts keep them
+async def checkpoint_vehicle_stats():
+    while True:
+        await asyncio.sleep(STATS_CHECKPOINT_INTERVAL)
+        try:
+            await asyncio.to_thread(save_checkpoint, vehicle_stats.snapshot(), stats_checkpoint)
+        except Exception as e:
+            print(f"Failed to checkpoint vehicle stats: {e}")
+
+# Function to format the periodic stats line
+def format_stats():
+    cache = user_cache.stats()
+    stats = (f"loop lag {loop_lag.format_summary()}; "
+             f"user cache {cache['hits']} hits / {cache['misses']} misses; ")
+    if writer is not None:
+        stats += (f"writer {writer.rows_written} rows in {writer.batches_written} batches, "
+                  f"{writer.rows_spilled} spilled; ")
+    return stats + (f"{detector.events} out-of-norm events, {vehicle_stats.anomalies} anomalies; "
+                    f"{pubsub.subscriber_count()} live subscribers")
+
+# Background task that prints daemon stats
+async def report_stats():
+    while True:
+        await asyncio.sleep(STATS_REPORT_INTERVAL)
+        print(f"Stats: {format_stats()}")
+
+# Function to reload norm ranges immediately (SIGHUP)
+def reload_norm_ranges():
+    asyncio.ensure_future(db.run(norm_ranges.load))
+    print("Reloading norm ranges")
+
+# Function to open the database thread and load the cached tables. Processes that
+# store frames (every process but a sharded ingest worker) also get the writer.
+async def open_daemon(stores_frames=True):
+    global db, writer, loop_lag, metrics_server
+    db = AsyncDb()
+    if stores_frames:
+        # Rows spilled by an earlier run go in before any new ones
+        try:
+            replayed = await db.run(replay_spill)
+            if replayed:
+                print(f"Replayed {replayed} spilled rows")
+        except sqlite3.Error as e:
+            print(f"Failed to replay spilled rows ({e}), keeping them for later")
+        writer = BatchWriter(db).start()
+        WRITER_QUEUE_DEPTH.set_function(writer.queue.qsize)
+    loop_lag = LoopLagMonitor().start()
+    LIVE_SUBSCRIBERS.set_function(pubsub.subscriber_count)
+    USER_CACHE_HITS.set_function(lambda: user_cache.hits)
+    USER_CACHE_MISSES.set_function(lambda: user_cache.misses)
+    # Metrics are optional: a port taken by another process only costs the endpoint
+    if metrics_port:
+        try:
+            metrics_server = await start_metrics_server(HOST, metrics_port)
+            print(f"Metrics on http://{HOST}:{metrics_port}/metrics")
+        except OSError as e:
+            print(f"Failed to serve metrics on port {metrics_port} ({e}), running without them")
+    await db.run(norm_ranges.load)
+    await db.run(user_cache.refresh_if_changed)
+
+# Function to start the background tasks of a process that runs the stateful checks
+# of frames (`checks_frames`) and/or stores them (`stores_frames`)
+def start_background_tasks(checks_frames=True, stores_frames=True):
+    tasks = [watch_table_versions(), report_stats()]
+    if checks_frames:
+        tasks.append(checkpoint_vehicle_stats())
+    if stores_frames:
+        tasks += [compact_rollups(), archive_old_rows()]
+    return [asyncio.create_task(task) for task in tasks]
+
+# Function to stop the background tasks and flush everything still buffered
+async def close_daemon(background_tasks, checks_frames=True):
+    for task in background_tasks:
+        task.cancel()
+    await loop_lag.stop()
+    if metrics_server is not None:
+        metrics_server.close()
+    if writer is not None:
+        await writer.close()
+        hot_store.flush()
+    if checks_frames:
+        save_checkpoint(vehicle_stats.snapshot(), stats_checkpoint)
+    db.close()
+    print(f"Stats: {format_stats()}")
 
 # WebSocket server coroutine
 async def start_websocket_server():
-    async with websockets.serve(obd_websocket, "localhost", 8765):
-        print("WebSocket server started on ws://localhost:8765")
-        await asyncio.Future()  # Run forever
+    await open_daemon()
+    if vehicle_stats.load_checkpoint(stats_checkpoint):
+        print(f"Restored statistics of {len(vehicle_stats.slots)} vehicles")
+    background_tasks = start_background_tasks()
+
+    # Stop on SIGTERM as well as Ctrl+C so queued rows are always flushed
+    loop = asyncio.get_running_loop()
+    stop = loop.create_future()
+    try:
+        loop.add_signal_handler(signal.SIGTERM, stop.set_result, None)
+        loop.add_signal_handler(signal.SIGHUP, reload_norm_ranges)
+        loop.add_signal_handler(signal.SIGUSR2, profiler.toggle)
+    except NotImplementedError:
+        pass
+
+    try:
+        async with websockets.serve(obd_websocket, HOST, PORT, subprotocols=SUBPROTOCOLS):
+            print(f"WebSocket server started on ws://{HOST}:{PORT}")
+            await stop
+    finally:
+        await close_daemon(background_tasks)
 
 if __name__ == "__main__":
+    config = apply_config(parse_args("Receive OBD-II frames from vehicles and store them.", daemon=True))
+    HOST, PORT, metrics_port = config.host, config.port, config.metrics_port
+
     # Initialize SQLite database
     init_db()
 
-    # Run WebSocket server
-    asyncio.run(start_websocket_server())
+    # Run WebSocket server, sharded over several processes if configured
+    try:
+        if config.workers > 1:
+            from obd_sharding import run_sharded
+            run_sharded(config)
+        else:
+            if config.profile:
+                profiler.start()
+            asyncio.run(start_websocket_server())
+    except KeyboardInterrupt:
+        print("WebSocket server stopped.")
+    finally:
+        profiler.stop()
+        close_all()
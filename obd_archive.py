@@ -0,0 +1,164 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from obd_storage import METRIC_COLUMNS, connection, init_db
+
+# Directory holding raw obd_data rows moved out of SQLite, laid out as
+#   obd_archive/user_<user_id>/<YYYY-MM-DD>/<first id>-<last id>.npz
+# with one compressed part per retention chunk. Each part holds the row ids, the
+# epoch ms timestamps and an (n, len(METRIC_COLUMNS)) float64 array of metrics
+# (NaN where the row had NULL). Days are UTC.
+ARCHIVE_DIR = 'obd_archive'
+
+# Raw rows older than this are moved to the archive
+RETENTION_DAYS = 30
+
+# Rows archived and deleted per transaction; the daemon lets the batch writer run
+# between chunks, so ingest never waits on a long delete
+RETENTION_CHUNK_ROWS = 5000
+
+# Seconds between retention passes of the daemon
+RETENTION_INTERVAL = 600
+
+DAY_MS = 24 * 60 * 60 * 1000
+
+# Function to get the directory of one user's archived day
+def archive_day_dir(user_id, day, archive_dir=None):
+    day_name = time.strftime('%Y-%m-%d', time.gmtime(day * DAY_MS // 1000))
+    return os.path.join(archive_dir or ARCHIVE_DIR, f'user_{user_id}', day_name)
+
+# Function to write one part file atomically, so readers never see half a file
+def write_part(path, ids, timestamps, values):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez_compressed(f, id=ids, ts=timestamps, values=values)
+    os.replace(tmp_path, path)
+
+# Move up to `chunk_rows` raw rows older than `retention_days` into the archive and
+# delete them from obd_data (blocking, run it on the DB thread). Only rows already
+# folded into the rollup tables are moved. Files are written before the rows are
+# deleted; if a pass dies in between, the next one rewrites the same rows and
+# readers drop the duplicate ids. Returns the number of rows archived.
+def archive_chunk(db_path=None, archive_dir=None, retention_days=RETENTION_DAYS,
+                  chunk_rows=RETENTION_CHUNK_ROWS):
+    cutoff_ts = int(time.time() * 1000) - retention_days * DAY_MS
+    with connection(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT last_id FROM rollup_state WHERE source = 'obd_data'
+        ''')
+        result = cursor.fetchone()
+        rolled_up_id = result[0] if result else 0
+
+        cursor.execute(f'''
+            SELECT id, user_id, ts, {', '.join(METRIC_COLUMNS)}
+            FROM obd_data
+            WHERE id <= ? AND ts < ?
+            ORDER BY id
+            LIMIT ?
+        ''', (rolled_up_id, cutoff_ts, chunk_rows))
+        rows = cursor.fetchall()
+        if not rows:
+            return 0
+
+        frame = pd.DataFrame(rows, columns=['id', 'user_id', 'ts'] + METRIC_COLUMNS)
+        for (user_id, day), part in frame.groupby(['user_id', frame['ts'] // DAY_MS]):
+            ids = part['id'].to_numpy(dtype=np.int64)
+            path = os.path.join(archive_day_dir(user_id, day, archive_dir), f'{ids[0]}-{ids[-1]}.npz')
+            write_part(path, ids, part['ts'].to_numpy(dtype=np.int64),
+                       part[METRIC_COLUMNS].to_numpy(dtype=np.float64))
+
+        cursor.executemany('''
+            DELETE FROM obd_data WHERE id = ?
+        ''', [(row[0],) for row in rows])
+        conn.commit()
+    return len(rows)
+
+# Function to load every part of one archived day as (ids, timestamps, values)
+def load_archive_day(day_dir):
+    parts = [np.load(os.path.join(day_dir, name))
+             for name in sorted(os.listdir(day_dir)) if name.endswith('.npz')]
+    if not parts:
+        return None
+    return tuple(np.concatenate([part[key] for part in parts]) for key in ('id', 'ts', 'values'))
+
+# Function to turn archived arrays into a frame shaped like an obd_data query
+# (id, ts, *METRIC_COLUMNS), ordered by ts and id, without duplicate ids
+def archive_frame(ids, timestamps, values):
+    frame = pd.DataFrame(values, columns=METRIC_COLUMNS)
+    frame.insert(0, 'ts', timestamps)
+    frame.insert(0, 'id', ids)
+    return frame.drop_duplicates('id').sort_values(['ts', 'id'], ignore_index=True)
+
+# Function to read a user's archived rows with start_ts <= ts < end_ts
+def read_archive(user_id, start_ts, end_ts, archive_dir=None):
+    days = []
+    for day in range(int(start_ts) // DAY_MS, (int(end_ts) - 1) // DAY_MS + 1):
+        day_dir = archive_day_dir(user_id, day, archive_dir)
+        if os.path.isdir(day_dir):
+            loaded = load_archive_day(day_dir)
+            if loaded is not None:
+                days.append(loaded)
+    if not days:
+        return archive_frame(np.empty(0, np.int64), np.empty(0, np.int64),
+                             np.empty((0, len(METRIC_COLUMNS))))
+
+    ids, timestamps, values = (np.concatenate(arrays) for arrays in zip(*days))
+    keep = (timestamps >= start_ts) & (timestamps < end_ts)
+    return archive_frame(ids[keep], timestamps[keep], values[keep])
+
+# Function to read the latest `limit` archived rows of a user with ts < before_ts
+def read_archive_latest(user_id, before_ts, limit, archive_dir=None):
+    user_dir = os.path.join(archive_dir or ARCHIVE_DIR, f'user_{user_id}')
+    if not os.path.isdir(user_dir):
+        return read_archive(user_id, 0, 0, archive_dir)
+
+    frames = []
+    found = 0
+    for day_name in sorted(os.listdir(user_dir), reverse=True):
+        loaded = load_archive_day(os.path.join(user_dir, day_name))
+        if loaded is None:
+            continue
+        frame = archive_frame(*loaded)
+        frame = frame[frame['ts'] < before_ts]
+        frames.append(frame)
+        found += len(frame)
+        if found >= limit:
+            break
+    if not frames:
+        return read_archive(user_id, 0, 0, archive_dir)
+    return pd.concat(frames[::-1], ignore_index=True).tail(limit)
+
+# Function to read a user's raw rows with start_ts <= ts < end_ts from both the
+# database and the archive, as one frame of (id, ts, *METRIC_COLUMNS) ordered by ts
+def read_obd_data(conn, user_id, start_ts, end_ts, archive_dir=None):
+    hot = pd.read_sql_query(f'''
+        SELECT id, ts, {', '.join(METRIC_COLUMNS)}
+        FROM obd_data
+        WHERE user_id = ? AND ts >= ? AND ts < ?
+        ORDER BY ts, id
+    ''', conn, params=(user_id, int(start_ts), int(end_ts)),
+        dtype={metric: np.float64 for metric in METRIC_COLUMNS})
+    cold = read_archive(user_id, start_ts, end_ts, archive_dir)
+    if cold.empty:
+        return hot
+    frame = pd.concat([cold, hot], ignore_index=True)
+    return frame.drop_duplicates('id').sort_values(['ts', 'id'], ignore_index=True)
+
+if __name__ == "__main__":
+    # Archive everything past the retention age in one go
+    # (obd_config imports this module, hence the late import)
+    from obd_config import apply_config, parse_args
+    config = apply_config(parse_args("Archive obd_data rows older than the retention age."))
+    init_db()
+    total = 0
+    while True:
+        archived = archive_chunk(archive_dir=config.archive_dir)
+        total += archived
+        if archived < RETENTION_CHUNK_ROWS:
+            break
+    print(f"Archived {total} rows of obd_data older than {RETENTION_DAYS} days to {config.archive_dir}/")
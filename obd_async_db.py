@@ -0,0 +1,22 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+# Maximum number of database operations queued on the executor at once. Callers
+# beyond this wait on the event loop instead of piling work onto the DB thread.
+DB_MAX_IN_FLIGHT = 64
+
+# Runs blocking sqlite3 calls on one dedicated thread so commits and lock waits
+# never stall the event loop. SQLite allows a single writer anyway, so one thread
+# serializes the work without losing throughput.
+class AsyncDb:
+    def __init__(self, max_in_flight=DB_MAX_IN_FLIGHT):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='obd-db')
+        self._slots = asyncio.Semaphore(max_in_flight)
+
+    # Run fn(*args) on the database thread and await its result
+    async def run(self, fn, *args):
+        async with self._slots:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
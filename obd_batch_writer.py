@@ -0,0 +1,233 @@
+import asyncio
+import json
+import os
+import sqlite3
+import time
+from itertools import groupby
+
+from obd_metrics import DB_BATCH_ROWS, DB_COMMIT_RETRIES, DB_COMMIT_SECONDS, DB_SPILLED_ROWS
+from obd_storage import connection
+
+# Commit as soon as this many rows are buffered
+BATCH_MAX_ROWS = 1000
+
+# ...or once the oldest buffered row has waited this long
+BATCH_MAX_DELAY_MS = 50
+
+# Number of pending frames before producers have to wait for the writer (backpressure)
+QUEUE_MAX_SIZE = 20000
+
+# Seconds before a failed commit is retried, doubled per attempt up to the maximum
+COMMIT_RETRY_DELAY = 0.05
+COMMIT_RETRY_MAX_DELAY = 5
+
+# Attempts a failed commit gets before its batch is spilled, and the fewer it
+# still gets once the writer is stopping
+COMMIT_MAX_ATTEMPTS = 10
+COMMIT_STOP_ATTEMPTS = 5
+
+# Errors worth retrying: the database is locked or busy, or the disk failed or
+# filled up. Any other error (no such table, read-only database, missing column)
+# fails the same way every time.
+TRANSIENT_ERRORS = ('SQLITE_BUSY', 'SQLITE_LOCKED', 'SQLITE_IOERR', 'SQLITE_FULL')
+
+# File that batches the database cannot take are appended to, one JSON
+# [sql, params] row per line, so acknowledged frames are never silently lost
+SPILL_PATH = 'obd_writer_spill.jsonl'
+
+# Sentinel that asks the writer task to flush and exit
+_STOP = object()
+
+# Function to tell whether a failed commit may succeed if retried
+def is_transient(error):
+    return (isinstance(error, sqlite3.OperationalError)
+            and (getattr(error, 'sqlite_errorname', None) or '').startswith(TRANSIENT_ERRORS))
+
+# Function to write the rows of the spill file to the database in one transaction
+# and remove it. Rows the database still refuses (or lines cut short by a crash)
+# are kept in the file; a transient error leaves the whole file for a later replay.
+# Returns the number of rows written.
+def replay_spill(db_path=None, spill_path=None):
+    spill_path = spill_path or SPILL_PATH
+    if not os.path.exists(spill_path):
+        return 0
+    with open(spill_path) as f:
+        lines = [line for line in f if line.strip()]
+
+    rejected = []
+    with connection(db_path) as conn:
+        cursor = conn.cursor()
+        for line in lines:
+            try:
+                sql, params = json.loads(line)
+                cursor.execute(sql, params)
+            except (ValueError, sqlite3.Error) as e:
+                if is_transient(e):
+                    raise
+                rejected.append(line)
+        conn.commit()
+
+    if rejected:
+        with open(spill_path, 'w') as f:
+            f.writelines(line if line.endswith('\n') else line + '\n' for line in rejected)
+        print(f"Kept {len(rejected)} rows the database refused in {spill_path}")
+    else:
+        os.remove(spill_path)
+    return len(lines) - len(rejected)
+
+# Background writer that coalesces inserts from every connection into group commits.
+# Producers enqueue lists of (sql, params) pairs; each list always lands in a single
+# transaction. The writer groups consecutive rows with the same statement into one
+# executemany call and commits the whole batch at once. Commits run on the AsyncDb
+# thread, so the loop keeps serving clients meanwhile. Rows whose statement ends in
+# RETURNING id are run one at a time instead, and the ids SQLite assigned them are
+# handed to the producer's on_commit callback once the batch is committed.
+#
+# Frames are acknowledged once queued, so a batch is never dropped: a commit that
+# fails with a transient error (database locked, disk full or failing) is retried
+# with backoff while the queue fills up and holds back the producers. Batches the
+# database refuses outright, and those still failing after COMMIT_MAX_ATTEMPTS, are
+# appended to the spill file instead; replay_spill loads them once the database
+# takes them again.
+class BatchWriter:
+    def __init__(self, db, db_path=None, max_rows=None, max_delay_ms=None, queue_size=None, spill_path=None):
+        self.db = db
+        self.db_path = db_path
+        self.max_rows = max_rows or BATCH_MAX_ROWS
+        self.max_delay = (max_delay_ms or BATCH_MAX_DELAY_MS) / 1000
+        self.queue = asyncio.Queue(maxsize=queue_size or QUEUE_MAX_SIZE)
+        self.spill_path = spill_path or SPILL_PATH
+        self.rows_written = 0
+        self.batches_written = 0
+        self.rows_spilled = 0
+        self._stopping = False
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    # Queue one row; waits while the queue is full so slow disks throttle the producers
+    async def put(self, sql, params):
+        await self.queue.put(([(sql, params)], None))
+
+    # Queue several (sql, params) rows that must be committed together. on_commit, if
+    # given, is called on the loop with the ids of their RETURNING id rows once they
+    # are committed, or with None if they were spilled.
+    async def put_many(self, rows, on_commit=None):
+        if rows:
+            await self.queue.put((rows, on_commit))
+
+    # Flush everything still queued and stop the writer task
+    async def close(self):
+        if self._task is None:
+            return
+        self._stopping = True
+        await self.queue.put(_STOP)
+        await self._task
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self.queue.get()
+            if item is _STOP:
+                break
+
+            batch, callbacks = [], []
+            self._add(batch, callbacks, item)
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_rows:
+                try:
+                    item = self.queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self.queue.get(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                if item is _STOP:
+                    stopping = True
+                    break
+                self._add(batch, callbacks, item)
+
+            ids = await self._commit(batch)
+            for on_commit, start, end in callbacks:
+                try:
+                    on_commit(None if ids is None else [row_id for row_id in ids[start:end] if row_id is not None])
+                except Exception as e:
+                    print(f"on_commit callback failed: {e!r}")
+
+    # Function to append a queued item to the batch, remembering which rows its
+    # callback covers
+    @staticmethod
+    def _add(batch, callbacks, item):
+        rows, on_commit = item
+        if on_commit is not None:
+            callbacks.append((on_commit, len(batch), len(batch) + len(rows)))
+        batch.extend(rows)
+
+    # Function to commit a batch, retrying while the database cannot take it and
+    # spilling it when it never will. Returns the ids of the batch's rows (None for
+    # rows without RETURNING id), or None once the batch was spilled.
+    async def _commit(self, batch):
+        delay = COMMIT_RETRY_DELAY
+        attempts = 0
+        while True:
+            try:
+                ids = await self.db.run(self._write, batch)
+                if attempts:
+                    print(f"Wrote batch of {len(batch)} rows after {attempts} retries")
+                return ids
+            except sqlite3.Error as e:
+                attempts += 1
+                if (not is_transient(e) or attempts >= COMMIT_MAX_ATTEMPTS
+                        or self._stopping and attempts >= COMMIT_STOP_ATTEMPTS):
+                    error = e
+                    break
+                if attempts == 1:
+                    print(f"Failed to write batch of {len(batch)} rows ({e}), retrying")
+                DB_COMMIT_RETRIES.inc()
+                await asyncio.sleep(delay)
+                delay = min(2 * delay, COMMIT_RETRY_MAX_DELAY)
+        print(f"Failed to write batch of {len(batch)} rows ({error}), spilling it to {self.spill_path}")
+        await self.db.run(self._spill, batch)
+        return None
+
+    def _write(self, batch):
+        start = time.perf_counter()
+        ids = []
+        with connection(self.db_path) as conn:
+            cursor = conn.cursor()
+            for sql, rows in groupby(batch, key=lambda item: item[0]):
+                params = [params for _, params in rows]
+                if sql.rstrip().upper().endswith('RETURNING ID'):
+                    ids.extend(cursor.execute(sql, row).fetchone()[0] for row in params)
+                else:
+                    cursor.executemany(sql, params)
+                    ids.extend([None] * len(params))
+            conn.commit()
+        DB_COMMIT_SECONDS.observe(time.perf_counter() - start)
+        DB_BATCH_ROWS.observe(len(batch))
+        self.rows_written += len(batch)
+        self.batches_written += 1
+        return ids
+
+    def _spill(self, batch):
+        with open(self.spill_path, 'a') as f:
+            for sql, params in batch:
+                f.write(json.dumps([' '.join(sql.split()), list(params)]) + '\n')
+        DB_SPILLED_ROWS.inc(len(batch))
+        self.rows_spilled += len(batch)
+
+if __name__ == "__main__":
+    # Write the rows of the spill file to the database, e.g. once a full disk is freed
+    # (obd_config imports this module, hence the late import)
+    from obd_config import apply_config, parse_args
+    from obd_storage import init_db
+    apply_config(parse_args("Replay the rows the batched writer spilled."))
+    init_db()
+    print(f"Replayed {replay_spill()} spilled rows from {SPILL_PATH}")
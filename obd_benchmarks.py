@@ -0,0 +1,416 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import websockets
+
+import car_digital_twin_ws_daemon as daemon
+import obd_archive
+import obd_batch_writer
+import obd_storage
+from obd_async_db import AsyncDb
+from obd_batch_writer import BatchWriter
+from obd_detection import DetectionEngine
+from obd_load_generator import create_load_users, encode_json_samples, print_report, run_vehicles, simulate_samples
+from obd_norm_ranges import NormRangeCache
+from obd_storage import METRIC_COLUMNS, close_all, connection, init_db
+from obd_vehicle_stats import VehicleStats
+from obd_wire import FLAG_ACK, SUBPROTOCOL_BINARY, decode_frame, encode_binary_samples
+
+# Standalone benchmark runner. Each benchmark records per-operation timings and
+# the whole run is written to JSON, so a run before and after a change can be
+# compared with --compare:
+#   python obd_benchmarks.py --output before.json
+#   python obd_benchmarks.py --output after.json --compare before.json
+
+# Benchmark groups, in the order they run
+BENCH_GROUPS = ['decode', 'detect', 'stats', 'store', 'queries', 'websocket']
+
+# Dataset sizes (obd_data rows) of the dashboard query benchmarks
+BENCH_SIZES = {'10k': 10_000, '1m': 1_000_000, '10m': 10_000_000}
+
+# Sizes run unless --sizes asks for others; 10m is opt-in, building it takes minutes
+BENCH_DEFAULT_SIZES = ['10k', '1m']
+
+# Directory the generated datasets are kept in between runs, so each size is
+# only built once
+BENCH_DATA_DIR = 'obd_bench_data'
+
+# Vehicles the dataset rows are spread over, and rows per out-of-norm log row
+BENCH_USERS = 10
+BENCH_ROWS_PER_LOG = 100
+
+# Each benchmark runs for at least this many seconds and this many calls
+BENCH_MIN_TIME = 1.0
+BENCH_MIN_CALLS = 20
+
+# Rows stored per timed call of the batched store benchmark: two full group
+# commits, so no call waits out the writer's batch delay
+BENCH_STORE_ROWS = 2 * obd_batch_writer.BATCH_MAX_ROWS
+
+# Sequential acked frames per websocket round-trip benchmark
+BENCH_ROUND_TRIPS = 500
+
+# A result is a regression when its median is this many times the baseline's
+REGRESSION_THRESHOLD = 1.2
+
+BENCH_SEED = 42
+
+# Function to summarize per-operation timings (seconds) into a result row in
+# microseconds
+def summarize(name, timings, **params):
+    timings = np.asarray(timings) * 1e6
+    return {
+        'name': name,
+        'params': params,
+        'calls': len(timings),
+        'mean_us': round(float(timings.mean()), 3),
+        'median_us': round(float(np.median(timings)), 3),
+        'p99_us': round(float(np.percentile(timings, 99)), 3),
+        'min_us': round(float(timings.min()), 3),
+        'ops_per_s': round(1e6 / float(np.median(timings)), 1)
+    }
+
+# Function to time fn() call by call for at least BENCH_MIN_TIME seconds
+def time_calls(fn):
+    timings = []
+    end = time.perf_counter() + BENCH_MIN_TIME
+    while time.perf_counter() < end or len(timings) < BENCH_MIN_CALLS:
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+# Function to make n simulated readings as (epoch ms array, values)
+def make_frame(rng, n):
+    timestamps = int(time.time() * 1000) + np.arange(n, dtype=np.int64) * 100
+    return timestamps, simulate_samples(rng, n, 0.01)
+
+def bench_decode(rng):
+    results = []
+    for n in (1, 100):
+        timestamps, values = make_frame(rng, n)
+        for wire_format, message in (('json', encode_json_samples(1, timestamps, values)),
+                                     ('binary', encode_binary_samples(1, timestamps, values))):
+            results.append(summarize('decode_frame', time_calls(lambda: decode_frame(message)),
+                                     format=wire_format, samples=n))
+    return results
+
+# Norm checks and excursion tracking of one vehicle, frame after frame
+def bench_detect(rng):
+    norm_ranges = NormRangeCache()
+    norm_ranges.load()
+    results = []
+    for n in (1, 100):
+        detector = DetectionEngine(norm_ranges)
+        timestamps, values = make_frame(rng, n)
+
+        def detect():
+            timestamps[:] += 100 * n
+            detector.detect(1, timestamps, values)
+        results.append(summarize('detect', time_calls(detect), samples=n))
+    return results
+
+def bench_stats(rng):
+    results = []
+    for n in (1, 100):
+        stats = VehicleStats()
+        timestamps, values = make_frame(rng, n)
+        # Warm the statistics up first, so anomaly scoring is part of the timing
+        for _ in range(300 // n + 1):
+            stats.update(1, timestamps, values)
+        results.append(summarize('vehicle_stats_update', time_calls(lambda: stats.update(1, timestamps, values)),
+                                 samples=n))
+    return results
+
+# Storing rows: the baseline commits each row on its own, as the original app
+# did; store_data_in_db queues them for the daemon's batched writer, one row per
+# frame and 100-row frames. Timings are per row; a batched call stores
+# BENCH_STORE_ROWS rows and ends once the last of them is committed.
+def bench_store(rng):
+    timestamps, values = make_frame(rng, 1)
+    row = (1, int(timestamps[0]), *values[0].tolist())
+    columns = ', '.join(METRIC_COLUMNS)
+
+    def commit_row():
+        with connection() as conn:
+            conn.execute(f'''
+                INSERT INTO obd_data (user_id, ts, {columns}) VALUES ({', '.join('?' * len(row))})
+            ''', row)
+            conn.commit()
+    results = [summarize('store_row_commit', time_calls(commit_row), samples_per_frame=1)]
+
+    async def open_writer():
+        daemon.db = AsyncDb()
+        daemon.writer = BatchWriter(daemon.db).start()
+
+    async def close_writer():
+        await daemon.writer.close()
+        daemon.db.close()
+        daemon.writer = None
+
+    async def store(frames, no_events):
+        committed = asyncio.get_running_loop().create_future()
+        for index, (timestamps, values) in enumerate(frames):
+            on_commit = committed.set_result if index == len(frames) - 1 else None
+            await daemon.store_data_in_db(1, timestamps, values, no_events, on_commit=on_commit)
+        await committed
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(open_writer())
+        for n in (1, 100):
+            frames = [make_frame(rng, n) for _ in range(BENCH_STORE_ROWS // n)]
+            no_events = np.zeros((n, len(METRIC_COLUMNS)), dtype=bool)
+            timings = time_calls(lambda: loop.run_until_complete(store(frames, no_events)))
+            results.append(summarize('store_data_in_db', np.asarray(timings) / BENCH_STORE_ROWS,
+                                     samples_per_frame=n, rows=BENCH_STORE_ROWS))
+        loop.run_until_complete(close_writer())
+    finally:
+        loop.close()
+    return results
+
+# Function to build (once) a database with `rows` obd_data rows spread over
+# BENCH_USERS vehicles at 1 Hz, and one out-of-norm log row per BENCH_ROWS_PER_LOG
+def build_dataset(size, rows, data_dir):
+    path = os.path.join(data_dir, f'bench_{size}.db')
+    if os.path.exists(path):
+        return path
+    os.makedirs(data_dir, exist_ok=True)
+    tmp_path = path + '.tmp'
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(tmp_path + suffix):
+            os.remove(tmp_path + suffix)
+    print(f"Building {size} dataset in {path}...")
+    init_db(tmp_path)
+
+    rng = np.random.default_rng(BENCH_SEED)
+    start_ts = int(time.time() * 1000) - (rows // BENCH_USERS) * 1000
+    chunk = 100_000
+    with connection(tmp_path) as conn:
+        for first in range(0, rows, chunk):
+            index = np.arange(first, min(first + chunk, rows))
+            user_ids = index % BENCH_USERS + 1
+            timestamps = start_ts + (index // BENCH_USERS) * 1000
+            values = simulate_samples(rng, len(index), 0.01)
+            conn.executemany(f'''
+                INSERT INTO obd_data (user_id, ts, {', '.join(METRIC_COLUMNS)})
+                VALUES (?, ?, {', '.join('?' * len(METRIC_COLUMNS))})
+            ''', zip(user_ids.tolist(), timestamps.tolist(), *values.T.tolist()))
+
+            logged = (index // BENCH_USERS) % BENCH_ROWS_PER_LOG == 0
+            metrics = rng.integers(len(METRIC_COLUMNS), size=int(logged.sum()))
+            conn.executemany('''
+                INSERT INTO out_of_norm_logs (user_id, metric_name, value, ts) VALUES (?, ?, ?, ?)
+            ''', zip(user_ids[logged].tolist(), [METRIC_COLUMNS[metric] for metric in metrics.tolist()],
+                     values[logged, metrics].tolist(), timestamps[logged].tolist()))
+            conn.commit()
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    close_all()
+    os.replace(tmp_path, path)
+    return path
+
+# The dashboard's queries against each dataset size
+def bench_queries(sizes, data_dir):
+    # Imported here: it pulls in Streamlit. These are the uncached queries.
+    from obd_dashboard_data import get_latest_obd_data, get_new_obd_data, get_out_of_norm_logs
+
+    results = []
+    db_path, archive_dir = obd_storage.DB_PATH, obd_archive.ARCHIVE_DIR
+    obd_archive.ARCHIVE_DIR = os.path.join(data_dir, 'no_archive')
+    try:
+        for size in sizes:
+            obd_storage.DB_PATH = build_dataset(size, BENCH_SIZES[size], data_dir)
+            with connection() as conn:
+                last_id = conn.execute('SELECT MAX(id) FROM obd_data').fetchone()[0]
+                first_log_id = conn.execute('SELECT MAX(id) FROM out_of_norm_logs').fetchone()[0]
+            for name, fn in (
+                ('get_latest_obd_data', lambda: get_latest_obd_data(1)),
+                ('get_new_obd_data', lambda: get_new_obd_data(1, last_id - 100)),
+                ('get_out_of_norm_logs', lambda: get_out_of_norm_logs(1)),
+                ('get_out_of_norm_logs_metric', lambda: get_out_of_norm_logs(1, metric_name='rpm')),
+                ('get_out_of_norm_logs_older_page', lambda: get_out_of_norm_logs(1, before_id=first_log_id // 2))
+            ):
+                results.append(summarize(name, time_calls(fn), rows=size))
+    finally:
+        obd_storage.DB_PATH, obd_archive.ARCHIVE_DIR = db_path, archive_dir
+        close_all()
+    return results
+
+# Function to find a free local port for the benchmark daemon
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+# Full round trips against a daemon started on a scratch copy of the 10k dataset:
+# sequential acked frames on one connection, then a short fleet load
+def bench_websocket(data_dir):
+    run_dir = os.path.join(data_dir, 'daemon')
+    os.makedirs(run_dir, exist_ok=True)
+    db_path = os.path.join(run_dir, 'obd_data.db')
+    with sqlite3.connect(build_dataset('10k', BENCH_SIZES['10k'], data_dir)) as source, \
+            sqlite3.connect(db_path) as target:
+        source.backup(target)
+    port = free_port()
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'car_digital_twin_ws_daemon.py')
+    # Without /metrics, so it runs next to a daemon that already serves them
+    process = subprocess.Popen([sys.executable, script, '--db-path', db_path, '--port', str(port),
+                                '--metrics-port', '0'], cwd=run_dir, stdout=subprocess.DEVNULL)
+    uri = f'ws://localhost:{port}'
+
+    async def round_trips(wire_format, samples):
+        rng = np.random.default_rng(BENCH_SEED)
+        subprotocols = [SUBPROTOCOL_BINARY] if wire_format == 'binary' else None
+        async with websockets.connect(uri, subprotocols=subprotocols) as websocket:
+            timings = []
+            for _ in range(BENCH_ROUND_TRIPS):
+                timestamps, values = make_frame(rng, samples)
+                if wire_format == 'binary':
+                    message = encode_binary_samples(1, timestamps, values, FLAG_ACK)
+                else:
+                    message = encode_json_samples(1, timestamps, values)
+                start = time.perf_counter()
+                await websocket.send(message)
+                while 'ack' not in json.loads(await websocket.recv()):
+                    pass
+                timings.append(time.perf_counter() - start)
+        return timings
+
+    async def wait_for_daemon():
+        for _ in range(100):
+            try:
+                async with websockets.connect(uri):
+                    return
+            except OSError:
+                await asyncio.sleep(0.1)
+        raise RuntimeError(f"Benchmark daemon did not start on {uri}")
+
+    results = []
+    try:
+        asyncio.run(wait_for_daemon())
+        for wire_format, samples in (('json', 1), ('binary', 1), ('binary', 100)):
+            timings = asyncio.run(round_trips(wire_format, samples))
+            results.append(summarize('websocket_round_trip', timings, format=wire_format, samples=samples))
+
+        load = SimpleNamespace(uri=uri, vehicles=50, rate=10.0, batch_size=1, format='binary', duration=5.0,
+                               ramp_up=1.0, out_of_norm=0.01, burst_every=0, burst_size=1, reconnect_every=0,
+                               seed=BENCH_SEED)
+        # One user per vehicle, like the load generator
+        user_ids = create_load_users(load.vehicles, db_path)
+        start = time.perf_counter()
+        stats = asyncio.run(run_vehicles(range(load.vehicles), user_ids, load))
+        report = stats.report(load.duration, time.perf_counter() - start, load.vehicles)
+        print_report(report)
+        result = summarize('websocket_fleet', stats.latencies, vehicles=load.vehicles, rate=load.rate)
+        result['load'] = report
+        results.append(result)
+    finally:
+        process.terminate()
+        process.wait()
+    return results
+
+# Function to describe where a run happened
+def run_metadata():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'commit': commit or None,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count()
+    }
+
+# Function to compare results with a baseline run. Returns the regressions found.
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    def key(result):
+        return result['name'], json.dumps(result['params'], sort_keys=True)
+    previous = {key(result): result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        before = previous.get(key(result))
+        if before is None:
+            continue
+        ratio = result['median_us'] / before['median_us']
+        flag = ''
+        if ratio > threshold:
+            flag = '  REGRESSION'
+            regressions.append(result)
+        print(f"{result['name']:<32} {json.dumps(result['params']):<40} "
+              f"{before['median_us']:>12.1f}us -> {result['median_us']:>12.1f}us  x{ratio:.2f}{flag}")
+    return regressions
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark ingest, detection, storage and dashboard queries.")
+    parser.add_argument('--only', default=','.join(BENCH_GROUPS),
+                        help=f"comma-separated groups to run (default: all of {','.join(BENCH_GROUPS)})")
+    parser.add_argument('--sizes', default=','.join(BENCH_DEFAULT_SIZES),
+                        help=f"comma-separated dataset sizes of the query benchmarks, of {','.join(BENCH_SIZES)} "
+                             f"(default: %(default)s)")
+    parser.add_argument('--data-dir', default=BENCH_DATA_DIR, help="where datasets are kept (default: %(default)s)")
+    parser.add_argument('--output', default='obd_benchmarks.json', help="result file (default: %(default)s)")
+    parser.add_argument('--compare', help="baseline result file to compare against")
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help="median slowdown counted as a regression (default: %(default)s)")
+    options = parser.parse_args()
+    options.only = [group.strip() for group in options.only.split(',') if group.strip()]
+    options.sizes = [size.strip().lower() for size in options.sizes.split(',') if size.strip()]
+    for group in options.only:
+        if group not in BENCH_GROUPS:
+            parser.error(f"unknown group {group!r}")
+    for size in options.sizes:
+        if size not in BENCH_SIZES:
+            parser.error(f"unknown size {size!r} (choose from {', '.join(BENCH_SIZES)})")
+    return options
+
+if __name__ == "__main__":
+    options = parse_args()
+    data_dir = os.path.abspath(options.data_dir)
+    # The in-process benchmarks write to a scratch database of their own
+    os.makedirs(data_dir, exist_ok=True)
+    obd_storage.DB_PATH = os.path.join(data_dir, 'scratch.db')
+    init_db()
+
+    rng = np.random.default_rng(BENCH_SEED)
+    benchmarks = {
+        'decode': lambda: bench_decode(rng),
+        'detect': lambda: bench_detect(rng),
+        'stats': lambda: bench_stats(rng),
+        'store': lambda: bench_store(rng),
+        'queries': lambda: bench_queries(options.sizes, data_dir),
+        'websocket': lambda: bench_websocket(data_dir)
+    }
+    results = []
+    for group in BENCH_GROUPS:
+        if group in options.only:
+            for result in benchmarks[group]():
+                print(f"{result['name']:<32} {json.dumps(result['params']):<40} "
+                      f"median {result['median_us']:>12.1f}us  p99 {result['p99_us']:>12.1f}us")
+                results.append(result)
+    close_all()
+
+    with open(options.output, 'w') as f:
+        json.dump({'meta': run_metadata(), 'results': results}, f, indent=2)
+    print(f"Wrote {len(results)} results to {options.output}")
+
+    if options.compare:
+        with open(options.compare) as f:
+            regressions = compare(results, json.load(f), options.threshold)
+        if regressions:
+            print(f"{len(regressions)} benchmarks regressed by more than x{options.threshold}")
+            sys.exit(1)
@@ -0,0 +1,139 @@
+import argparse
+import os
+
+import obd_archive
+import obd_batch_writer
+import obd_hot_store
+import obd_metrics
+import obd_profiling
+import obd_pubsub
+import obd_rollups
+import obd_storage
+
+# Every option can also be set through an environment variable named after it,
+# e.g. --db-path / OBD_DB_PATH, so the same settings work for `streamlit run`,
+# service units and containers. Command-line options win over the environment.
+ENV_PREFIX = 'OBD_'
+
+# Address the daemon and its live feed listen on unless configured otherwise
+DEFAULT_HOST = 'localhost'
+DEFAULT_PORT = 8765
+DEFAULT_AGGREGATOR_PORT = 8766
+
+# Environment values of on/off options
+TRUE_VALUES = ('1', 'true', 'yes', 'on')
+FALSE_VALUES = ('0', 'false', 'no', 'off')
+
+def _env_name(option):
+    return ENV_PREFIX + option.lstrip('-').replace('-', '_').upper()
+
+# Function to parse a NAME=VALUE pragma setting
+def _pragma(text):
+    name, separator, value = text.partition('=')
+    if not separator or not name.isidentifier() or not value:
+        raise argparse.ArgumentTypeError(f"expected NAME=VALUE, got {text!r}")
+    return name, value
+
+# Parser whose defaults come from the environment. A malformed environment value is
+# reported like a malformed option.
+class EnvArgumentParser(argparse.ArgumentParser):
+    def add_option(self, option, type=str, default=None, **kwargs):
+        value = os.environ.get(_env_name(option))
+        if value is not None:
+            try:
+                default = type(value)
+            except (ValueError, argparse.ArgumentTypeError) as e:
+                self.error(f"invalid {_env_name(option)}={value!r}: {e}")
+        help_text = kwargs.pop('help', '')
+        kwargs['help'] = f"{help_text} (env {_env_name(option)}, default: %(default)s)"
+        return self.add_argument(option, type=type, default=default, **kwargs)
+
+    # On/off option with a --no- form; the environment takes 1/0, true/false, yes/no or on/off
+    def add_flag(self, option, **kwargs):
+        value = os.environ.get(_env_name(option))
+        default = False
+        if value is not None:
+            if value.lower() not in TRUE_VALUES + FALSE_VALUES:
+                self.error(f"invalid {_env_name(option)}={value!r}: expected one of {', '.join(TRUE_VALUES)} "
+                           f"or {', '.join(FALSE_VALUES)}")
+            default = value.lower() in TRUE_VALUES
+        help_text = kwargs.pop('help', '')
+        kwargs['help'] = f"{help_text} (env {_env_name(option)}, default: %(default)s)"
+        return self.add_argument(option, action=argparse.BooleanOptionalAction, default=default, **kwargs)
+
+# Function to build the options shared by every program that opens the database;
+# `server` adds the listening address, `daemon` the ingest tuning knobs
+def build_parser(description, server=False, daemon=False):
+    parser = EnvArgumentParser(description=description)
+    parser.add_option('--db-path', default=obd_storage.DB_PATH,
+                      help="SQLite database file")
+    parser.add_argument('--pragma', type=_pragma, action='append', default=[], metavar='NAME=VALUE',
+                        help="extra SQLite pragma for every connection, may be repeated "
+                             f"(env {_env_name('--pragmas')} as a comma-separated list)")
+    parser.add_option('--hot-store-dir', default=obd_hot_store.HOT_STORE_DIR,
+                      help="directory of the memory-mapped recent samples")
+    parser.add_option('--archive-dir', default=obd_archive.ARCHIVE_DIR,
+                      help="directory of archived raw samples")
+    parser.add_flag('--profile', help="sample the stacks of frame handling / dashboard refreshes")
+    parser.add_option('--profile-dir', default=obd_profiling.PROFILE_DIR,
+                      help="directory of the collapsed stacks and summaries")
+    parser.add_option('--profile-interval', type=float, default=obd_profiling.PROFILE_DUMP_INTERVAL,
+                      help="seconds between profile dumps")
+
+    if server or daemon:
+        parser.add_option('--host', default=DEFAULT_HOST, help="address to accept connections on")
+        parser.add_option('--port', type=int, default=DEFAULT_PORT, help="port to accept connections on")
+    else:
+        parser.add_option('--live-feed-uri', default=obd_pubsub.LIVE_FEED_URI,
+                          help="daemon endpoint that pushes live updates")
+        parser.add_option('--chart-points', type=int, default=obd_rollups.CHART_POINTS,
+                          help="most points of a long-range chart, shared by all metrics")
+
+    if daemon:
+        parser.add_option('--workers', type=int, default=1,
+                          help="ingest processes sharing the port; more than one runs the sharded mode")
+        parser.add_option('--aggregator-port', type=int, default=DEFAULT_AGGREGATOR_PORT,
+                          help="port of the live feed in the sharded mode")
+        parser.add_option('--metrics-port', type=int, default=obd_metrics.METRICS_PORT,
+                          help="port of the Prometheus /metrics endpoint, 0 to disable; "
+                               "sharded workers use the ports after it")
+        parser.add_option('--batch-rows', type=int, default=obd_batch_writer.BATCH_MAX_ROWS,
+                          help="rows buffered before a group commit")
+        parser.add_option('--batch-delay-ms', type=float, default=obd_batch_writer.BATCH_MAX_DELAY_MS,
+                          help="longest a buffered row waits for its commit")
+        parser.add_option('--queue-size', type=int, default=obd_batch_writer.QUEUE_MAX_SIZE,
+                          help="frames queued for the writer before connections wait")
+    return parser
+
+# Function to parse the command line (sys.argv by default; under Streamlit, the
+# arguments after `--`)
+def parse_args(description, argv=None, server=False, daemon=False):
+    parser = build_parser(description, server, daemon)
+    config = parser.parse_args(argv)
+
+    pragmas = os.environ.get(_env_name('--pragmas'))
+    if pragmas:
+        try:
+            config.pragma = [_pragma(text.strip()) for text in pragmas.split(',')] + config.pragma
+        except argparse.ArgumentTypeError as e:
+            parser.error(f"invalid {_env_name('--pragmas')}: {e}")
+    return config
+
+# Function to make a parsed configuration the default of every module. Worker
+# processes of the sharded daemon call it again, as they start from a fresh
+# interpreter.
+def apply_config(config):
+    obd_storage.DB_PATH = config.db_path
+    obd_storage.PRAGMAS.update(config.pragma)
+    obd_hot_store.HOT_STORE_DIR = config.hot_store_dir
+    obd_archive.ARCHIVE_DIR = config.archive_dir
+    obd_profiling.PROFILE_DIR = config.profile_dir
+    obd_profiling.PROFILE_DUMP_INTERVAL = config.profile_interval
+    if hasattr(config, 'live_feed_uri'):
+        obd_pubsub.LIVE_FEED_URI = config.live_feed_uri
+        obd_rollups.CHART_POINTS = config.chart_points
+    if hasattr(config, 'batch_rows'):
+        obd_batch_writer.BATCH_MAX_ROWS = config.batch_rows
+        obd_batch_writer.BATCH_MAX_DELAY_MS = config.batch_delay_ms
+        obd_batch_writer.QUEUE_MAX_SIZE = config.queue_size
+    return config
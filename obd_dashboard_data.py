@@ -0,0 +1,196 @@
+import time
+
+import streamlit as st
+
+import obd_storage
+from obd_archive import read_archive_latest
+from obd_pubsub import SharedLiveFeed
+from obd_rollups import downsample, get_metric_history
+from obd_storage import init_db
+
+# Data access of the Streamlit dashboards. Streamlit reruns the script on every
+# interaction and runs each browser session on a thread of its own, so the
+# queries below are shared between sessions: results are cached for a few seconds
+# under the user and time window they cover, and ten people watching one car
+# cost about one query per TTL instead of ten per refresh. The get_* functions
+# run uncached and are what the cached ones (and the benchmarks) call. Live
+# updates pushed by the daemon also arrive over one subscription per vehicle.
+
+# Number of samples kept in each live chart
+CHART_WINDOW = 30
+
+# Number of out-of-norm log rows per page (and kept in the live first page)
+LOG_PAGE_SIZE = 100
+
+# Seconds a cached result is served before it is read again: the live window
+# refreshes every second, logs a little less often, and the long-range charts
+# are drawn from rollups that only change once a minute
+LIVE_TTL = 1
+LOG_TTL = 2
+HISTORY_TTL = 60
+USER_TTL = 60
+
+# Distinct arguments kept per cached query, across all sessions
+CACHE_MAX_ENTRIES = 1000
+
+# Relative time windows start on a multiple of this many milliseconds, so sessions
+# that open the same view within a minute share one cache entry
+WINDOW_STEP_MS = 60 * 1000
+
+# Function to open a database once per process: the schema is created or
+# migrated on first use and every session then shares its connection pool
+@st.cache_resource
+def open_database(db_path):
+    init_db(db_path)
+    return obd_storage.get_pool(db_path)
+
+# Function to borrow a pooled connection to the configured database
+def dashboard_connection():
+    return open_database(obd_storage.DB_PATH).connection()
+
+# Function to read a static file once per process, e.g. an image shown on every
+# page; None if the file is missing, so the page is drawn without it
+@st.cache_resource
+def static_asset(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        print(f"Static asset {path} not found")
+        return None
+
+# Function to get the epoch ms start of a window reaching `look_back` ms into the
+# past (None = all time), rounded down to WINDOW_STEP_MS
+def window_start(look_back):
+    if look_back is None:
+        return None
+    return (int(time.time() * 1000) - look_back) // WINDOW_STEP_MS * WINDOW_STEP_MS
+
+# Function to retrieve the latest OBD-II entries for the logged-in user as
+# (id, ts, *metrics) rows in chronological order. When the database holds fewer
+# than `limit` rows, the rest come from the archive of older data.
+def get_latest_obd_data(user_id, limit=CHART_WINDOW):
+    with dashboard_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, ts, battery_voltage, engine_load, rpm,
+                   coolant_temp, throttle_position, fuel_level,
+                   intake_pressure, maf_rate
+            FROM obd_data
+            WHERE user_id = ?
+            ORDER BY id DESC
+            LIMIT ?
+        ''', (user_id, limit))
+        rows = cursor.fetchall()
+    rows.reverse()  # Reverse to get chronological order
+
+    if len(rows) < limit:
+        before_ts = rows[0][1] if rows else int(time.time() * 1000) + 1
+        archived = read_archive_latest(user_id, before_ts, limit - len(rows))
+        archived = archived.astype(object).where(archived.notna(), None)
+        rows = list(archived.itertuples(index=False, name=None)) + rows
+    return rows
+
+# Function to retrieve at most `limit` OBD-II entries stored after row `last_id`,
+# as (id, ts, *metrics) rows. This is a range scan of idx_obd_data_user_id.
+def get_new_obd_data(user_id, last_id, limit=CHART_WINDOW):
+    with dashboard_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, ts, battery_voltage, engine_load, rpm,
+                   coolant_temp, throttle_position, fuel_level,
+                   intake_pressure, maf_rate
+            FROM obd_data
+            WHERE user_id = ? AND id > ?
+            ORDER BY id
+            LIMIT ?
+        ''', (user_id, last_id, limit))
+        return cursor.fetchall()
+
+# Function to get one page of the user's out-of-norm logs, newest first, joined
+# with norm ranges. Pages are keyset paginated by log id: pass before_id to get
+# older rows or after_id to get only rows logged since the last refresh.
+def get_out_of_norm_logs(user_id, metric_name=None, since_ts=None,
+                         before_id=None, after_id=None, limit=LOG_PAGE_SIZE):
+    conditions = ['logs.user_id = ?']
+    params = [user_id]
+    if metric_name is not None:
+        conditions.append('logs.metric_name = ?')
+        params.append(metric_name)
+    if since_ts is not None:
+        conditions.append('logs.ts >= ?')
+        params.append(since_ts)
+    if before_id is not None:
+        conditions.append('logs.id < ?')
+        params.append(before_id)
+    if after_id is not None:
+        conditions.append('logs.id > ?')
+        params.append(after_id)
+
+    with dashboard_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT logs.id, logs.metric_name, logs.value,
+                   datetime(logs.ts / 1000, 'unixepoch', 'localtime'),
+                   ranges.min_value, ranges.max_value
+            FROM out_of_norm_logs logs
+            LEFT JOIN norm_ranges ranges ON logs.metric_name = ranges.metric_name
+            WHERE {' AND '.join(conditions)}
+            ORDER BY logs.id DESC
+            LIMIT ?
+        ''', params + [limit])
+        logs = cursor.fetchall()
+    return logs
+
+# Function to check if user exists
+def get_user_exists(user_id):
+    with dashboard_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id FROM users WHERE id = ?
+        ''', (user_id,))
+        user = cursor.fetchone()
+    return user is not None
+
+# Cached versions of the queries above, shared by every session of the process
+@st.cache_data(ttl=LIVE_TTL, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def latest_obd_data(user_id, limit=CHART_WINDOW):
+    return get_latest_obd_data(user_id, limit)
+
+@st.cache_data(ttl=LOG_TTL, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def out_of_norm_logs(user_id, metric_name=None, since_ts=None, before_id=None, after_id=None):
+    return get_out_of_norm_logs(user_id, metric_name, since_ts, before_id, after_id)
+
+@st.cache_data(ttl=USER_TTL, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def user_exists(user_id):
+    return get_user_exists(user_id)
+
+# Function to get every metric of the last `look_back` ms as a history frame
+# downsampled to the chart's point budget
+@st.cache_data(ttl=HISTORY_TTL, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def metric_history(user_id, look_back):
+    end_ts = int(time.time() * 1000)
+    return downsample(get_metric_history(user_id, end_ts - look_back, end_ts))
+
+# Function to get the process-wide subscription to a vehicle's live feed
+@st.cache_resource
+def shared_live_feed(user_id):
+    return SharedLiveFeed(user_id)
+
+# One session's position in a vehicle's shared live feed
+class FeedReader:
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.last = 0
+        # Subscription the reader is caught up with; -1 makes the first read backfill
+        self.generation = -1
+
+    # Function to read the pushed messages since the last call. Returns
+    # (messages, backfill): when backfill is True the source of updates changed
+    # and the reader has to start over from the database; messages is None while
+    # the daemon is unreachable, so the database has to be polled instead.
+    def read(self):
+        messages, self.last, generation = shared_live_feed(self.user_id).read(self.last, self.generation)
+        backfill = generation != self.generation or (messages is None and generation is not None)
+        self.generation = generation
+        return (None if backfill else messages), backfill
@@ -0,0 +1,109 @@
+import numpy as np
+
+from obd_storage import METRIC_COLUMNS
+
+# Function to carry the last non-NaN value of each column forward through NaN
+# rows, starting from `initial` (one value per column, NaN = nothing yet)
+def carry_forward(values, initial):
+    stacked = np.vstack([initial, values])
+    rows = np.where(np.isnan(stacked), 0, np.arange(len(stacked))[:, None])
+    np.maximum.accumulate(rows, axis=0, out=rows)
+    return stacked[rows, np.arange(stacked.shape[1])][1:]
+
+# Per-vehicle detector state, one value per metric, carried between frames
+class DetectionState:
+    __slots__ = ('active', 'start_ts', 'reported', 'last_value', 'last_ts')
+
+    def __init__(self):
+        self.active = np.zeros(len(METRIC_COLUMNS))       # 1.0 while in an excursion
+        self.start_ts = np.full(len(METRIC_COLUMNS), np.nan)  # when the excursion began
+        self.reported = np.zeros(len(METRIC_COLUMNS))     # 1.0 once it has been reported
+        self.last_value = np.full(len(METRIC_COLUMNS), np.nan)
+        self.last_ts = np.full(len(METRIC_COLUMNS), np.nan)
+
+# Turns out-of-range samples into excursions and reports each one once. A whole
+# frame of samples is evaluated with array operations across samples and metrics:
+#   - a sample starts (or continues) an excursion when it is outside
+#     [min_value, max_value] or changed faster than max_rate per second
+#   - the excursion ends once a sample is back inside the range by `hysteresis`;
+#     samples in between (or missing) keep the current state
+#   - the excursion is reported at the first sample where it has lasted
+#     min_duration_ms, and never again until it has ended
+# Most frames are in range for a vehicle with no excursion going on; those only
+# cost the range check. The rate and duration bookkeeping is only done while a
+# rule asks for it, so last values are tracked only while a max_rate is set.
+class DetectionEngine:
+    def __init__(self, norm_ranges):
+        self.norm_ranges = norm_ranges
+        self.states = {}
+        self.events = 0
+        self._rules = None
+        self._rate_rules = False
+        self._duration_rules = False
+
+    def forget(self, user_id):
+        self.states.pop(user_id, None)
+
+    # Function to get the detection rules, noting which kinds are configured
+    def _get_rules(self):
+        rules = self.norm_ranges.get_rules()
+        if rules is not self._rules:
+            _, min_duration, max_rate = rules
+            self._rate_rules = bool(np.isfinite(max_rate).any())
+            self._duration_rules = bool(min_duration.any())
+            self._rules = rules
+        return rules
+
+    # Mask (aligned with `samples`) of the samples where an excursion is reported.
+    # timestamps are epoch ms; samples are (n, len(METRIC_COLUMNS)) with NaN gaps.
+    def detect(self, user_id, timestamps, samples):
+        hysteresis, min_duration, max_rate = self._get_rules()
+        values = np.asarray(samples, dtype=np.float64)
+        out_of_range = self.norm_ranges.out_of_norm_mask(values)
+        state = self.states.get(user_id)
+        if not self._rate_rules and not out_of_range.any() and (state is None or not state.active.any()):
+            return out_of_range
+        if state is None:
+            state = self.states[user_id] = DetectionState()
+
+        mins, maxs = self.norm_ranges.get_bounds()
+        ts = np.broadcast_to(np.asarray(timestamps, dtype=np.float64)[:, None], values.shape)
+        out_of_norm = out_of_range
+        back_in_norm = (values >= mins + hysteresis) & (values <= maxs - hysteresis)
+
+        # Rate of change against the previous reported value of each metric
+        if self._rate_rules:
+            last_value = carry_forward(values, state.last_value)
+            last_ts = carry_forward(np.where(np.isnan(values), np.nan, ts), state.last_ts)
+            previous_value = np.vstack([state.last_value, last_value[:-1]])
+            previous_ts = np.vstack([state.last_ts, last_ts[:-1]])
+            elapsed = (ts - previous_ts) / 1000
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rate = np.abs(values - previous_value) / elapsed
+            too_fast = (elapsed > 0) & (rate > max_rate)
+            out_of_norm = out_of_norm | too_fast
+            back_in_norm &= ~too_fast
+            state.last_value = last_value[-1]
+            state.last_ts = last_ts[-1]
+
+        # Excursion state after every sample: set when out of norm, cleared once back
+        # inside by the hysteresis margin, carried over otherwise
+        signal = np.where(out_of_norm, 1.0, np.where(back_in_norm, 0.0, np.nan))
+        active = carry_forward(signal, state.active)
+        was_active = np.vstack([state.active, active[:-1]])
+
+        # Report each excursion once, at the first sample past its minimum duration
+        if self._duration_rules:
+            started = (active == 1) & (was_active == 0)
+            start_ts = carry_forward(np.where(started, ts, np.nan), state.start_ts)
+            confirmed = (active == 1) & (ts - start_ts >= min_duration)
+            state.start_ts = np.where(active[-1] == 1, start_ts[-1], np.nan)
+        else:
+            confirmed = active == 1
+        was_confirmed = np.vstack([state.reported, confirmed[:-1]]) == 1
+        reported = confirmed & ~was_confirmed
+
+        state.active = active[-1]
+        state.reported = confirmed[-1].astype(np.float64)
+        self.events += int(reported.sum())
+        return reported
@@ -0,0 +1,255 @@
+import asyncio
+import os
+import time
+from functools import partial
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from obd_metrics import HOT_STORE_REJECTED
+from obd_storage import METRIC_COLUMNS
+
+# Directory of the memory-mapped store of recent samples, written by the daemon
+# next to the SQLite database:
+#   obd_hot/user_<user_id>/count.npy   int64[1], samples appended so far
+#   obd_hot/user_<user_id>/seq.npy     int64[1], odd while an append is being written
+#   obd_hot/user_<user_id>/stale.npy   int64[1], newest ts of the samples dropped
+#   obd_hot/user_<user_id>/ts.npy      int64[2 * capacity], epoch milliseconds
+#   obd_hot/user_<user_id>/<metric>.npy float32[2 * capacity], one per METRIC_COLUMNS
+HOT_STORE_DIR = 'obd_hot'
+
+# Samples kept per vehicle: a bit over an hour at 50 Hz, about 20 MiB on disk
+HOT_STORE_CAPACITY = 1 << 18
+
+# Each column is a mirrored ring buffer: sample k is written at k % capacity and
+# again at k % capacity + capacity. Positions [end - capacity, end) with
+# end = count % capacity + capacity then always hold the latest samples oldest
+# first, so any recent window is one contiguous slice that readers copy out of
+# the mapped file in one go, without reordering anything.
+#
+# seq.npy is a seqlock around appends: the writer makes it odd before touching the
+# columns and even again once count is updated. Readers copy what they need and
+# keep it only if seq was even and unchanged across the copy, as the writer
+# overwrites the oldest samples once the ring has wrapped.
+#
+# Samples stay sorted by ts, as readers binary search them. A late sample, e.g.
+# from a second connection of the same vehicle, is merged in by rewriting the
+# samples after it. One that would move more than HOT_STORE_MAX_REORDER of them
+# is dropped instead, and stale.npy marks the store incomplete up to its ts, so
+# ranges reaching back that far are read from SQLite.
+COLUMNS = ['ts'] + METRIC_COLUMNS
+
+# Most stored samples an append rewrites to merge in late ones
+HOT_STORE_MAX_REORDER = 4096
+
+# Attempts of a read that keeps overlapping appends, and seconds between them,
+# before the caller is told to read SQLite instead
+HOT_STORE_READ_ATTEMPTS = 100
+HOT_STORE_READ_RETRY_DELAY = 0.001
+
+def _user_dir(user_id, store_dir=None):
+    return os.path.join(store_dir or HOT_STORE_DIR, f'user_{user_id}')
+
+# One vehicle's memory-mapped columns
+class HotColumns:
+    def __init__(self, user_id, store_dir=None, capacity=HOT_STORE_CAPACITY, writable=False):
+        self.user_id = user_id
+        user_dir = _user_dir(user_id, store_dir)
+        if writable and not os.path.exists(os.path.join(user_dir, 'count.npy')):
+            os.makedirs(user_dir, exist_ok=True)
+            for column in COLUMNS:
+                dtype = np.int64 if column == 'ts' else np.float32
+                open_memmap(os.path.join(user_dir, f'{column}.npy'), mode='w+',
+                            dtype=dtype, shape=(2 * capacity,)).flush()
+            open_memmap(os.path.join(user_dir, 'count.npy'), mode='w+', dtype=np.int64, shape=(1,)).flush()
+        # seq.npy and then stale.npy are created last, also in stores written before
+        # they existed, so readers never see a half-created store
+        for name in ('seq', 'stale'):
+            path = os.path.join(user_dir, f'{name}.npy')
+            if writable and not os.path.exists(path):
+                initial = np.iinfo(np.int64).min if name == 'stale' else 0
+                marker = open_memmap(path, mode='w+', dtype=np.int64, shape=(1,))
+                marker[0] = initial
+                marker.flush()
+
+        mode = 'r+' if writable else 'r'
+        self.count = np.load(os.path.join(user_dir, 'count.npy'), mmap_mode=mode)
+        self.seq = np.load(os.path.join(user_dir, 'seq.npy'), mmap_mode=mode)
+        self.stale = np.load(os.path.join(user_dir, 'stale.npy'), mmap_mode=mode)
+        self.columns = {column: np.load(os.path.join(user_dir, f'{column}.npy'), mmap_mode=mode)
+                        for column in COLUMNS}
+        self.capacity = len(self.columns['ts']) // 2
+
+    # Number of samples currently available (at most the capacity)
+    def __len__(self):
+        return int(min(self.count[0], self.capacity))
+
+    # Slice of the mirrored arrays holding the latest `n` of `count` samples
+    def _latest_slice(self, count, n):
+        n = min(n, count, self.capacity)
+        end = count % self.capacity + self.capacity
+        return slice(end - n, end)
+
+    # Function to run read(count) on a consistent state of the columns, retrying
+    # while it overlaps an append. Returns its result, or None if every attempt
+    # overlapped one.
+    def _consistent(self, read):
+        for _ in range(HOT_STORE_READ_ATTEMPTS):
+            seq = int(self.seq[0])
+            if seq % 2 == 0:
+                result = read(int(self.count[0]))
+                if int(self.seq[0]) == seq:
+                    return result
+            time.sleep(HOT_STORE_READ_RETRY_DELAY)
+        return None
+
+    # Latest `n` samples as {'ts': ..., metric: ...} arrays, oldest first
+    def latest(self, n):
+        def read(count):
+            window = self._latest_slice(count, n)
+            return {column: values[window].copy() for column, values in self.columns.items()}
+        return self._consistent(read)
+
+    # Samples with start_ts <= ts < end_ts as {'ts': ..., metric: ...} arrays, or
+    # None when the store does not reach back to start_ts or dropped samples there
+    def range(self, start_ts, end_ts):
+        def read(count):
+            window = self._latest_slice(count, self.capacity)
+            ts = self.columns['ts'][window]
+            if not len(ts) or ts[0] > start_ts or start_ts <= self.stale[0]:
+                return None
+            first, last = np.searchsorted(ts, [start_ts, end_ts])
+            window = slice(window.start + first, window.start + last)
+            return {column: values[window].copy() for column, values in self.columns.items()}
+        return self._consistent(read)
+
+    # Oldest timestamp held, or None when empty
+    def oldest_ts(self):
+        def read(count):
+            window = self._latest_slice(count, self.capacity)
+            return int(self.columns['ts'][window.start]) if count else None
+        return self._consistent(read)
+
+    # Append samples, merging late ones in among the stored ones by ts. Returns how
+    # many were dropped for being too late (see HOT_STORE_MAX_REORDER).
+    def append(self, timestamps, samples):
+        if len(timestamps) > 1 and (np.diff(timestamps) < 0).any():
+            order = np.argsort(timestamps, kind='stable')
+            timestamps, samples = timestamps[order], samples[order]
+        count = int(self.count[0])
+        stale = None
+        if not count or timestamps[0] >= self.columns['ts'][(count - 1) % self.capacity]:
+            # The usual case: the samples all go after the stored ones
+            start = count
+            merged = [timestamps] + [samples[:, index] for index in range(len(METRIC_COLUMNS))]
+        else:
+            start, merged, stale = self._merge(count, timestamps, samples)
+        added = len(merged[0]) - (count - start)
+        if len(merged[0]) > self.capacity:
+            start += len(merged[0]) - self.capacity
+            merged = [values[-self.capacity:] for values in merged]
+
+        seq = int(self.seq[0])
+        self.seq[0] = seq + 1
+        positions = (start + np.arange(len(merged[0]))) % self.capacity
+        mirrored = np.concatenate([positions, positions + self.capacity])
+        for column, values in zip(COLUMNS, merged):
+            self.columns[column][mirrored] = np.tile(values, 2)
+        if stale is not None:
+            self.stale[0] = stale
+        # Publish the samples only once they are fully written
+        self.count[0] = count + added
+        self.seq[0] = seq + 2
+        return len(timestamps) - added
+
+    # Function to merge late samples (sorted by ts) in among the stored ones. Returns
+    # the sample number the merged columns start at, the columns, and the new stale
+    # ts if samples had to be dropped (else None).
+    def _merge(self, count, timestamps, samples):
+        window = self._latest_slice(count, self.capacity)
+        held = self.columns['ts'][window]
+
+        # Stored samples from `first` on move up to make room for the late ones
+        first = int(np.searchsorted(held, timestamps[0], side='right'))
+        stale = None
+        if len(held) - first > HOT_STORE_MAX_REORDER:
+            first = len(held) - HOT_STORE_MAX_REORDER
+            too_late = np.searchsorted(held, timestamps, side='right') < first
+            stale = max(int(self.stale[0]), int(timestamps[too_late][-1]))
+            timestamps, samples = timestamps[~too_late], samples[~too_late]
+            if len(timestamps):
+                first = int(np.searchsorted(held, timestamps[0], side='right'))
+            else:
+                first = len(held)
+
+        moved = slice(window.start + first, window.stop)
+        merged_ts = np.concatenate([held[first:], timestamps])
+        order = np.argsort(merged_ts, kind='stable')
+        merged = [merged_ts[order]] + [np.concatenate([self.columns[metric][moved], samples[:, index]])[order]
+                                       for index, metric in enumerate(METRIC_COLUMNS)]
+        return count - (len(held) - first), merged, stale
+
+# The daemon's writer. Samples land in the page cache, so appends cost a memcpy
+# and the kernel writes them back in the background.
+class HotStoreWriter:
+    def __init__(self, store_dir=None, capacity=HOT_STORE_CAPACITY):
+        self.store_dir = store_dir
+        self.capacity = capacity
+        self._vehicles = {}
+        # Frames of the vehicles whose files are being created
+        self._opening = {}
+
+    # Append a decoded frame (epoch ms array and samples aligned with METRIC_COLUMNS).
+    # A new vehicle's files are created on a thread, as sizing them takes a while;
+    # its frames wait in memory meanwhile rather than holding up the loop or the frame.
+    def append(self, user_id, timestamps, samples):
+        columns = self._vehicles.get(user_id)
+        if columns is not None:
+            self._append(columns, timestamps, samples)
+            return
+        pending = self._opening.get(user_id)
+        if pending is None:
+            pending = self._opening[user_id] = []
+            opening = asyncio.ensure_future(asyncio.to_thread(
+                HotColumns, user_id, self.store_dir, self.capacity, writable=True))
+            opening.add_done_callback(partial(self._opened, user_id))
+        pending.append((timestamps, samples))
+
+    def _opened(self, user_id, opening):
+        pending = self._opening.pop(user_id)
+        if opening.cancelled():
+            return
+        if opening.exception() is not None:
+            # The samples are still in SQLite; the vehicle's next frame tries again
+            print(f"Failed to open the hot store of user {user_id}: {opening.exception()!r}")
+            return
+        columns = self._vehicles[user_id] = opening.result()
+        for timestamps, samples in pending:
+            self._append(columns, timestamps, samples)
+
+    @staticmethod
+    def _append(columns, timestamps, samples):
+        dropped = columns.append(timestamps, samples)
+        if dropped:
+            HOT_STORE_REJECTED.inc(dropped)
+
+    def flush(self):
+        for columns in self._vehicles.values():
+            for values in columns.columns.values():
+                values.flush()
+            columns.count.flush()
+            columns.seq.flush()
+            columns.stale.flush()
+
+_readers = {}
+
+# Function to get a read-only view of a vehicle's hot store, or None if the daemon
+# has not written one
+def open_hot_store(user_id, store_dir=None):
+    key = (store_dir or HOT_STORE_DIR, user_id)
+    reader = _readers.get(key)
+    if reader is None:
+        if not os.path.exists(os.path.join(_user_dir(user_id, store_dir), 'stale.npy')):
+            return None
+        reader = _readers[key] = HotColumns(user_id, store_dir)
+    return reader
@@ -0,0 +1,355 @@
+import asyncio
+import json
+import multiprocessing
+import resource
+import time
+from array import array
+from collections import Counter, deque
+
+import numpy as np
+import websockets
+
+from car_digital_twin_mobile_app_signals_simulator import NORMAL_RANGES
+from obd_config import DEFAULT_HOST, DEFAULT_PORT, EnvArgumentParser
+from obd_storage import METRIC_COLUMNS, connection, hash_password, init_db
+from obd_wire import FLAG_ACK, SUBPROTOCOL_BINARY, SUBPROTOCOL_JSON, encode_binary_samples
+
+# Load generator: many simulated vehicles, each with its own connection, sending
+# the mobile app simulator's readings as fast as configured. Every frame asks the
+# daemon for an ack (see obd_wire), so send-to-ack latency covers decoding,
+# detection and queueing for the batched writer.
+
+# Default fleet: vehicles, readings per second per vehicle and readings per frame
+LOAD_VEHICLES = 1000
+LOAD_RATE_HZ = 1.0
+LOAD_BATCH_SIZE = 1
+
+# Seconds the load runs, and over which the vehicles connect at the start
+LOAD_DURATION = 60
+LOAD_RAMP_UP = 10
+
+# Chance that a single metric value is outside its normal range
+OUT_OF_NORM_PROBABILITY = 0.01
+
+# Seconds between progress lines
+LOAD_REPORT_INTERVAL = 5
+
+# Seconds a vehicle waits before reconnecting after its connection failed
+RECONNECT_DELAY = 1
+
+# Frames a vehicle sends without an ack before it waits for the daemon
+MAX_PENDING_FRAMES = 100
+
+# Seconds vehicles wait for outstanding acks once the load stops
+ACK_GRACE = 5
+
+# Password of the users made by --create-users (hashed once, they never log in)
+LOAD_USER_PASSWORD = 'load-test'
+
+_LOWS = np.array([NORMAL_RANGES[metric][0] for metric in METRIC_COLUMNS], dtype=np.float64)
+_HIGHS = np.array([NORMAL_RANGES[metric][1] for metric in METRIC_COLUMNS], dtype=np.float64)
+
+# Function to simulate n readings at once, like simulate_obd_data: values inside the
+# normal ranges, except for a few slightly below or above them
+def simulate_samples(rng, n, out_of_norm_probability):
+    values = rng.uniform(_LOWS, _HIGHS, (n, len(METRIC_COLUMNS)))
+    outside = rng.random(values.shape) < out_of_norm_probability
+    if outside.any():
+        offset = rng.uniform(0.1, 1.0, values.shape)
+        below = rng.random(values.shape) < 0.5
+        values = np.where(outside, np.where(below, _LOWS - offset, _HIGHS + offset), values)
+    return np.round(values, 2)
+
+# Function to encode readings as a JSON frame that asks for an ack
+def encode_json_samples(user_id, timestamps, values):
+    samples = [dict(zip(METRIC_COLUMNS, row), ts=ts) for ts, row in zip(timestamps.tolist(), values.tolist())]
+    if len(samples) == 1:
+        return json.dumps(dict(samples[0], user_id=user_id, ack=True))
+    return json.dumps({"user_id": user_id, "ack": True, "samples": samples})
+
+# Function to parse a user id list such as "1", "1,4,7" or "1-500"
+def parse_user_ids(text):
+    user_ids = []
+    for part in text.split(','):
+        first, _, last = part.strip().partition('-')
+        user_ids.extend(range(int(first), int(last or first) + 1))
+    if not user_ids:
+        raise ValueError("no user ids")
+    return user_ids
+
+# Function to make sure `count` load test users exist and get their ids
+def create_load_users(count, db_path=None):
+    init_db(db_path)
+    usernames = [f'load_{index:06d}' for index in range(count)]
+    hashed_password = hash_password(LOAD_USER_PASSWORD)
+    with connection(db_path) as conn:
+        conn.executemany('''
+            INSERT OR IGNORE INTO users (username, password) VALUES (?, ?)
+        ''', [(username, hashed_password) for username in usernames])
+        conn.commit()
+        rows = conn.execute(f'''
+            SELECT id FROM users WHERE username IN ({', '.join('?' * count)}) ORDER BY id
+        ''', usernames).fetchall()
+    return [row[0] for row in rows]
+
+# Counters of one load run; processes send theirs back to be merged
+class LoadStats:
+    def __init__(self):
+        self.frames_sent = 0
+        self.samples_sent = 0
+        self.frames_acked = 0
+        self.frames_lost = 0      # sent, but the connection closed before the answer
+        self.warnings = 0
+        self.connections = 0
+        self.errors = Counter()
+        self.latencies = array('d')
+
+    def merge(self, other):
+        for name in ('frames_sent', 'samples_sent', 'frames_acked', 'frames_lost', 'warnings', 'connections'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        self.errors.update(other.errors)
+        self.latencies.extend(other.latencies)
+        return self
+
+    # Summary as a JSON-serializable dict. Rates are over the `duration` frames were
+    # sent in; `elapsed` also covers connecting and waiting for the last acks.
+    # Latencies are in milliseconds.
+    def report(self, duration, elapsed, vehicles):
+        latencies = np.frombuffer(self.latencies, dtype=np.float64) * 1000
+        report = {
+            'vehicles': vehicles,
+            'duration_s': duration,
+            'wall_time_s': round(elapsed, 3),
+            'frames_sent': self.frames_sent,
+            'samples_sent': self.samples_sent,
+            'frames_acked': self.frames_acked,
+            'frames_lost': self.frames_lost,
+            'frames_per_s': round(self.frames_sent / duration, 1),
+            'samples_per_s': round(self.samples_sent / duration, 1),
+            'acks_per_s': round(self.frames_acked / duration, 1),
+            'warnings': self.warnings,
+            'connections': self.connections,
+            'errors': dict(self.errors)
+        }
+        if len(latencies):
+            for name, q in (('p50', 50), ('p90', 90), ('p99', 99), ('p999', 99.9)):
+                report[f'ack_latency_{name}_ms'] = round(float(np.percentile(latencies, q)), 3)
+            report['ack_latency_max_ms'] = round(float(latencies.max()), 3)
+        return report
+
+# Function to print a report as aligned "name: value" lines
+def print_report(report):
+    width = max(len(name) for name in report)
+    for name, value in report.items():
+        print(f"{name:<{width}}  {value}")
+
+# One simulated vehicle. It reconnects after failures, after --reconnect-every
+# seconds on average, and sends --burst-size frames back to back every
+# --burst-every seconds, like a car flushing readings it buffered without coverage.
+class Vehicle:
+    def __init__(self, index, user_id, options, stats):
+        self.index = index
+        self.user_id = user_id
+        self.options = options
+        self.stats = stats
+        self.rng = np.random.default_rng(options.seed + index)
+        self.binary = False
+        self.pending = deque()
+
+    async def run(self, start, deadline):
+        loop = asyncio.get_running_loop()
+        await asyncio.sleep(max(0, start - loop.time()))
+        subprotocols = [SUBPROTOCOL_BINARY if self.options.format == 'binary' else SUBPROTOCOL_JSON]
+        while loop.time() < deadline:
+            try:
+                async with websockets.connect(self.options.uri, subprotocols=subprotocols,
+                                              open_timeout=10, max_queue=None) as websocket:
+                    self.stats.connections += 1
+                    self.binary = websocket.subprotocol == SUBPROTOCOL_BINARY
+                    receiver = asyncio.create_task(self.receive(websocket))
+                    try:
+                        await self.drive(websocket, deadline)
+                    finally:
+                        receiver.cancel()
+            except (OSError, asyncio.TimeoutError, websockets.InvalidHandshake) as e:
+                self.stats.errors[f'connect: {type(e).__name__}'] += 1
+            except websockets.ConnectionClosed:
+                self.stats.errors['connection closed'] += 1
+            else:
+                continue
+            finally:
+                self.stats.frames_lost += len(self.pending)
+                self.pending.clear()
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    # Send frames at the configured rate until the deadline or the planned reconnect
+    async def drive(self, websocket, deadline):
+        loop = asyncio.get_running_loop()
+        options = self.options
+        interval = options.batch_size / options.rate
+        now = loop.time()
+        next_send = now
+        next_burst = now + options.burst_every if options.burst_every else None
+        reconnect_at = now + self.rng.exponential(options.reconnect_every) if options.reconnect_every else None
+
+        while True:
+            now = loop.time()
+            if now >= deadline or (reconnect_at is not None and now >= reconnect_at):
+                break
+            frames = 1
+            if next_burst is not None and now >= next_burst:
+                frames = options.burst_size
+                next_burst += options.burst_every
+            for _ in range(frames):
+                # Counted once per stall, however long the daemon takes to catch up
+                if len(self.pending) >= MAX_PENDING_FRAMES:
+                    self.stats.errors['send window full'] += 1
+                    while len(self.pending) >= MAX_PENDING_FRAMES:
+                        await asyncio.sleep(0.01)
+                await self.send(websocket)
+            next_send += interval
+            await asyncio.sleep(max(0, next_send - loop.time()))
+
+        # Give the daemon time to answer what is still in flight
+        grace_end = loop.time() + ACK_GRACE
+        while self.pending and loop.time() < grace_end:
+            await asyncio.sleep(0.01)
+
+    async def send(self, websocket):
+        n = self.options.batch_size
+        now_ms = int(time.time() * 1000)
+        timestamps = now_ms - ((n - 1 - np.arange(n)) * 1000 / self.options.rate).astype(np.int64)
+        values = simulate_samples(self.rng, n, self.options.out_of_norm)
+        if self.binary:
+            message = encode_binary_samples(self.user_id, timestamps, values, FLAG_ACK)
+        else:
+            message = encode_json_samples(self.user_id, timestamps, values)
+        self.pending.append(time.perf_counter())
+        try:
+            await websocket.send(message)
+        except websockets.ConnectionClosed:
+            # The frame never left, so it is not waiting for an answer
+            self.pending.pop()
+            raise
+        self.stats.frames_sent += 1
+        self.stats.samples_sent += n
+
+    # Match answers to frames in order: every frame gets an ack or an error
+    async def receive(self, websocket):
+        try:
+            async for message in websocket:
+                reply = json.loads(message)
+                if 'warning' in reply:
+                    self.stats.warnings += 1
+                    continue
+                sent = self.pending.popleft() if self.pending else None
+                if 'ack' in reply and sent is not None:
+                    self.stats.frames_acked += 1
+                    self.stats.latencies.append(time.perf_counter() - sent)
+                elif 'error' in reply:
+                    self.stats.errors[f"server: {reply['error']}"] += 1
+        except websockets.ConnectionClosed:
+            pass
+
+# Background task that prints the throughput of this process every interval
+async def report_progress(stats, label):
+    previous_frames, previous_acked = 0, 0
+    while True:
+        await asyncio.sleep(LOAD_REPORT_INTERVAL)
+        frames, acked = stats.frames_sent, stats.frames_acked
+        print(f"{label}{(frames - previous_frames) / LOAD_REPORT_INTERVAL:.0f} frames/s sent, "
+              f"{(acked - previous_acked) / LOAD_REPORT_INTERVAL:.0f} acked/s, "
+              f"{sum(stats.errors.values())} errors so far")
+        previous_frames, previous_acked = frames, acked
+
+# Function to run some of the vehicles in this process
+async def run_vehicles(indices, user_ids, options, label=''):
+    stats = LoadStats()
+    loop = asyncio.get_running_loop()
+    begin = loop.time()
+    deadline = begin + options.duration
+    vehicles = [Vehicle(index, user_ids[index % len(user_ids)], options, stats) for index in indices]
+    progress = asyncio.create_task(report_progress(stats, label))
+    try:
+        # Spread the connections over the ramp-up so they do not all land at once
+        await asyncio.gather(*(
+            vehicle.run(begin + options.ramp_up * vehicle.index / options.vehicles, deadline)
+            for vehicle in vehicles
+        ))
+    finally:
+        progress.cancel()
+    return stats
+
+# Entry point of a load process; each process drives every `processes`-th vehicle
+def process_main(process_index, user_ids, options):
+    raise_open_file_limit()
+    indices = range(process_index, options.vehicles, options.processes)
+    return asyncio.run(run_vehicles(indices, user_ids, options, f"[process {process_index}] "))
+
+# Each vehicle holds a socket, so allow as many open files as the system permits
+def raise_open_file_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+# Function to run the whole load and return its merged report
+def run_load(options, user_ids):
+    start = time.perf_counter()
+    if options.processes == 1:
+        raise_open_file_limit()
+        stats = asyncio.run(run_vehicles(range(options.vehicles), user_ids, options))
+    else:
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(options.processes) as pool:
+            results = pool.starmap(process_main, [(index, user_ids, options) for index in range(options.processes)])
+        stats = LoadStats()
+        for result in results:
+            stats.merge(result)
+    return stats.report(options.duration, time.perf_counter() - start, options.vehicles)
+
+def build_parser():
+    parser = EnvArgumentParser(description="Simulate a fleet of vehicles sending OBD-II frames to the daemon.")
+    parser.add_option('--uri', default=f'ws://{DEFAULT_HOST}:{DEFAULT_PORT}', help="daemon to load")
+    parser.add_option('--vehicles', type=int, default=LOAD_VEHICLES, help="simulated vehicles")
+    parser.add_option('--processes', type=int, default=1, help="processes sharing the vehicles")
+    parser.add_option('--rate', type=float, default=LOAD_RATE_HZ, help="readings per second per vehicle")
+    parser.add_option('--batch-size', type=int, default=LOAD_BATCH_SIZE, help="readings per frame")
+    parser.add_option('--format', choices=['json', 'binary'], default='binary', help="wire format")
+    parser.add_option('--duration', type=float, default=LOAD_DURATION, help="seconds to run")
+    parser.add_option('--ramp-up', type=float, default=LOAD_RAMP_UP, help="seconds over which vehicles connect")
+    parser.add_option('--out-of-norm', type=float, default=OUT_OF_NORM_PROBABILITY,
+                      help="chance of each metric value being out of its normal range")
+    parser.add_option('--burst-every', type=float, default=0,
+                      help="seconds between bursts of frames per vehicle (0 = no bursts)")
+    parser.add_option('--burst-size', type=int, default=10, help="frames sent back to back in a burst")
+    parser.add_option('--reconnect-every', type=float, default=0,
+                      help="mean seconds a vehicle stays connected (0 = for the whole run)")
+    parser.add_option('--user-ids', help="users the vehicles send as, e.g. 1 or 1-500 "
+                                         "(default: one load_* user per vehicle, see --create-users)")
+    parser.add_option('--create-users', type=int, default=0,
+                      help="create this many load_* users and send as them instead of --user-ids")
+    parser.add_option('--db-path', help="database to create the users in (default: the daemon's)")
+    parser.add_option('--seed', type=int, default=0, help="random seed of the simulated readings")
+    parser.add_option('--json', help="also write the report to this JSON file")
+    return parser
+
+if __name__ == "__main__":
+    options = build_parser().parse_args()
+    if options.user_ids and not options.create_users:
+        user_ids = parse_user_ids(options.user_ids)
+    else:
+        # Each vehicle sends as a user of its own unless told otherwise, as several
+        # vehicles of one user interleave their samples
+        user_ids = create_load_users(options.create_users or options.vehicles, options.db_path)
+
+    print(f"Loading {options.uri} with {options.vehicles} vehicles at {options.rate:g} Hz, "
+          f"{options.batch_size} readings per {options.format} frame, for {options.duration:g}s")
+    try:
+        report = run_load(options, user_ids)
+    except KeyboardInterrupt:
+        print("Load generator stopped.")
+    else:
+        print_report(report)
+        if options.json:
+            with open(options.json, 'w') as f:
+                json.dump(report, f, indent=2)
@@ -0,0 +1,257 @@
+import asyncio
+import math
+from bisect import bisect_left
+from collections import deque
+
+# Seconds between event-loop lag probes
+LOOP_LAG_INTERVAL = 0.1
+
+# Number of recent probes kept for percentiles
+LOOP_LAG_WINDOW = 600
+
+# Seconds between stats summaries printed by the daemon
+STATS_REPORT_INTERVAL = 60
+
+# Port of the daemon's Prometheus /metrics endpoint (--metrics-port, 0 = off)
+METRICS_PORT = 9108
+
+# Histogram buckets, in seconds, of the latency metrics
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+# Histogram buckets of the rows per group commit
+BATCH_ROW_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# Measures how late the event loop wakes up a sleeping task. Any blocking call on
+# the loop (a slow commit, a large JSON decode) shows up directly as lag.
+class LoopLagMonitor:
+    def __init__(self, interval=LOOP_LAG_INTERVAL, window=LOOP_LAG_WINDOW):
+        self.interval = interval
+        self.samples = deque(maxlen=window)
+        self.max_lag = 0.0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            LOOP_LAG_SECONDS.observe(lag)
+            self.samples.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+
+    # Lag in seconds at quantile q (0..1) over the recent window
+    def percentile(self, q):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def summary(self):
+        return {
+            "p50_ms": self.percentile(0.5) * 1000,
+            "p99_ms": self.percentile(0.99) * 1000,
+            "max_ms": self.max_lag * 1000
+        }
+
+    def format_summary(self):
+        summary = self.summary()
+        return f"p50={summary['p50_ms']:.2f}ms p99={summary['p99_ms']:.2f}ms max={summary['max_ms']:.2f}ms"
+
+# Minimal Prometheus instrumentation. Recording is a few attribute updates (a
+# bisect for histograms) and nothing is formatted until /metrics is scraped, so
+# the hot path pays next to nothing when nobody is looking. Metrics with labels
+# hand out one child per label combination; callers keep the child they need so
+# the label lookup happens once, not per frame.
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    # Text exposition format 0.0.4
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+def _format_value(value):
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+class _Value:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+class _HistogramValue:
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._children = {}
+        self._function = None
+        registry.register(self)
+
+    def _new_child(self):
+        return _Value()
+
+    # Child for one combination of label values, in the order of `labels`
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    # Read the value from a callback at scrape time instead, for numbers some other
+    # object already keeps (queue sizes, cache counters); costs nothing in between
+    def set_function(self, function):
+        self._function = function
+
+    def samples(self):
+        if self._function is not None:
+            yield self.name, {}, self._function()
+            return
+        for values, child in self._children.items():
+            yield self.name, dict(zip(self.label_names, values)), child.value
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help, labels, registry)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def samples(self):
+        for values, child in self._children.items():
+            labels = dict(zip(self.label_names, values))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), child.counts):
+                cumulative += count
+                yield f'{self.name}_bucket', dict(labels, le=_format_value(bound)), cumulative
+            yield f'{self.name}_sum', labels, child.sum
+            yield f'{self.name}_count', labels, cumulative
+
+# Metrics of the ingest daemon
+CONNECTED_CLIENTS = Gauge('obd_connected_clients', "Open vehicle connections")
+FRAMES = Counter('obd_frames_total', "Frames accepted", ['format'])
+SAMPLES = Counter('obd_samples_total', "Samples accepted")
+FRAME_ERRORS = Counter('obd_frame_errors_total', "Frames rejected", ['reason'])
+STAGE_SECONDS = Histogram('obd_frame_stage_seconds', "Time spent per frame in each ingest stage", ['stage'])
+OUT_OF_NORM_EVENTS = Counter('obd_out_of_norm_events_total', "Out-of-norm excursions reported", ['metric'])
+ANOMALIES = Counter('obd_anomalies_total', "Anomalies flagged by the rolling statistics", ['metric', 'kind'])
+DB_COMMIT_SECONDS = Histogram('obd_db_commit_seconds', "Duration of each group commit")
+DB_BATCH_ROWS = Histogram('obd_db_batch_rows', "Rows per group commit", buckets=BATCH_ROW_BUCKETS)
+DB_COMMIT_RETRIES = Counter('obd_db_commit_retries_total', "Group commits retried after a database error")
+DB_SPILLED_ROWS = Counter('obd_db_spilled_rows_total', "Rows written to the spill file instead of the database")
+AGGREGATOR_ERRORS = Counter('obd_aggregator_errors_total', "Frames of sharded workers that failed to be recorded")
+WRITER_QUEUE_DEPTH = Gauge('obd_writer_queue_depth', "Frames waiting for the batched writer")
+HOT_STORE_REJECTED = Counter('obd_hot_store_rejected_samples_total',
+                             "Samples too late to be merged into the hot store, whose range is read from SQLite instead")
+LIVE_SUBSCRIBERS = Gauge('obd_live_subscribers', "Dashboards subscribed to the live feed")
+USER_CACHE_HITS = Counter('obd_user_cache_hits_total', "user_exists answers served from the cache")
+USER_CACHE_MISSES = Counter('obd_user_cache_misses_total', "user_exists answers looked up in the database")
+LOOP_LAG_SECONDS = Histogram('obd_event_loop_lag_seconds', "How late the event loop woke up a sleeping task")
+
+# Serve GET /metrics over plain HTTP/1.0 on the running loop
+async def _handle_metrics_request(reader, writer, registry):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()).strip():
+            pass  # Headers are not needed
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, body = '200 OK', registry.render().encode('utf-8')
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        else:
+            status, body, content_type = '404 Not Found', b'Not found\n', 'text/plain'
+        writer.write(f"HTTP/1.0 {status}\r\nContent-Type: {content_type}\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('latin-1') + body)
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+# Function to start the /metrics endpoint; returns the asyncio server
+async def start_metrics_server(host, port, registry=REGISTRY):
+    return await asyncio.start_server(lambda reader, writer: _handle_metrics_request(reader, writer, registry),
+                                      host, port)
@@ -0,0 +1,86 @@
+import numpy as np
+
+from obd_storage import METRIC_COLUMNS, connection, get_table_version
+
+# In-memory copy of norm_ranges laid out as two arrays aligned with METRIC_COLUMNS,
+# so checking a frame is one vectorized comparison instead of a query per metric.
+# Metrics without a configured range get (-inf, inf) and therefore never trigger.
+# The detection rules (see NORM_RULE_COLUMNS) are kept the same way, as
+# (hysteresis, min_duration_ms, max_rate) arrays with max_rate inf when unset.
+class NormRangeCache:
+    def __init__(self, db_path=None):
+        self.db_path = db_path
+        self.version = None
+        self.reloads = 0
+        self._bounds = (
+            np.full(len(METRIC_COLUMNS), -np.inf),
+            np.full(len(METRIC_COLUMNS), np.inf)
+        )
+        self._rules = (
+            np.zeros(len(METRIC_COLUMNS)),
+            np.zeros(len(METRIC_COLUMNS)),
+            np.full(len(METRIC_COLUMNS), np.inf)
+        )
+
+    # Reload every range from the database (blocking, run it on the DB thread)
+    def load(self):
+        with connection(self.db_path) as conn:
+            version = get_table_version(conn, 'norm_ranges')
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT metric_name, min_value, max_value, hysteresis, min_duration_ms, max_rate
+                FROM norm_ranges
+            ''')
+            rows = cursor.fetchall()
+
+        mins = np.full(len(METRIC_COLUMNS), -np.inf)
+        maxs = np.full(len(METRIC_COLUMNS), np.inf)
+        hysteresis = np.zeros(len(METRIC_COLUMNS))
+        min_duration = np.zeros(len(METRIC_COLUMNS))
+        max_rate = np.full(len(METRIC_COLUMNS), np.inf)
+        for metric_name, min_value, max_value, margin, duration, rate in rows:
+            if metric_name in METRIC_COLUMNS:
+                index = METRIC_COLUMNS.index(metric_name)
+                mins[index] = -np.inf if min_value is None else min_value
+                maxs[index] = np.inf if max_value is None else max_value
+                hysteresis[index] = margin or 0
+                min_duration[index] = duration or 0
+                max_rate[index] = np.inf if rate is None else rate
+
+        # Swap whole tuples of arrays so readers never see a half-updated table
+        self._bounds = (mins, maxs)
+        self._rules = (hysteresis, min_duration, max_rate)
+        self.version = version
+        self.reloads += 1
+
+    # Reload only if norm_ranges changed since the last load (blocking)
+    def refresh_if_changed(self):
+        with connection(self.db_path) as conn:
+            version = get_table_version(conn, 'norm_ranges')
+        if version != self.version:
+            self.load()
+            return True
+        return False
+
+    # Function to get the normal range for a metric, or None if it has none
+    def get_norm_range(self, metric_name):
+        mins, maxs = self._bounds
+        index = METRIC_COLUMNS.index(metric_name)
+        if np.isneginf(mins[index]) and np.isposinf(maxs[index]):
+            return None
+        return float(mins[index]), float(maxs[index])
+
+    # Detection rules as (hysteresis, min_duration_ms, max_rate) arrays
+    def get_rules(self):
+        return self._rules
+
+    # Norm bounds as (mins, maxs) arrays
+    def get_bounds(self):
+        return self._bounds
+
+    # Boolean mask of out-of-norm values. `values` is aligned with METRIC_COLUMNS (or
+    # is an (n, len(METRIC_COLUMNS)) array of frames); NaN marks a missing metric and
+    # never counts as out of norm.
+    def out_of_norm_mask(self, values):
+        mins, maxs = self._bounds
+        return (values < mins) | (values > maxs)
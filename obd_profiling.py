@@ -0,0 +1,211 @@
+import functools
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import nullcontext
+
+# Opt-in sampling profiler (--profile / OBD_PROFILE). A background thread looks at
+# the stack of every thread that is inside a profiled section (a frame handled by
+# obd_websocket, a refresh of the dashboard) and counts each distinct stack.
+# Every PROFILE_DUMP_INTERVAL seconds the counts are written out and reset:
+#   <name>-<pid>-<time>.collapsed  one "section;outer;...;inner count" line per
+#                                  stack, the input of flamegraph.pl / speedscope
+#   <name>-<pid>-<time>.txt        the PROFILE_TOP_N functions by own and total samples
+# The daemon toggles profiling with SIGUSR2, so a running process can be profiled
+# for a while and then left alone.
+#
+# Sections only mark a thread as interesting; samples show whatever it runs at that
+# moment. On the daemon's event loop that includes the wait for the next event
+# (the selector), and other tasks that run while a frame's handler is suspended.
+
+# Directory the profiles are written to (--profile-dir)
+PROFILE_DIR = 'obd_profiles'
+
+# Seconds between dumps of the collected samples (--profile-interval)
+PROFILE_DUMP_INTERVAL = 60
+
+# Seconds between two samples; every sample costs a walk of each profiled stack
+PROFILE_SAMPLE_INTERVAL = 0.005
+
+# Functions listed in each summary
+PROFILE_TOP_N = 30
+
+# Shared no-op section used while profiling is off
+_NOT_PROFILED = nullcontext()
+
+# Function to get the "name (file:line)" label of a code object
+def _frame_label(code):
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+# Marks the calling thread as profiled until the block exits. Handlers running
+# interleaved on one event loop share the mark.
+class _Section:
+    __slots__ = ('sampler', 'label', 'thread_id')
+
+    def __init__(self, sampler, label):
+        self.sampler = sampler
+        self.label = label
+
+    def __enter__(self):
+        self.thread_id = threading.get_ident()
+        active = self.sampler.active.get(self.thread_id)
+        if active is None:
+            self.sampler.active[self.thread_id] = [self.label, 1]
+        else:
+            active[1] += 1
+
+    def __exit__(self, *exc_info):
+        active = self.sampler.active.get(self.thread_id)
+        if active is not None:
+            active[1] -= 1
+            if active[1] <= 0:
+                del self.sampler.active[self.thread_id]
+        return False
+
+class StackSampler:
+    def __init__(self, name, out_dir=None, dump_interval=None, interval=PROFILE_SAMPLE_INTERVAL,
+                 top_n=PROFILE_TOP_N):
+        self.name = name
+        self.out_dir = out_dir
+        self.dump_interval = dump_interval
+        self.interval = interval
+        self.top_n = top_n
+        # Thread id -> [section label, nesting depth] of the profiled threads
+        self.active = {}
+        self.counts = Counter()
+        self.samples = 0
+        self.window_start = None
+        self._labels = {}
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    # Function to profile the enclosed block: `with profiler.section('name'): ...`
+    def section(self, label):
+        if self._thread is None:
+            return _NOT_PROFILED
+        return _Section(self, label)
+
+    # Decorator form of section(): profile every call of the function
+    def profiled(self, label):
+        def decorate(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.section(label):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def start(self):
+        if self._thread is not None:
+            return self
+        self.out_dir = self.out_dir or PROFILE_DIR
+        self.dump_interval = self.dump_interval or PROFILE_DUMP_INTERVAL
+        os.makedirs(self.out_dir, exist_ok=True)
+        self.counts.clear()
+        self.samples = 0
+        self.window_start = time.time()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=f'obd-profiler-{self.name}', daemon=True)
+        self._thread.start()
+        print(f"Profiling {self.name} into {self.out_dir}/ every {self.dump_interval}s")
+        return self
+
+    # Function to stop sampling and dump what was collected since the last dump
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.active.clear()
+        self.dump()
+        print(f"Stopped profiling {self.name}")
+
+    def toggle(self):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def _run(self):
+        next_dump = time.monotonic() + self.dump_interval
+        while not self._stop.wait(self.interval):
+            self.sample()
+            if time.monotonic() >= next_dump:
+                self.dump()
+                next_dump = time.monotonic() + self.dump_interval
+
+    # Function to take one sample of every profiled thread
+    def sample(self):
+        if not self.active:
+            return
+        frames = sys._current_frames()
+        for thread_id, (label, _) in list(self.active.items()):
+            frame = frames.get(thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                name = self._labels.get(code)
+                if name is None:
+                    name = self._labels[code] = _frame_label(code)
+                stack.append(name)
+                frame = frame.f_back
+            stack.append(label)
+            stack.reverse()
+            self.counts[';'.join(stack)] += 1
+            self.samples += 1
+
+    # Function to write the samples since the last dump and start a new window.
+    # Returns the path of the collapsed stacks, or None when nothing was sampled.
+    def dump(self):
+        counts, samples, window_start = self.counts, self.samples, self.window_start
+        self.counts, self.samples, self.window_start = Counter(), 0, time.time()
+        if not samples:
+            return None
+
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(window_start))
+        base = os.path.join(self.out_dir, f'{self.name}-{os.getpid()}-{stamp}')
+        with open(base + '.collapsed', 'w') as f:
+            for stack, count in counts.most_common():
+                f.write(f'{stack} {count}\n')
+        with open(base + '.txt', 'w') as f:
+            f.write(format_summary(counts, samples, time.time() - window_start, self.interval, self.top_n))
+        return base + '.collapsed'
+
+# Function to summarise collapsed stack counts: samples per section, then the top_n
+# functions by own samples (on top of the stack) and by total samples (anywhere on it)
+def format_summary(counts, samples, seconds, interval, top_n=PROFILE_TOP_N):
+    sections, own, total = Counter(), Counter(), Counter()
+    for stack, count in counts.items():
+        frames = stack.split(';')
+        sections[frames[0]] += count
+        own[frames[-1]] += count
+        for name in set(frames[1:]):
+            total[name] += count
+
+    lines = [f"{samples} samples every {interval * 1000:g} ms over {seconds:.1f} s", ""]
+    lines += [f"{100 * count / samples:6.1f}%  {section}" for section, count in sections.most_common()]
+    for title, ranked in (("own", own), ("total", total)):
+        lines += ["", f"Top {top_n} functions by {title} samples", "  own %  total %  function"]
+        lines += [
+            f"{100 * own[name] / samples:6.1f}%  {100 * total[name] / samples:6.1f}%  {name}"
+            for name, _ in ranked.most_common(top_n)
+        ]
+    return '\n'.join(lines) + '\n'
+
+# One sampler per name and process, so Streamlit reruns keep profiling into the same one
+_samplers = {}
+
+def get_profiler(name):
+    sampler = _samplers.get(name)
+    if sampler is None:
+        sampler = _samplers[name] = StackSampler(name)
+    return sampler
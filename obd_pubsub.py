@@ -0,0 +1,187 @@
+import json
+import threading
+import time
+from collections import defaultdict, deque
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+import websockets
+from websockets.sync.client import connect
+
+# Path of the daemon's subscription endpoint, e.g. ws://localhost:8765/subscribe?user_id=1
+SUBSCRIBE_PATH = '/subscribe'
+
+# URI dashboards subscribe to for live updates
+LIVE_FEED_URI = 'ws://localhost:8765' + SUBSCRIBE_PATH
+
+# Messages a shared feed keeps for readers that have not caught up yet
+SHARED_FEED_BUFFER = 1000
+
+# Seconds a shared feed waits before subscribing again while the daemon is
+# unreachable, and at most per attempt, so readers are never held up for long
+SHARED_FEED_RETRY_INTERVAL = 5
+SHARED_FEED_CONNECT_TIMEOUT = 0.5
+
+# Seconds a poll waits for each further message once one arrived. The client
+# hands received messages over one at a time, through its reader thread, so the
+# next one is rarely ready immediately even when it is already buffered.
+LIVE_FEED_DRAIN_TIMEOUT = 0.01
+
+# Messages published to subscribers of one vehicle:
+#   {"type": "samples", "user_id": 1, "rows": [[ts, battery_voltage, ..., maf_rate], ...]}
+#   {"type": "out_of_norm", "user_id": 1, "events": [[id, metric_name, value, ts, min, max], ...]}
+#   {"type": "anomaly", "user_id": 1, "events": [[metric_name, value, ts, kind, score], ...]}
+# ts is epoch milliseconds and metrics follow METRIC_COLUMNS, null when not reported;
+# id is the row id of the out-of-norm log.
+
+# Function to get the user_id a subscription request asks for, or None
+def parse_subscription(path):
+    url = urlsplit(path)
+    if url.path != SUBSCRIBE_PATH:
+        return None
+    values = parse_qs(url.query).get('user_id')
+    if not values:
+        return None
+    try:
+        return int(values[0])
+    except ValueError:
+        return None
+
+# Daemon side: fans accepted frames and out-of-norm events out to the dashboards
+# subscribed to each vehicle. Messages are only serialized when someone listens,
+# and websockets.broadcast never waits on a slow subscriber.
+class PubSubHub:
+    def __init__(self):
+        self._subscribers = defaultdict(set)
+
+    def subscribe(self, user_id, websocket):
+        self._subscribers[user_id].add(websocket)
+
+    def unsubscribe(self, user_id, websocket):
+        subscribers = self._subscribers.get(user_id)
+        if subscribers is not None:
+            subscribers.discard(websocket)
+            if not subscribers:
+                del self._subscribers[user_id]
+
+    def subscriber_count(self):
+        return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def has_subscribers(self, user_id):
+        return user_id in self._subscribers
+
+    def publish(self, user_id, message):
+        subscribers = self._subscribers.get(user_id)
+        if subscribers:
+            websockets.broadcast(subscribers, json.dumps(message))
+
+    # Publish a decoded frame (epoch ms array and samples aligned with METRIC_COLUMNS)
+    def publish_samples(self, user_id, timestamps, samples):
+        if not self.has_subscribers(user_id):
+            return
+        values = np.where(np.isnan(samples), None, samples).tolist()
+        self.publish(user_id, {
+            "type": "samples",
+            "user_id": user_id,
+            "rows": [[ts] + row for ts, row in zip(timestamps.tolist(), values)]
+        })
+
+    # Publish out-of-norm events as [id, metric_name, value, ts, min, max] lists
+    def publish_out_of_norm(self, user_id, events):
+        if events and self.has_subscribers(user_id):
+            self.publish(user_id, {"type": "out_of_norm", "user_id": user_id, "events": events})
+
+    # Publish anomalies as [metric_name, value, ts, kind, score] lists
+    def publish_anomalies(self, user_id, anomalies):
+        if anomalies and self.has_subscribers(user_id):
+            self.publish(user_id, {"type": "anomaly", "user_id": user_id, "events": [list(a) for a in anomalies]})
+
+# Dashboard side: a blocking subscription to one vehicle's live updates
+class LiveFeed:
+    def __init__(self, user_id, uri=None):
+        self.url = f"{uri or LIVE_FEED_URI}?user_id={user_id}"
+        self._websocket = None
+
+    @property
+    def connected(self):
+        return self._websocket is not None
+
+    # Try to subscribe; returns False (and stays disconnected) if the daemon is unreachable
+    def connect(self, timeout=2):
+        try:
+            try:
+                self._websocket = connect(self.url, open_timeout=timeout)
+            except websockets.InvalidStatus as e:
+                # A sharded daemon redirects subscriptions to its aggregator
+                location = e.response.headers.get('Location')
+                if location is None or not 300 <= e.response.status_code < 400:
+                    raise
+                self._websocket = connect(location, open_timeout=timeout)
+        except (OSError, TimeoutError, websockets.InvalidHandshake, websockets.InvalidURI):
+            self._websocket = None
+        return self.connected
+
+    # Wait up to `timeout` seconds for the next message, then drain every message
+    # already received. Returns the decoded messages (empty on timeout).
+    def poll(self, timeout):
+        messages = []
+        try:
+            messages.append(json.loads(self._websocket.recv(timeout=timeout)))
+            while True:
+                messages.append(json.loads(self._websocket.recv(timeout=LIVE_FEED_DRAIN_TIMEOUT)))
+        except TimeoutError:
+            pass
+        except websockets.ConnectionClosed:
+            self.close()
+        return messages
+
+    def close(self):
+        if self._websocket is not None:
+            self._websocket.close()
+            self._websocket = None
+
+# Dashboard side: one subscription to a vehicle shared by every reader in the
+# process, e.g. all the browser sessions watching it. Messages are numbered and
+# buffered; each reader passes the number of the last message it saw and gets
+# the ones after it, without waiting.
+class SharedLiveFeed:
+    def __init__(self, user_id, uri=None, size=SHARED_FEED_BUFFER):
+        self._feed = LiveFeed(user_id, uri)
+        self._messages = deque(maxlen=size)
+        self._last = 0
+        self._next_connect = 0.0
+        self._lock = threading.Lock()
+        # Number of the current subscription; it changes whenever the feed resubscribes
+        self.generation = 0
+
+    # Function to subscribe again if needed and buffer the messages received so far
+    def _refresh(self):
+        if not self._feed.connected:
+            if time.monotonic() < self._next_connect:
+                return
+            if not self._feed.connect(timeout=SHARED_FEED_CONNECT_TIMEOUT):
+                self._next_connect = time.monotonic() + SHARED_FEED_RETRY_INTERVAL
+                return
+            self.generation += 1
+            self._messages.clear()
+        for message in self._feed.poll(timeout=0):
+            self._last += 1
+            self._messages.append((self._last, message))
+
+    # Function to read the messages after number `after` of subscription `generation`.
+    # Returns (messages, last, generation): generation is None while the daemon is
+    # unreachable, and messages is None when the reader has to read the database
+    # instead, because it is new, fell behind the buffer or the feed resubscribed.
+    def read(self, after, generation):
+        with self._lock:
+            self._refresh()
+            if not self._feed.connected:
+                return None, self._last, None
+            missed = self._messages and after < self._messages[0][0] - 1
+            if generation != self.generation or missed:
+                return None, self._last, self.generation
+            return [message for number, message in self._messages if number > after], self._last, self.generation
+
+    def close(self):
+        with self._lock:
+            self._feed.close()
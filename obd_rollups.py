@@ -0,0 +1,230 @@
+import numpy as np
+import pandas as pd
+
+from obd_archive import read_obd_data
+from obd_hot_store import open_hot_store
+from obd_storage import METRIC_COLUMNS, ROLLUP_COLUMNS, ROLLUP_TABLES, connection, init_db
+
+# Seconds between compaction passes of the daemon
+ROLLUP_INTERVAL = 5
+
+# Raw rows read from obd_data per compaction pass, which bounds how long one pass
+# holds the database thread
+ROLLUP_CHUNK_ROWS = 20000
+
+# Touched buckets further apart than this are recomputed with separate range
+# queries, so one late sample does not re-read everything in between
+ROLLUP_RUN_GAP = 60
+
+# Most points (timestamps) sent for a long-range chart, shared by all metrics
+# (--chart-points)
+CHART_POINTS = 500
+
+# Spans up to this long are read from raw obd_data; longer spans use the finest
+# rollup table with at most ROLLUP_ROWS_PER_POINT rows per chart point
+RAW_MAX_SPAN_MS = 5 * 60 * 1000
+ROLLUP_ROWS_PER_POINT = 10
+
+# Function to aggregate raw (ts, *metrics) rows into buckets of `bucket_ms`
+def rollup_raw(frame, bucket_ms):
+    buckets = frame['ts'] // bucket_ms * bucket_ms
+    grouped = frame[METRIC_COLUMNS].groupby(buckets)
+    result = grouped.agg(['min', 'max', 'mean', 'last'])
+    result.columns = [f'{metric}_{aggregate}' for metric, aggregate in result.columns]
+    result.insert(0, 'samples', grouped.size())
+    return result[['samples'] + ROLLUP_COLUMNS]
+
+# Function to aggregate rows of a finer rollup table into buckets of `bucket_ms`.
+# Means are weighted by sample count, skipping buckets where the metric was missing.
+def rollup_rollups(frame, bucket_ms):
+    buckets = frame['ts'] // bucket_ms * bucket_ms
+    grouped = frame.groupby(buckets)
+    result = pd.DataFrame({'samples': grouped['samples'].sum()})
+    for metric in METRIC_COLUMNS:
+        mean = frame[f'{metric}_mean']
+        weight = frame['samples'].where(mean.notna())
+        result[f'{metric}_min'] = grouped[f'{metric}_min'].min()
+        result[f'{metric}_max'] = grouped[f'{metric}_max'].max()
+        result[f'{metric}_mean'] = ((mean * weight).groupby(buckets).sum(min_count=1)
+                                    / weight.groupby(buckets).sum())
+        result[f'{metric}_last'] = grouped[f'{metric}_last'].last()
+    return result
+
+# Function to split sorted bucket starts into runs that are read with one range query
+def bucket_runs(buckets, bucket_ms):
+    breaks = np.flatnonzero(np.diff(buckets) > ROLLUP_RUN_GAP * bucket_ms) + 1
+    return np.split(buckets, breaks)
+
+# Function to read the rows a rollup bucket range is computed from. Raw rows may
+# already be archived when a late sample lands in an old bucket, so raw reads go
+# through the archive as well.
+def read_rollup_source(conn, source, user_id, start_ts, end_ts):
+    if source == 'obd_data':
+        return read_obd_data(conn, user_id, start_ts, end_ts).drop(columns='id')
+    columns = ['samples'] + ROLLUP_COLUMNS
+    return pd.read_sql_query(f'''
+        SELECT ts, {', '.join(columns)}
+        FROM {source}
+        WHERE user_id = ? AND ts >= ? AND ts < ?
+        ORDER BY ts
+    ''', conn, params=(user_id, int(start_ts), int(end_ts)),
+        dtype={column: np.float64 for column in columns})
+
+# Function to replace rollup rows with freshly aggregated ones
+def write_rollups(conn, table, user_id, result):
+    values = result.astype(object).where(result.notna(), None)
+    conn.executemany(f'''
+        INSERT OR REPLACE INTO {table} (user_id, ts, samples, {', '.join(ROLLUP_COLUMNS)})
+        VALUES (?, ?, ?, {', '.join('?' * len(ROLLUP_COLUMNS))})
+    ''', [(user_id, int(ts), *row) for ts, *row in values.itertuples()])
+
+# Fold obd_data rows inserted since the last pass into every rollup table (blocking,
+# run it on the DB thread). Each bucket touched by a new row is recomputed from the
+# next finer level, so late and out-of-order samples are handled too. Returns the
+# number of raw rows consumed; a full chunk means more are waiting.
+def compact(db_path=None, chunk_rows=ROLLUP_CHUNK_ROWS):
+    with connection(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT last_id FROM rollup_state WHERE source = 'obd_data'
+        ''')
+        result = cursor.fetchone()
+        last_id = result[0] if result else 0
+
+        cursor.execute('''
+            SELECT id, user_id, ts FROM obd_data
+            WHERE id > ? AND ts IS NOT NULL
+            ORDER BY id
+            LIMIT ?
+        ''', (last_id, chunk_rows))
+        rows = cursor.fetchall()
+        if not rows:
+            return 0
+
+        new_rows = pd.DataFrame(rows, columns=['id', 'user_id', 'ts'])
+        touched = {user_id: group['ts'].to_numpy() for user_id, group in new_rows.groupby('user_id')}
+
+        source, aggregate = 'obd_data', rollup_raw
+        for table, bucket_ms in ROLLUP_TABLES.items():
+            for user_id, timestamps in touched.items():
+                buckets = np.unique(timestamps // bucket_ms * bucket_ms)
+                for run in bucket_runs(buckets, bucket_ms):
+                    frame = read_rollup_source(conn, source, user_id, run[0], run[-1] + bucket_ms)
+                    if not frame.empty:
+                        write_rollups(conn, table, user_id, aggregate(frame, bucket_ms))
+                touched[user_id] = buckets
+            source, aggregate = table, rollup_rollups
+
+        cursor.execute('''
+            INSERT OR REPLACE INTO rollup_state (source, last_id) VALUES ('obd_data', ?)
+        ''', (rows[-1][0],))
+        conn.commit()
+    return len(rows)
+
+# Function to pick the table to chart a time span from: ('obd_data', None) for
+# short spans, else (rollup table, bucket width in ms)
+def choose_resolution(span_ms, points=None):
+    points = points or CHART_POINTS
+    if span_ms <= RAW_MAX_SPAN_MS:
+        return 'obd_data', None
+    for table, bucket_ms in ROLLUP_TABLES.items():
+        if span_ms / bucket_ms <= points * ROLLUP_ROWS_PER_POINT:
+            break
+    return table, bucket_ms
+
+# Function to get a user's metrics between two epoch ms times as a DataFrame with
+# a ts column and one column per metric (bucket means when read from a rollup),
+# at the resolution that fits the span. Raw reads come straight from the daemon's
+# memory-mapped hot store when it covers the span, else from SQLite and the archive.
+def get_metric_history(user_id, start_ts, end_ts, points=None, db_path=None):
+    table, _ = choose_resolution(end_ts - start_ts, points)
+    if table == 'obd_data':
+        hot_store = open_hot_store(user_id)
+        window = hot_store.range(start_ts, end_ts) if hot_store is not None else None
+        if window is not None:
+            return pd.DataFrame(window).astype({metric: np.float64 for metric in METRIC_COLUMNS})
+
+    with connection(db_path) as conn:
+        if table == 'obd_data':
+            return read_obd_data(conn, user_id, start_ts, end_ts).drop(columns='id')
+        return pd.read_sql_query(f'''
+            SELECT ts, {', '.join(f'{metric}_mean AS {metric}' for metric in METRIC_COLUMNS)}
+            FROM {table}
+            WHERE user_id = ? AND ts >= ? AND ts < ?
+            ORDER BY ts
+        ''', conn, params=(user_id, int(start_ts), int(end_ts)),
+            dtype={metric: np.float64 for metric in METRIC_COLUMNS})
+
+# Largest-Triangle-Three-Buckets: indices of `threshold` points of (x, y) that keep
+# the visual shape of the line. The first and last points are always kept; below
+# 3 points there is no shape left to keep, so the extremes are kept instead.
+def lttb_indices(x, y, threshold):
+    n = len(x)
+    if threshold >= n:
+        return np.arange(n)
+    if threshold == 1:
+        return np.array([np.argmax(np.abs(y - y.mean()))])
+    if threshold == 2:
+        return np.unique([np.argmin(y), np.argmax(y)])
+
+    every = (n - 2) / (threshold - 2)
+    indices = np.empty(threshold, dtype=np.int64)
+    indices[0], indices[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+
+        # Pick the point forming the largest triangle with the previously chosen
+        # point and the average of the next bucket
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        indices[i + 1] = a
+    return indices
+
+# Function to split `budget` rows over metrics in proportion to their counts of
+# reported values; rows left over by rounding down go to the largest remainders
+def split_budget(budget, counts):
+    total = int(counts.sum())
+    if total == 0:
+        return np.zeros(len(counts), dtype=np.int64)
+    shares, remainders = np.divmod(budget * counts, total)
+    leftover = budget - int(shares.sum())
+    shares[np.argsort(-remainders, kind='stable')[:leftover]] += 1
+    return shares
+
+# Function to downsample a history frame to at most `points` rows. The first and
+# last rows are always kept; each metric picks its LTTB points out of its share of
+# the rest and the rows kept are the union of them, so every metric is drawn on
+# one time axis and still keeps its own peaks. Missing values stay NaN.
+def downsample(history, points=None):
+    points = points or CHART_POINTS
+    if len(history) <= points:
+        return history.reset_index(drop=True)
+
+    x = history['ts'].to_numpy(dtype=np.float64)
+    keep = [np.array([0, len(history) - 1])[-points:]]
+    valid = [np.flatnonzero(history[metric].notna().to_numpy()) for metric in METRIC_COLUMNS]
+    shares = split_budget(max(points - 2, 0), np.array([len(indices) for indices in valid]))
+    for metric, indices, share in zip(METRIC_COLUMNS, valid, shares):
+        if share:
+            y = history[metric].to_numpy(dtype=np.float64)[indices]
+            keep.append(indices[lttb_indices(x[indices], y, share)])
+    return history.iloc[np.unique(np.concatenate(keep))].reset_index(drop=True)
+
+if __name__ == "__main__":
+    # Build rollups for everything already stored in obd_data
+    # (obd_config imports this module, hence the late import)
+    from obd_config import apply_config, parse_args
+    apply_config(parse_args("Build the rollup tables from obd_data."))
+    init_db()
+    total = 0
+    while True:
+        consumed = compact()
+        total += consumed
+        if consumed < ROLLUP_CHUNK_ROWS:
+            break
+    print(f"Rolled up {total} rows of obd_data")
@@ -0,0 +1,360 @@
+import asyncio
+import glob
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import weakref
+from functools import partial
+from itertools import count
+from http import HTTPStatus
+
+import websockets
+
+import car_digital_twin_ws_daemon as daemon
+from obd_config import DEFAULT_AGGREGATOR_PORT, apply_config
+from obd_metrics import AGGREGATOR_ERRORS
+from obd_profiling import StackSampler
+from obd_pubsub import SUBSCRIBE_PATH
+from obd_storage import close_all
+from obd_vehicle_stats import STATS_CHECKPOINT, save_checkpoint
+from obd_wire import SUBPROTOCOLS
+
+# Sharded mode: --workers ingest processes accept vehicles on the same port
+# (SO_REUSEPORT, so the kernel spreads connections across them), decode their
+# frames, check their users and acknowledge them. Every valid frame is passed over
+# one queue to the aggregator in the supervising process, which runs the stateful
+# checks (detection and rolling statistics) and is the only process that writes
+# SQLite and the hot store. A vehicle that reconnects may land on any worker, but
+# its state stays in one place. The aggregator sends each frame's warnings back
+# to the worker holding the connection, so they follow the frame's ack. It also
+# serves the live feed; workers redirect /subscribe requests to it. The
+# supervisor's /metrics cover checks and storage (commits, writer queue); worker N
+# serves the frame path metrics of its own connections on --metrics-port + 1 + N.
+# SIGUSR2 toggles the profiling of every worker.
+
+# Port the aggregator serves live feed subscriptions on (--aggregator-port)
+AGGREGATOR_PORT = DEFAULT_AGGREGATOR_PORT
+
+# Frames in flight between the workers and the aggregator before workers wait
+SHARD_QUEUE_SIZE = 10000
+
+# Seconds a stopping worker gets to close its connections and hand over its frames
+DRAIN_TIMEOUT = 15
+
+# Seconds of DRAIN_TIMEOUT a worker waits for its vehicles to go quiet; the
+# connections still open then are closed right away
+CONNECTION_DRAIN_TIMEOUT = 10
+
+# Most frames the aggregator drains from the queue and hands to its event loop at once
+AGGREGATOR_BATCH_FRAMES = 500
+
+# Seconds between checks for workers that died
+WORKER_CHECK_INTERVAL = 1
+
+# Worker processes start from a fresh interpreter rather than a fork of the
+# supervisor's running event loop
+_context = multiprocessing.get_context('spawn')
+
+# Queue of ('frame', route, user_id, timestamps, samples) and ('done', worker_id)
+# items read by the aggregator; `route` is a (process, connection) pair
+frames = None
+
+# Worker side: queue of (connection, warnings) items the aggregator sends back to
+# this worker process, and its number among every process the supervisor spawned
+replies = None
+process_number = None
+
+# Worker side: numbers of the open vehicle connections, both ways
+connections = weakref.WeakValueDictionary()
+connection_numbers = weakref.WeakKeyDictionary()
+_next_connection = count()
+
+# Function to get the checkpoint file of a worker. Workers of earlier versions kept
+# statistics of their own; their checkpoints are merged once and removed.
+def worker_checkpoint(worker_id):
+    base, extension = os.path.splitext(STATS_CHECKPOINT)
+    return f'{base}.{worker_id}{extension}'
+
+# Worker side: hand a valid frame to the aggregator, waiting while the queue is full
+async def forward_frame(websocket, user_id, timestamps, samples):
+    connection = connection_numbers.get(websocket)
+    if connection is None:
+        connection = connection_numbers[websocket] = next(_next_connection)
+        connections[connection] = websocket
+    item = ('frame', (process_number, connection), user_id, timestamps, samples)
+    while True:
+        try:
+            frames.put_nowait(item)
+            return
+        except queue.Full:
+            await asyncio.sleep(0.005)
+
+# Worker side: send the warnings of a checked frame, unless its vehicle is gone
+async def send_warnings(connection, warnings):
+    websocket = connections.get(connection)
+    if websocket is None:
+        return
+    try:
+        for warning in warnings:
+            await websocket.send(warning)
+    except websockets.ConnectionClosed:
+        pass
+
+# Worker side: thread that passes the aggregator's warnings to the event loop,
+# until it reads None
+def read_replies(loop):
+    while True:
+        item = replies.get()
+        if item is None:
+            return
+        asyncio.run_coroutine_threadsafe(send_warnings(*item), loop)
+
+# Worker side: answer live feed subscriptions with a redirect to the aggregator
+def redirect_subscriptions(host, path, request_headers):
+    if path.startswith(SUBSCRIBE_PATH):
+        location = f'ws://{host}:{AGGREGATOR_PORT}{path}'
+        return HTTPStatus.TEMPORARY_REDIRECT, [('Location', location)], b''
+    return None
+
+async def run_worker(worker_id, host, port):
+    daemon.HOST = host
+    daemon.frame_sink = forward_frame
+    await daemon.open_daemon(stores_frames=False)
+    background_tasks = daemon.start_background_tasks(checks_frames=False, stores_frames=False)
+    loop = asyncio.get_running_loop()
+    reader = threading.Thread(target=read_replies, args=(loop,), name='obd-replies', daemon=True)
+    reader.start()
+
+    # SIGTERM drains the worker: stop accepting, answer the frames vehicles already
+    # sent and close each connection with 1001 (going away) once it is quiet, then
+    # hand over and exit
+    stop = loop.create_future()
+    loop.add_signal_handler(signal.SIGTERM, stop.set_result, None)
+    loop.add_signal_handler(signal.SIGHUP, daemon.reload_norm_ranges)
+    loop.add_signal_handler(signal.SIGUSR2, daemon.profiler.toggle)
+
+    try:
+        async with websockets.serve(daemon.obd_websocket, host, port, subprotocols=SUBPROTOCOLS,
+                                    reuse_port=True, process_request=partial(redirect_subscriptions, host)) as server:
+            print(f"Worker {worker_id} (pid {os.getpid()}) accepting on ws://{host}:{port}")
+            await stop
+            # Only the listening socket closes here; new vehicles go to the other workers
+            server.server.close()
+            remaining = await daemon.drain_connections(CONNECTION_DRAIN_TIMEOUT)
+            if remaining:
+                print(f"Worker {worker_id} closing {remaining} connections that did not go quiet")
+    finally:
+        replies.put(None)
+        await daemon.close_daemon(background_tasks, checks_frames=False)
+
+# Entry point of a worker process; `config` is the supervisor's parsed command line
+def worker_main(worker_id, number, frame_queue, reply_queue, config):
+    global frames, replies, process_number, AGGREGATOR_PORT
+    frames, replies, process_number = frame_queue, reply_queue, number
+    apply_config(config)
+    AGGREGATOR_PORT = config.aggregator_port
+    # Each worker has its own metrics, on the ports after the supervisor's
+    daemon.metrics_port = config.metrics_port + 1 + worker_id if config.metrics_port else 0
+    # and profiles its frames into files of its own
+    daemon.profiler = StackSampler(f'worker-{worker_id}')
+    if config.profile:
+        daemon.profiler.start()
+
+    # Ctrl+C reaches every process of the group; only the supervisor acts on it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        asyncio.run(run_worker(worker_id, config.host, config.port))
+    finally:
+        daemon.profiler.stop()
+        close_all()
+        # Queued frames are flushed before the process exits, so this is the last item
+        frames.put(('done', worker_id))
+
+# Function to restore the aggregator's rolling statistics from its checkpoint and
+# merge in any worker checkpoints, which are removed once the merge is saved
+def restore_vehicle_stats():
+    daemon.vehicle_stats.load_checkpoint(daemon.stats_checkpoint)
+    merged = sorted(glob.glob(worker_checkpoint('*')))
+    for path in merged:
+        daemon.vehicle_stats.load_checkpoint(path)
+    if merged:
+        save_checkpoint(daemon.vehicle_stats.snapshot(), daemon.stats_checkpoint)
+        for path in merged:
+            os.remove(path)
+        print(f"Merged {len(merged)} worker checkpoints into {daemon.stats_checkpoint}")
+    if daemon.vehicle_stats.slots:
+        print(f"Restored statistics of {len(daemon.vehicle_stats.slots)} vehicles")
+
+# Supervisor and aggregator: runs the workers and stores what they check
+class Supervisor:
+    def __init__(self, config):
+        self.config = config
+        self.workers = config.workers
+        self.host = config.host
+        self.port = config.port
+        self.frames = _context.Queue(SHARD_QUEUE_SIZE)
+        self.processes = {}
+        self.stopping = False
+        self.restarts = 0
+        self.rolling = None
+        # Reply queue of every worker process still running, by process number
+        self.replies = {}
+        self.spawned = 0
+
+    def spawn(self, worker_id):
+        number, self.spawned = self.spawned, self.spawned + 1
+        self.replies[number] = _context.Queue()
+        process = _context.Process(target=worker_main, args=(worker_id, number, self.frames, self.replies[number],
+                                                             self.config), name=f'obd-worker-{worker_id}')
+        process.number = number
+        process.start()
+        self.processes[worker_id] = process
+        return process
+
+    # Function to stop a worker gracefully, killing it if it does not drain in time
+    async def drain(self, process):
+        process.terminate()
+        await asyncio.to_thread(process.join, DRAIN_TIMEOUT)
+        if process.is_alive():
+            print(f"{process.name} did not drain within {DRAIN_TIMEOUT}s, killing it")
+            process.kill()
+            await asyncio.to_thread(process.join)
+        self.forget(process)
+
+    # Function to drop the reply queue of a worker process that exited, without
+    # waiting at exit for replies nobody reads any more
+    def forget(self, process):
+        replies = self.replies.pop(process.number, None)
+        if replies is not None:
+            replies.cancel_join_thread()
+
+    # Background task that replaces workers that died
+    async def watch_workers(self):
+        while not self.stopping:
+            await asyncio.sleep(WORKER_CHECK_INTERVAL)
+            for worker_id, process in list(self.processes.items()):
+                if not process.is_alive() and not self.stopping:
+                    print(f"{process.name} exited with code {process.exitcode}, restarting it")
+                    self.forget(process)
+                    self.restarts += 1
+                    self.spawn(worker_id)
+
+    # Restart the workers one at a time (SIGUSR1): the replacement starts accepting
+    # on the shared port before the old worker drains, so vehicles can reconnect
+    async def rolling_restart(self):
+        for worker_id in list(self.processes):
+            if self.stopping:
+                break
+            old = self.processes[worker_id]
+            self.spawn(worker_id)
+            await asyncio.sleep(WORKER_CHECK_INTERVAL)
+            await self.drain(old)
+        print("Rolling restart finished")
+
+    # Function to start a rolling restart unless one is still running
+    def start_rolling_restart(self):
+        if self.rolling is None or self.rolling.done():
+            self.rolling = asyncio.ensure_future(self.rolling_restart())
+
+    # Function to pass a signal on to every running worker
+    def signal_workers(self, signum):
+        for process in self.processes.values():
+            if process.is_alive():
+                os.kill(process.pid, signum)
+
+    # Function to forward SIGHUP to the workers and reload the aggregator's ranges too
+    def reload_norm_ranges(self):
+        self.signal_workers(signal.SIGHUP)
+        daemon.reload_norm_ranges()
+
+    # Thread that feeds frames from the workers to the aggregator's event loop. It
+    # drains whatever the queue holds, up to AGGREGATOR_BATCH_FRAMES, and waits for
+    # the whole batch to be queued for writing, so a slow disk holds back the shared
+    # queue and, through it, the workers.
+    def read_frames(self, loop):
+        stopping = False
+        while not stopping:
+            items = [self.frames.get()]
+            while len(items) < AGGREGATOR_BATCH_FRAMES:
+                try:
+                    items.append(self.frames.get_nowait())
+                except queue.Empty:
+                    break
+
+            batch = []
+            for item in items:
+                if item[0] == 'frame':
+                    batch.append(item[1:])
+                elif item[0] == 'done':
+                    print(f"Worker {item[1]} drained")
+                elif item[0] == 'stop':
+                    stopping = True
+            if batch:
+                asyncio.run_coroutine_threadsafe(self.record_frames(batch), loop).result()
+
+    # Function to check and record a batch of frames in order, sending their
+    # warnings back to the worker holding the connection. A frame that fails is
+    # reported and skipped; the reader has to keep draining the queue or every
+    # worker stalls.
+    async def record_frames(self, batch):
+        for (number, connection), user_id, timestamps, samples in batch:
+            try:
+                out_of_norm, anomalies = daemon.check_frame(user_id, timestamps, samples)
+                await daemon.record_frame(user_id, timestamps, samples, out_of_norm, anomalies)
+                warnings = daemon.frame_warnings(samples, out_of_norm, anomalies)
+                if warnings and number in self.replies:
+                    self.replies[number].put_nowait((connection, warnings))
+            except Exception as e:
+                AGGREGATOR_ERRORS.inc()
+                print(f"Failed to record a frame of user {user_id}: {e!r}")
+
+    async def run(self):
+        daemon.HOST, daemon.metrics_port = self.host, self.config.metrics_port
+        await daemon.open_daemon()
+        restore_vehicle_stats()
+        background_tasks = daemon.start_background_tasks()
+        loop = asyncio.get_running_loop()
+        reader = threading.Thread(target=self.read_frames, args=(loop,), name='obd-aggregator', daemon=True)
+        reader.start()
+
+        stop = loop.create_future()
+        loop.add_signal_handler(signal.SIGTERM, stop.set_result, None)
+        loop.add_signal_handler(signal.SIGINT, stop.set_result, None)
+        loop.add_signal_handler(signal.SIGHUP, self.reload_norm_ranges)
+        loop.add_signal_handler(signal.SIGUSR1, self.start_rolling_restart)
+        loop.add_signal_handler(signal.SIGUSR2, self.signal_workers, signal.SIGUSR2)
+
+        watcher = None
+        try:
+            async with websockets.serve(daemon.subscribe_websocket, self.host, AGGREGATOR_PORT):
+                for worker_id in range(self.workers):
+                    self.spawn(worker_id)
+                watcher = asyncio.create_task(self.watch_workers())
+                print(f"Supervisor (pid {os.getpid()}) started {self.workers} workers on "
+                      f"ws://{self.host}:{self.port}, live feed on ws://{self.host}:{AGGREGATOR_PORT}")
+                await stop
+        finally:
+            # Drain every worker, including one a rolling restart is retiring, then
+            # every frame they handed over, then the writer
+            self.stopping = True
+            print("Draining workers...")
+            drains = [self.drain(process) for process in self.processes.values()]
+            if self.rolling is not None:
+                drains.append(self.rolling)
+            await asyncio.gather(*drains)
+            self.frames.put(('stop',))
+            await asyncio.to_thread(reader.join)
+            if watcher is not None:
+                watcher.cancel()
+            await daemon.close_daemon(background_tasks)
+
+# Function to run the daemon as a supervisor of config.workers ingest processes
+def run_sharded(config):
+    global AGGREGATOR_PORT
+    AGGREGATOR_PORT = config.aggregator_port
+    try:
+        asyncio.run(Supervisor(config).run())
+    finally:
+        close_all()
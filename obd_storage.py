@@ -0,0 +1,415 @@
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from functools import lru_cache
+
+import bcrypt
+
+# Path of the SQLite database shared by the daemon and the dashboards
+DB_PATH = 'obd_data.db'
+
+# Pragmas applied to every pooled connection. WAL lets the dashboards read while
+# the daemon writes, and synchronous=NORMAL only fsyncs at checkpoints in WAL mode.
+PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -65536,  # Negative values are KiB, so this is a 64 MiB page cache
+    'temp_store': 'MEMORY',
+    'mmap_size': 268435456,
+    'busy_timeout': 5000,
+}
+
+# Number of compiled statements each connection keeps for reuse. sqlite3 caches
+# prepared statements by SQL text, so helpers that run the same query string on a
+# long-lived connection skip the parse/plan step after the first call.
+CACHED_STATEMENTS = 256
+
+# Maximum number of connections kept open per database file
+POOL_SIZE = 4
+
+# The OBD-II metric columns of obd_data, in storage order
+METRIC_COLUMNS = [
+    'battery_voltage', 'engine_load', 'rpm', 'coolant_temp',
+    'throttle_position', 'fuel_level', 'intake_pressure', 'maf_rate'
+]
+
+# Tables whose changes bump a counter in table_versions, so caches can cheaply
+# poll for changes instead of re-reading the table
+VERSIONED_TABLES = ['norm_ranges', 'users']
+
+# Seconds between polls of the table_versions counters by caches
+TABLE_VERSION_POLL_INTERVAL = 5
+
+# Rollup tables and the bucket width of each, in milliseconds. Each row holds the
+# min, max, mean and last value of every metric over one bucket for one user.
+ROLLUP_TABLES = {
+    'obd_rollup_1s': 1000,
+    'obd_rollup_1m': 60 * 1000,
+    'obd_rollup_1h': 60 * 60 * 1000
+}
+ROLLUP_AGGREGATES = ['min', 'max', 'mean', 'last']
+
+# Aggregate columns of a rollup table, e.g. rpm_min, rpm_max, rpm_mean, rpm_last
+ROLLUP_COLUMNS = [f'{metric}_{aggregate}' for metric in METRIC_COLUMNS for aggregate in ROLLUP_AGGREGATES]
+
+# Schema version kept in PRAGMA user_version
+#   1: "YYYY-MM-DD HH:MM:SS" TEXT timestamps (original layout)
+#   2: integer epoch-millisecond `ts` columns with (user_id, ts) indexes
+#   3: detection rule columns on norm_ranges
+SCHEMA_VERSION = 3
+
+# Detection rule columns of norm_ranges besides min_value/max_value:
+#   hysteresis       an excursion only ends once the value is back inside the range
+#                    by this margin (0 = as soon as it is back in range)
+#   min_duration_ms  an excursion is only reported once it has lasted this long
+#   max_rate         largest allowed change per second; faster changes count as
+#                    out of norm (NULL = no limit)
+NORM_RULE_COLUMNS = {
+    'hysteresis': 'REAL NOT NULL DEFAULT 0',
+    'min_duration_ms': 'INTEGER NOT NULL DEFAULT 0',
+    'max_rate': 'REAL'
+}
+
+# Text timestamp format of the original schema and of the simulators
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Function to open a new connection with the tuned pragmas applied
+def connect(db_path=None):
+    conn = sqlite3.connect(
+        db_path or DB_PATH,
+        cached_statements=CACHED_STATEMENTS,
+        check_same_thread=False
+    )
+    for name, value in PRAGMAS.items():
+        conn.execute(f'PRAGMA {name} = {value}')
+    return conn
+
+# Small pool of long-lived connections to one database file
+class ConnectionPool:
+    def __init__(self, db_path, size=POOL_SIZE):
+        self.db_path = db_path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._opened < self.size:
+                self._opened += 1
+                open_new = True
+            else:
+                open_new = False
+
+        if open_new:
+            try:
+                return connect(self.db_path)
+            except Exception:
+                with self._lock:
+                    self._opened -= 1
+                raise
+
+        # Every connection is checked out, wait for one to be returned
+        return self._idle.get()
+
+    def _release(self, conn):
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        try:
+            yield conn
+        except BaseException:
+            # Never hand a connection with a half-finished transaction to the next caller
+            conn.rollback()
+            raise
+        finally:
+            self._release(conn)
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._opened -= 1
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+# Function to get the shared pool for a database file
+def get_pool(db_path=None):
+    db_path = db_path or DB_PATH
+    with _pools_lock:
+        pool = _pools.get(db_path)
+        if pool is None:
+            pool = _pools[db_path] = ConnectionPool(db_path)
+    return pool
+
+# Function to borrow a pooled connection, e.g. `with connection() as conn:`
+def connection(db_path=None):
+    return get_pool(db_path).connection()
+
+# Function to read the change counter of a table listed in VERSIONED_TABLES
+def get_table_version(conn, table):
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT version FROM table_versions WHERE table_name = ?
+    ''', (table,))
+    result = cursor.fetchone()
+    return result[0] if result else None
+
+# Function to convert a local "YYYY-MM-DD HH:MM:SS" timestamp to epoch milliseconds.
+# Simulators repeat the same second many times, so recent answers are cached.
+@lru_cache(maxsize=4096)
+def timestamp_to_ms(timestamp):
+    return int(time.mktime(time.strptime(timestamp, TIMESTAMP_FORMAT)) * 1000)
+
+# Function to convert epoch milliseconds to a local datetime for display
+def ms_to_datetime(ts_ms):
+    return datetime.fromtimestamp(ts_ms / 1000)
+
+# Function to get the column names of a table (empty if it does not exist)
+def get_table_columns(conn, table):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+
+# Migrate obd_data and out_of_norm_logs from TEXT timestamps (schema 1) to integer
+# epoch milliseconds (schema 2) in place. Each table is copied into its new layout
+# inside one transaction, keeping row ids; local text times are converted with
+# SQLite's 'utc' modifier, which treats them as local time.
+def migrate_timestamps(conn):
+    tables = {
+        'obd_data': ['id', 'user_id'] + METRIC_COLUMNS,
+        'out_of_norm_logs': ['id', 'user_id', 'metric_name', 'value']
+    }
+    for table, columns in tables.items():
+        existing = get_table_columns(conn, table)
+        if 'timestamp' not in existing:
+            continue
+
+        print(f"Migrating {table} to epoch millisecond timestamps...")
+        kept = [column for column in columns if column in existing]
+        column_types = ', '.join(
+            f"{column} {'TEXT' if column == 'metric_name' else 'REAL'}" for column in columns[2:]
+        )
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(f'ALTER TABLE {table} RENAME TO {table}_v1')
+            conn.execute(f'''
+                CREATE TABLE {table} (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER,
+                    ts INTEGER,
+                    {column_types},
+                    FOREIGN KEY(user_id) REFERENCES users(id)
+                )
+            ''')
+            conn.execute(f'''
+                INSERT INTO {table} ({', '.join(kept)}, ts)
+                SELECT {', '.join(kept)}, CAST(strftime('%s', timestamp, 'utc') AS INTEGER) * 1000
+                FROM {table}_v1
+            ''')
+            conn.execute(f'DROP TABLE {table}_v1')
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+# Function to close every idle pooled connection (used on shutdown)
+def close_all():
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.close()
+
+# Function to hash a password with bcrypt. python-bcrypt, the one requirements.txt
+# pins, takes str; the bcrypt package takes bytes.
+def hash_password(password):
+    try:
+        return bcrypt.hashpw(password, bcrypt.gensalt())
+    except TypeError:
+        return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+
+# Initialize SQLite Database
+def init_db(db_path=None):
+    with connection(db_path) as conn:
+        cursor = conn.cursor()
+
+        # Create table for user authentication
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT UNIQUE,
+                password TEXT
+            )
+        ''')
+
+        # Rebuild tables still using TEXT timestamps before creating anything new
+        migrate_timestamps(conn)
+
+        # Create table for storing OBD-II data with more parameters
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS obd_data (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                ts INTEGER,
+                battery_voltage REAL,
+                engine_load REAL,
+                rpm REAL,
+                coolant_temp REAL,
+                throttle_position REAL,
+                fuel_level REAL,
+                intake_pressure REAL,
+                maf_rate REAL,
+                FOREIGN KEY(user_id) REFERENCES users(id)
+            )
+        ''')
+
+        # Create table for norm ranges
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS norm_ranges (
+                metric_name TEXT PRIMARY KEY,
+                min_value REAL,
+                max_value REAL
+            )
+        ''')
+
+        # Add the detection rule columns to tables created before schema 3
+        existing = get_table_columns(conn, 'norm_ranges')
+        for column, column_type in NORM_RULE_COLUMNS.items():
+            if column not in existing:
+                cursor.execute(f'ALTER TABLE norm_ranges ADD COLUMN {column} {column_type}')
+
+        # Create table for logging out-of-norm events
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS out_of_norm_logs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                metric_name TEXT,
+                value REAL,
+                ts INTEGER,
+                FOREIGN KEY(user_id) REFERENCES users(id)
+            )
+        ''')
+
+        # Create table for logging statistical anomalies (kind is 'zscore' or 'drift')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS anomaly_logs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                metric_name TEXT,
+                value REAL,
+                ts INTEGER,
+                kind TEXT,
+                score REAL,
+                FOREIGN KEY(user_id) REFERENCES users(id)
+            )
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_anomaly_logs_user_ts ON anomaly_logs (user_id, ts)
+        ''')
+
+        # Per-vehicle time range scans for the dashboards
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_obd_data_user_ts ON obd_data (user_id, ts)
+        ''')
+
+        # Per-vehicle "rows after/before id N" scans for incremental dashboard refresh
+        # and log paging. Index entries end with the rowid, so (user_id = ? AND id > ?)
+        # is a range scan here.
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_obd_data_user_id ON obd_data (user_id)
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_out_of_norm_logs_user_id ON out_of_norm_logs (user_id)
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_out_of_norm_logs_user_ts ON out_of_norm_logs (user_id, ts)
+        ''')
+
+        # Create rollup tables, keyed by user and bucket start time, and the table
+        # remembering how far the compactor has read obd_data
+        rollup_columns = ', '.join(f'{column} REAL' for column in ROLLUP_COLUMNS)
+        for table in ROLLUP_TABLES:
+            cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS {table} (
+                    user_id INTEGER,
+                    ts INTEGER,
+                    samples INTEGER,
+                    {rollup_columns},
+                    PRIMARY KEY (user_id, ts)
+                ) WITHOUT ROWID
+            ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS rollup_state (
+                source TEXT PRIMARY KEY,
+                last_id INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+
+        # Create table of change counters maintained by triggers
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS table_versions (
+                table_name TEXT PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+
+        for table in VERSIONED_TABLES:
+            cursor.execute('''
+                INSERT OR IGNORE INTO table_versions (table_name, version) VALUES (?, 0)
+            ''', (table,))
+            for event in ('INSERT', 'UPDATE', 'DELETE'):
+                cursor.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_version
+                    AFTER {event} ON {table}
+                    BEGIN
+                        UPDATE table_versions SET version = version + 1 WHERE table_name = '{table}';
+                    END
+                ''')
+
+        conn.commit()
+
+        # Create default admin account if not exists
+        cursor.execute('''
+            SELECT * FROM users WHERE username = ?
+        ''', ('admin',))
+        if cursor.fetchone() is None:
+            hashed_password = hash_password('boogy332!')
+            cursor.execute('''
+                INSERT INTO users (username, password)
+                VALUES (?, ?)
+            ''', ('admin', hashed_password))
+            conn.commit()
+            print("Admin account created with default credentials: username: admin, password: boogy332!")
+
+        # Insert default norm ranges if not exists
+        default_ranges = {
+            'battery_voltage': (12.5, 14.8),
+            'engine_load': (0, 100),
+            'rpm': (700, 6000),
+            'coolant_temp': (70, 120),
+            'throttle_position': (0, 100),
+            'fuel_level': (0, 100),
+            'intake_pressure': (20, 100),
+            'maf_rate': (0, 200)
+        }
+
+        cursor.executemany('''
+            INSERT OR IGNORE INTO norm_ranges (metric_name, min_value, max_value)
+            VALUES (?, ?, ?)
+        ''', [(metric, min_val, max_val) for metric, (min_val, max_val) in default_ranges.items()])
+
+        cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        conn.commit()
@@ -0,0 +1,64 @@
+import time
+from collections import OrderedDict
+
+from obd_storage import connection, get_table_version
+
+# Maximum number of user ids remembered
+USER_CACHE_SIZE = 10000
+
+# Seconds before a cached answer is looked up again
+USER_CACHE_TTL = 300
+
+# LRU/TTL cache of user_exists answers. Both valid and invalid ids are cached;
+# the whole cache is dropped whenever the users table changes, so a deleted user
+# stops being accepted within one poll of its version counter.
+class UserCache:
+    def __init__(self, db_path=None, max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.db_path = db_path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    # Cached answer for user_id, or None if it has to be looked up
+    def get(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is None or entry[1] < time.monotonic():
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, user_id, exists):
+        self._entries[user_id] = (exists, time.monotonic() + self.ttl)
+        self._entries.move_to_end(user_id)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id=None):
+        if user_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(user_id, None)
+
+    # Drop every entry if the users table changed since the last check (blocking)
+    def refresh_if_changed(self):
+        with connection(self.db_path) as conn:
+            version = get_table_version(conn, 'users')
+        changed = self.version is not None and version != self.version
+        self.version = version
+        if changed:
+            self.invalidate()
+        return changed
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size": len(self._entries)
+        }
@@ -0,0 +1,263 @@
+import os
+
+import numpy as np
+
+from obd_storage import METRIC_COLUMNS
+
+# File the daemon checkpoints every vehicle's baselines to, so restarts keep them
+STATS_CHECKPOINT = 'obd_vehicle_stats.npz'
+
+# Seconds between checkpoints
+STATS_CHECKPOINT_INTERVAL = 60
+
+# Smoothing factors of the fast and slow exponentially weighted mean/variance.
+# The fast pair tracks the current behaviour (~100 samples), the slow pair is the
+# vehicle's baseline (~5000 samples); drift is the gap between the two.
+EWMA_ALPHA = 0.01
+BASELINE_ALPHA = 0.0002
+
+# Samples a metric needs before it can be flagged
+STATS_WARMUP_SAMPLES = 200
+
+# A sample is anomalous when it is this many fast standard deviations from the
+# fast mean; a metric drifts when the fast mean is this many baseline standard
+# deviations from the baseline mean
+ZSCORE_THRESHOLD = 4.0
+DRIFT_THRESHOLD = 3.0
+
+# Each kind of anomaly is reported at most once per metric in this window
+ANOMALY_COOLDOWN_MS = 60 * 1000
+
+# Decayed histogram per metric for percentiles. Bins cover the value range of the
+# matching OBD-II PID; old samples fade out with a half-life of ~7000 samples.
+HISTOGRAM_BINS = 64
+HISTOGRAM_DECAY = 0.9999
+HISTOGRAM_RANGES = {
+    'battery_voltage': (0, 20),
+    'engine_load': (0, 100),
+    'rpm': (0, 8000),
+    'coolant_temp': (-40, 215),
+    'throttle_position': (0, 100),
+    'fuel_level': (0, 100),
+    'intake_pressure': (0, 255),
+    'maf_rate': (0, 655.35)
+}
+
+# Vehicles with room in the preallocated arrays before they are grown
+INITIAL_VEHICLES = 64
+
+# Longest run of samples folded in one closed-form step; longer frames are split
+# so the running products of the smoothing factors stay far from underflow
+STATS_BLOCK_SAMPLES = 256
+
+_LOWS = np.array([HISTOGRAM_RANGES[metric][0] for metric in METRIC_COLUMNS], dtype=np.float64)
+_WIDTHS = np.array([HISTOGRAM_RANGES[metric][1] - HISTOGRAM_RANGES[metric][0] for metric in METRIC_COLUMNS])
+
+# Arrays of per-vehicle state, one row (slot) per vehicle and one column per metric
+_STATE_ARRAYS = {
+    'count': np.int64,
+    'mean': np.float64,
+    'var': np.float64,
+    'baseline_mean': np.float64,
+    'baseline_var': np.float64,
+    'last_zscore_ts': np.int64,
+    'last_drift_ts': np.int64
+}
+
+# Smoothing factors of the (fast, baseline) pairs, which are updated together
+_ALPHAS = np.array([[EWMA_ALPHA], [BASELINE_ALPHA]])
+
+# Function to solve y[k] = c[k] * y[k - 1] + d[k] along the first axis, starting
+# from y[-1] = start. Returns every y[k]; c must not be 0.
+def _linear_recurrence(start, c, d):
+    if len(c) == 1:
+        return c * start + d
+    products = np.cumprod(c, axis=0)
+    return products * (start + np.cumsum(d / products, axis=0))
+
+# Streaming statistics of every vehicle and metric in preallocated arrays: O(1)
+# work per sample and a fixed ~2.5 KiB per vehicle, whatever it has sent. A frame
+# is folded in with array operations over all its samples at once.
+class VehicleStats:
+    def __init__(self, capacity=INITIAL_VEHICLES):
+        self.slots = {}
+        self.anomalies = 0
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        metrics = len(METRIC_COLUMNS)
+        self.state = {name: np.zeros((capacity, metrics), dtype=dtype) for name, dtype in _STATE_ARRAYS.items()}
+        self.histogram = np.zeros((capacity, metrics, HISTOGRAM_BINS), dtype=np.float32)
+
+    def _grow(self):
+        old_state, old_histogram = self.state, self.histogram
+        self._allocate(2 * len(old_histogram))
+        for name, values in old_state.items():
+            self.state[name][:len(values)] = values
+        self.histogram[:len(old_histogram)] = old_histogram
+
+    def _slot(self, user_id):
+        slot = self.slots.get(user_id)
+        if slot is None:
+            if len(self.slots) == len(self.histogram):
+                self._grow()
+            slot = self.slots[user_id] = len(self.slots)
+        return slot
+
+    # Fold a frame into the vehicle's statistics (epoch ms timestamps and samples
+    # aligned with METRIC_COLUMNS, NaN where missing). Returns the anomalies found
+    # as (sample index, metric index, kind, score) with kind 'zscore' or 'drift'.
+    def update(self, user_id, timestamps, samples):
+        slot = self._slot(user_id)
+        anomalies = []
+        for start in range(0, len(samples), STATS_BLOCK_SAMPLES):
+            end = start + STATS_BLOCK_SAMPLES
+            self._update_block(slot, timestamps[start:end], samples[start:end], start, anomalies)
+        anomalies.sort(key=lambda anomaly: anomaly[0])
+
+        # Decayed histograms: fade each metric once per sample it got, then add the frame
+        present = ~np.isnan(samples)
+        histogram = self.histogram[slot]
+        histogram *= (HISTOGRAM_DECAY ** present.sum(axis=0))[:, None].astype(np.float32)
+        sample_index, metric_index = np.nonzero(present)
+        bins = np.clip((samples[sample_index, metric_index] - _LOWS[metric_index]) / _WIDTHS[metric_index]
+                       * HISTOGRAM_BINS, 0, HISTOGRAM_BINS - 1).astype(np.int64)
+        histogram.reshape(-1)[:] += np.bincount(metric_index * HISTOGRAM_BINS + bins,
+                                                minlength=histogram.size).astype(np.float32)
+
+        self.anomalies += len(anomalies)
+        return anomalies
+
+    # Function to fold consecutive samples into a vehicle's mean/variance pairs and
+    # append the anomalies among them (sample indices are offset by `offset`)
+    def _update_block(self, slot, timestamps, samples, offset, anomalies):
+        state = self.state
+        present = ~np.isnan(samples)
+        seen = present.astype(np.float64)
+        values = np.where(present, samples, 0)[:, None]
+        counts = state['count'][slot] + seen.cumsum(axis=0)
+
+        # Incremental exponentially weighted mean and variance. Until a metric has
+        # seen 1 / alpha samples the plain running mean/variance is used instead,
+        # so young statistics are not biased towards the first sample. Each update
+        #   mean += step * delta
+        #   var = (1 - step) * (var + step * delta ** 2),  delta = value - mean
+        # is linear in the previous mean and variance, so the state after every
+        # sample of the block is solved at once, as (samples, pair, metrics) arrays.
+        # A metric's first sample (step 1) replaces the zero state, which the
+        # recurrence gets with a factor of 1. prior_* hold the state each sample is
+        # scored against, before it is folded in.
+        step = seen[:, None] * np.maximum(_ALPHAS, 1 / np.maximum(counts, 1)[:, None])
+        keep = 1 - step
+        factor = keep + (keep == 0)
+        start_mean = np.array([state['mean'][slot], state['baseline_mean'][slot]])
+        start_var = np.array([state['var'][slot], state['baseline_var'][slot]])
+        means = _linear_recurrence(start_mean, factor, step * values)
+        prior_mean = np.concatenate([start_mean[None], means[:-1]])
+        delta = values - prior_mean
+        variances = _linear_recurrence(start_var, factor, keep * step * delta * delta)
+        state['mean'][slot] = means[-1, 0]
+        state['baseline_mean'][slot] = means[-1, 1]
+        state['var'][slot] = variances[-1, 0]
+        state['baseline_var'][slot] = variances[-1, 1]
+        state['count'][slot] = counts[-1]
+
+        # Score every sample, then attribute the few crossings to their samples in
+        # order, as each one reported starts its metric's cooldown
+        warm = present & (counts - seen >= STATS_WARMUP_SAMPLES)
+        if not warm.any():
+            return
+        prior_var = np.concatenate([start_var[None], variances[:-1]])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            zscore = np.abs(samples - prior_mean[:, 0]) / np.sqrt(prior_var[:, 0])
+            drift = np.abs(prior_mean[:, 0] - prior_mean[:, 1]) / np.sqrt(prior_var[:, 1])
+        if not (warm & ((zscore > ZSCORE_THRESHOLD) | (drift > DRIFT_THRESHOLD))).any():
+            return
+        for kind, score, threshold in (('zscore', zscore, ZSCORE_THRESHOLD), ('drift', drift, DRIFT_THRESHOLD)):
+            last_ts = state[f'last_{kind}_ts'][slot]
+            flagged = warm & (score > threshold) & (timestamps[:, None] - last_ts >= ANOMALY_COOLDOWN_MS)
+            sample_indices, metric_indices = flagged.nonzero()
+            for sample_index, metric_index in zip(sample_indices.tolist(), metric_indices.tolist()):
+                ts = timestamps[sample_index]
+                if ts - last_ts[metric_index] >= ANOMALY_COOLDOWN_MS:
+                    last_ts[metric_index] = ts
+                    anomalies.append((offset + sample_index, metric_index, kind,
+                                      float(score[sample_index, metric_index])))
+
+    # Function to estimate a percentile (0-100) of a vehicle's metric from its
+    # histogram, or None before any sample
+    def percentile(self, user_id, metric_name, q):
+        slot = self.slots.get(user_id)
+        if slot is None:
+            return None
+        index = METRIC_COLUMNS.index(metric_name)
+        weights = self.histogram[slot, index].astype(np.float64)
+        total = weights.sum()
+        if total == 0:
+            return None
+        cumulative = np.cumsum(weights) / total
+        bin_index = min(int(np.searchsorted(cumulative, q / 100)), HISTOGRAM_BINS - 1)
+        return float(_LOWS[index] + (bin_index + 0.5) / HISTOGRAM_BINS * _WIDTHS[index])
+
+    # Function to get a vehicle's statistics as {metric: {...}}, or None if unknown
+    def summary(self, user_id):
+        slot = self.slots.get(user_id)
+        if slot is None:
+            return None
+        return {
+            metric: {
+                'count': int(self.state['count'][slot, index]),
+                'mean': float(self.state['mean'][slot, index]),
+                'std': float(np.sqrt(self.state['var'][slot, index])),
+                'baseline_mean': float(self.state['baseline_mean'][slot, index]),
+                'baseline_std': float(np.sqrt(self.state['baseline_var'][slot, index])),
+                'p50': self.percentile(user_id, metric, 50),
+                'p99': self.percentile(user_id, metric, 99)
+            }
+            for index, metric in enumerate(METRIC_COLUMNS)
+        }
+
+    # Copy of everything a checkpoint holds, taken on the thread that updates the stats
+    def snapshot(self):
+        used = len(self.slots)
+        user_ids = np.empty(used, dtype=np.int64)
+        for user_id, slot in self.slots.items():
+            user_ids[slot] = user_id
+        arrays = {name: values[:used].copy() for name, values in self.state.items()}
+        arrays['histogram'] = self.histogram[:used].copy()
+        arrays['user_ids'] = user_ids
+        arrays['metrics'] = np.array(METRIC_COLUMNS)
+        return arrays
+
+    # Restore vehicles from a checkpoint written by save_checkpoint. A vehicle that is
+    # already tracked is only replaced if the checkpoint has seen more of its samples,
+    # so the checkpoints of several processes can be merged. Returns False if there
+    # is none or it was written for a different set of metrics.
+    def load_checkpoint(self, path=None):
+        path = path or STATS_CHECKPOINT
+        if not os.path.exists(path):
+            return False
+        with np.load(path) as checkpoint:
+            if checkpoint['metrics'].tolist() != METRIC_COLUMNS or checkpoint['histogram'].shape[2] != HISTOGRAM_BINS:
+                return False
+            user_ids = checkpoint['user_ids'].tolist()
+            state = {name: checkpoint[name] for name in self.state}
+            histogram = checkpoint['histogram']
+
+        for row, user_id in enumerate(user_ids):
+            slot = self.slots.get(user_id)
+            if slot is not None and self.state['count'][slot].sum() >= state['count'][row].sum():
+                continue
+            slot = self._slot(user_id)
+            for name, values in self.state.items():
+                values[slot] = state[name][row]
+            self.histogram[slot] = histogram[row]
+        return True
+
+# Function to write a snapshot to disk atomically (blocking, run it off the loop)
+def save_checkpoint(snapshot, path=None):
+    path = path or STATS_CHECKPOINT
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **snapshot)
+    os.replace(tmp_path, path)
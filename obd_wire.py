@@ -0,0 +1,142 @@
+import json
+import struct
+import time
+
+import numpy as np
+
+from obd_storage import METRIC_COLUMNS, timestamp_to_ms
+
+# WebSocket subprotocols understood by the daemon. Clients that offer none get
+# plain JSON text frames, which stays the default.
+SUBPROTOCOL_BINARY = 'obd.bin.v1'
+SUBPROTOCOL_JSON = 'obd.json.v1'
+SUBPROTOCOLS = [SUBPROTOCOL_BINARY, SUBPROTOCOL_JSON]
+
+# Binary frame layout (little endian):
+#   header: version u8, flags u8, sample count u16, user_id u32
+#   then `count` samples of: epoch milliseconds i64, one float32 per METRIC_COLUMNS
+#   entry (NaN when the car did not report that metric)
+# One sample is 40 bytes against roughly 300 bytes of JSON. Decoded values are the
+# exact float32 ones (13.2 arrives as 13.199999809265137); displays round them to
+# the 7 significant digits float32 holds.
+#
+# JSON frames are either one sample:
+#   {"user_id": 1, "ts": 1727800882000, "rpm": 900, ...}
+# or a batch sharing one user_id:
+#   {"user_id": 1, "samples": [{"ts": 1727800882000, "rpm": 900, ...}, ...]}
+# "ts" is epoch milliseconds; older clients may send a local "timestamp" of the
+# form "YYYY-MM-DD HH:MM:SS" instead, and samples with neither get the receive time.
+#
+# A frame with "ack": true (JSON) or FLAG_ACK set (binary) is answered with
+# {"ack": <sample count>} once its samples are queued for storage. A rejected frame
+# gets {"error": ...} instead, and frames are answered in the order they were sent,
+# so clients can match replies to frames without an id.
+BINARY_VERSION = 1
+FLAG_ACK = 0x01
+HEADER = struct.Struct('<BBHI')
+
+# Largest user_id a frame can carry, the u32 of the binary header
+MAX_USER_ID = 2**32 - 1
+SAMPLE_DTYPE = np.dtype([('ts', '<i8'), ('values', '<f4', (len(METRIC_COLUMNS),))])
+
+# Largest number of samples accepted in one frame
+MAX_BATCH_SAMPLES = 10000
+
+# Raised for frames that cannot be decoded; the message is sent back to the client
+class FrameError(ValueError):
+    pass
+
+# Function to get the epoch millisecond time of one JSON sample
+def sample_ts(sample, frame):
+    ts = sample.get('ts', frame.get('ts'))
+    if ts is not None:
+        return int(ts)
+    timestamp = sample.get('timestamp', frame.get('timestamp'))
+    if timestamp is not None:
+        return timestamp_to_ms(timestamp)
+    return int(time.time() * 1000)
+
+# Function to parse one JSON metric, accepting unit-suffixed strings like "13.2 V"
+def parse_metric(value):
+    if value is None:
+        return np.nan
+    if isinstance(value, str):
+        value = value.split()[0] if value.strip() else 'nan'
+    return float(value)
+
+# Function to decode a JSON text frame into (user_id, epoch ms array, values, ack)
+def decode_json_frame(message):
+    try:
+        data = json.loads(message)
+    except json.JSONDecodeError as e:
+        raise FrameError(f"Invalid JSON: {e}")
+    if not isinstance(data, dict):
+        raise FrameError("Frame must be a JSON object")
+    if 'user_id' not in data:
+        raise FrameError("user_id missing in message")
+    user_id = data['user_id']
+    # Binary frames can only carry u32 ids; "1" would be a different vehicle in
+    # every per-user table of the daemon, and ids SQLite cannot bind never get there
+    if not isinstance(user_id, int) or isinstance(user_id, bool):
+        raise FrameError("user_id must be an integer")
+    if not 0 <= user_id <= MAX_USER_ID:
+        raise FrameError(f"user_id must be between 0 and {MAX_USER_ID}")
+
+    samples = data.get('samples')
+    if samples is None:
+        samples = [data]
+    elif not isinstance(samples, list) or not all(isinstance(sample, dict) for sample in samples):
+        raise FrameError("samples must be a list of JSON objects")
+    elif not samples:
+        raise FrameError("samples is empty")
+    if len(samples) > MAX_BATCH_SAMPLES:
+        raise FrameError(f"Too many samples in one frame (max {MAX_BATCH_SAMPLES})")
+
+    try:
+        values = np.array([[parse_metric(sample.get(metric)) for metric in METRIC_COLUMNS] for sample in samples])
+    except (TypeError, ValueError):
+        raise FrameError("Metric values must be numbers")
+    try:
+        timestamps = np.array([sample_ts(sample, data) for sample in samples], dtype=np.int64)
+    except (TypeError, ValueError, OverflowError):
+        raise FrameError("ts must be epoch milliseconds or timestamp 'YYYY-MM-DD HH:MM:SS'")
+    return user_id, timestamps, values, data.get('ack') is True
+
+# Function to decode a binary frame into (user_id, epoch ms array, values, ack) without
+# building any per-sample dicts: the samples are a NumPy view over the message
+def decode_binary_frame(message):
+    if len(message) < HEADER.size:
+        raise FrameError("Binary frame too short")
+    version, flags, count, user_id = HEADER.unpack_from(message)
+    if version != BINARY_VERSION:
+        raise FrameError(f"Unsupported binary frame version {version}")
+    if count == 0:
+        raise FrameError("Binary frame has no samples")
+    if count > MAX_BATCH_SAMPLES:
+        raise FrameError(f"Too many samples in one frame (max {MAX_BATCH_SAMPLES})")
+    if len(message) != HEADER.size + count * SAMPLE_DTYPE.itemsize:
+        raise FrameError("Binary frame length does not match its sample count")
+
+    samples = np.frombuffer(message, dtype=SAMPLE_DTYPE, count=count, offset=HEADER.size)
+    return user_id, samples['ts'], samples['values'].astype(np.float64), bool(flags & FLAG_ACK)
+
+# Function to decode any frame: bytes are binary frames, text is JSON
+def decode_frame(message):
+    if isinstance(message, (bytes, bytearray, memoryview)):
+        return decode_binary_frame(bytes(message))
+    return decode_json_frame(message)
+
+# Function to encode samples as a binary frame. Each sample is a dict with an
+# epoch-millisecond 'ts' and any of the METRIC_COLUMNS keys.
+def encode_binary_frame(user_id, samples, flags=0):
+    timestamps = [sample['ts'] for sample in samples]
+    values = [[parse_metric(sample.get(metric)) for metric in METRIC_COLUMNS] for sample in samples]
+    return encode_binary_samples(user_id, timestamps, values, flags)
+
+# Function to encode an epoch ms array and an (n, len(METRIC_COLUMNS)) array of
+# values as a binary frame
+def encode_binary_samples(user_id, timestamps, values, flags=0):
+    records = np.empty(len(timestamps), dtype=SAMPLE_DTYPE)
+    records['ts'] = timestamps
+    records['values'] = values
+    return HEADER.pack(BINARY_VERSION, flags, len(records), user_id) + records.tobytes()